@@ -1,12 +1,17 @@
 from libs.kernel import KernelCmdlineParser
 from libs.repositories import ImageRepository, ConfigRepository
 from libs.volumes import VolumeManager
-from libs.partitioning import Disk
+from libs.partitioning import Disk, set_block_backend
 from libs.execution import RPFileExecutor
+from libs.prefetch import Prefetcher
+from libs.transports import get_transport
+from libs.peering import PeerRegistry, PeerServer, PeerTransport
+from libs.multicast import MulticastTransport
 from libs.picker import AnsiPicker
 from libs.pretty import setup
-from libs.constants import DEFAULT_REMOTE_MOUNTPOINT, DEFAULT_CACHE_MOUNTPOINT, DEFAULT_CACHE_LABEL, DEFAULT_PORT
-import requests, logging
+from libs.constants import DEFAULT_REMOTE_MOUNTPOINT, DEFAULT_CACHE_MOUNTPOINT, DEFAULT_CACHE_LABEL, DEFAULT_PORT, DEFAULT_MAX_WORKERS, \
+  DEFAULT_EVICTION_POLICY, DEFAULT_TRANSPORT, CONFIG_CACHE_FILE, DEFAULT_BLOCK_BACKEND
+import logging, os.path, requests
 
 cmdline = KernelCmdlineParser()
 
@@ -17,7 +22,17 @@ CACHE_MOUNTPOINT=cmdline.get("cache_mountpoint") or DEFAULT_CACHE_MOUNTPOINT
 CACHE_LABEL=cmdline.get("cache_label") or DEFAULT_CACHE_LABEL
 HOST=cmdline.get("host")
 PORT=int(cmdline.get("port") or DEFAULT_PORT)
-VOLUMEFILE = requests.get(f"http://{HOST}:{PORT}/labels", timeout=10)
+WORKERS=int(cmdline.get("workers") or DEFAULT_MAX_WORKERS)
+PULL_THROUGH="no_pull_through" not in cmdline
+EVICTION_POLICY=cmdline.get("eviction") or DEFAULT_EVICTION_POLICY
+TRANSPORT=cmdline.get("transport") or DEFAULT_TRANSPORT
+PEER_PORT=cmdline.get("peer_port")
+MULTICAST=cmdline.get("multicast")
+BLOCK_BACKEND=cmdline.get("block_backend") or DEFAULT_BLOCK_BACKEND
+ROOM=cmdline.get("room")
+UPLOAD_REPORTS="upload_reports" in cmdline
+
+set_block_backend(BLOCK_BACKEND)
 
 for disk in Disk.get_all().values():
     for part in disk.partitions:
@@ -29,14 +44,56 @@ for disk in Disk.get_all().values():
 _logger.info(f"Using root disk {root_disk.path}")
 _logger.info(f"Local repo at {repo_part.path}")
 
-image_repo = ImageRepository(REMOTE_MOUNTPOINT, CACHE_MOUNTPOINT, True)
-volume_man = VolumeManager(root_disk, repo_part, VOLUMEFILE)
-config_repo = ConfigRepository(HOST, PORT, True)
+# Boots from the last known good configs when the server is down
+config_repo = ConfigRepository(HOST, PORT, True, os.path.join(CACHE_MOUNTPOINT, CONFIG_CACHE_FILE))
+
+image_repo = ImageRepository(REMOTE_MOUNTPOINT, CACHE_MOUNTPOINT, True, EVICTION_POLICY,
+                             get_transport(TRANSPORT, f"http://{HOST}:{PORT}"))
+volume_man = VolumeManager(root_disk, repo_part, config_repo.volume_file)
+
+peer_server = None
+if PEER_PORT:
+  # Share our cache with the room and prefer peers when pulling
+  registry = PeerRegistry(f"http://{HOST}:{PORT}", int(PEER_PORT))
+  peer_server = PeerServer(image_repo, registry, int(PEER_PORT))
+  peer_server.start()
+  image_repo.transport = PeerTransport(f"http://{HOST}:{PORT}", registry, image_repo.transport)
+
+if MULTICAST:
+  # Receive images sent to the whole room, repair gaps through the other transports
+  group, group_port = MULTICAST.rsplit(":", 1)
+  image_repo.transport = MulticastTransport(group, int(group_port), image_repo.transport)
+
+# Keep images the lab configs use cached over leftovers
+image_repo.pin(image for config in config_repo.configs.values() for image in config.required_images)
+
+# Start pulling for the default config while the picker is on screen
+prefetcher = None
+if config_repo.configs:
+  default_config = next(iter(config_repo.configs.values()))
+  prefetcher = Prefetcher(RPFileExecutor(default_config, image_repo, volume_man,
+                                         max_workers=WORKERS, pull_through=PULL_THROUGH))
+  prefetcher.start()
 
 picker = AnsiPicker(config_repo.configs)
 selected_config = picker.ask(15)
+if prefetcher:
+  prefetcher.stop(selected_config)
+
+selected_name = next(name for name, config in config_repo.configs.items() if config is selected_config)
 
 with wrapper:
-  executor = RPFileExecutor(selected_config, image_repo, volume_man)
+  executor = RPFileExecutor(selected_config, image_repo, volume_man, max_workers=WORKERS,
+                            pull_through=PULL_THROUGH, name=selected_name, room=ROOM)
   executor.compile()
-  executor.execute()
\ No newline at end of file
+  try:
+    executor.execute()
+  finally:
+    if UPLOAD_REPORTS and executor.report:
+      try:
+        executor.report.post(f"http://{HOST}:{PORT}")
+      except requests.RequestException as ex:
+        _logger.warning(f"Failed to upload run report: {ex}")
+
+if peer_server:
+  peer_server.announce()
\ No newline at end of file
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+"""End-to-end harness running whole RPFiles without a lab machine.
+    Builds a partitioned loop device disk, a local directory standing in
+    for the NFS repository, the failrp server on localhost and synthetic
+    images for every image the RPFile uses. Deploys go through
+    fake-ocs-sr, which writes at --ocs-rate MB/s. The RPFile is then
+    compiled and executed, timing every operation, e.g.
+        e2e_bench.py configs/RPFile.linux --runs 2 -o linux.json
+    Needs root for loop devices and mounts"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from os.path import join, dirname, abspath, basename
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, join(ROOT, "server"))
+
+# Resolved when libs.imaging is imported
+os.environ.setdefault("FAILRP_OCS_SR", join(ROOT, "benchmarks", "fake-ocs-sr"))
+
+import sh
+from werkzeug.serving import make_server
+from libs.rpfile import RPFile, DeployInstruction
+from libs.repositories import ImageRepository, ConfigRepository, publish_image
+from libs.partitioning import Disk, get_topology, invalidate_topology, set_block_backend, \
+    set_disk_types
+from libs.volumes import VolumeManager
+from libs.execution import RPFileExecutor
+from libs.transports import get_transport
+from libs.unpacking import archive_format
+from libs.pretty import setup
+from libs.constants import DEFAULT_CACHE_LABEL, DEFAULT_MAX_WORKERS, DEFAULT_BLOCK_BACKEND
+import server as failrp_server
+
+wrapper, print, console, status, _logger, progress = setup()
+
+# sh logs every command it starts
+logging.getLogger("sh").setLevel(logging.WARNING)
+
+SECTOR = 512
+# First partition starts at 1 MiB
+FIRST_SECTOR = 2048
+LINUX_PARTITION = 0x83
+DEFAULT_PART = "sda1"
+ARCHIVE_FILES = 64
+SEED = 2022
+
+def parse_size(value: str) -> int:
+    """parses sizes like 64K, 16M or 1G"""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def write_mbr(disk_image: str, sizes: "list[int]") -> "list[int]":
+    """writes an MBR partition table with up to 4 partitions of the given sizes,
+        returns their sizes after alignment"""
+    if len(sizes) > 4:
+        raise ValueError("An MBR disk holds at most 4 partitions")
+
+    entries, aligned = b"", []
+    start = FIRST_SECTOR
+    for size in sizes:
+        sectors = size // SECTOR // FIRST_SECTOR * FIRST_SECTOR
+        entries += struct.pack("<B3sB3sII", 0, b"\xfe\xff\xff", LINUX_PARTITION,
+                               b"\xfe\xff\xff", start, sectors)
+        aligned.append(sectors * SECTOR)
+        start += sectors
+
+    with open(disk_image, "r+b") as _f:
+        _f.seek(440)
+        _f.write(random.Random(SEED).randbytes(4) + b"\0\0" + entries.ljust(64, b"\0") + b"\x55\xaa")
+    return aligned
+
+def write_random(file_path: str, size: int, rng: random.Random):
+    """writes size reproducible random bytes"""
+    with open(file_path, "wb") as _f:
+        for offset in range(0, size, 1024**2):
+            _f.write(rng.randbytes(min(1024**2, size - offset)))
+
+def make_filesystem(file_path: str, size: int, root: str, label=None):
+    """writes an ext4 filesystem image populated from root"""
+    with open(file_path, "wb") as _f:
+        _f.truncate(size)
+    args = ["-q", "-F", "-d", root]
+    if label:
+        args += ["-L", label]
+    sh.Command("mkfs.ext4")(*args, file_path)
+
+class Lab:
+    """A simulated lab machine and the server it boots from"""
+    def __init__(self, args):
+        self.args = args
+        self.work = tempfile.mkdtemp(prefix="failrp-e2e-")
+        self.repo = join(self.work, "repo")
+        self.configs = join(self.work, "rpository")
+        self.cache = join(self.work, "cache")
+        self.device: "str | None" = None
+        self.server = None
+        self.link: "str | None" = None
+        self.cache_part = None
+        self.mounts: "list[str]" = []
+        for directory in (self.repo, self.configs, self.cache):
+            os.mkdir(directory)
+
+        with open(args.rpfile, "r", encoding="utf-8") as _f:
+            self.source = _f.read()
+        self.name = basename(args.rpfile)
+        self.rpfile = RPFile(self.source)
+        # Every volume gets a partition, the cache takes the last one
+        self.volumes = list(dict.fromkeys(self.rpfile.required_volumes))
+
+    def build_disk(self):
+        """creates the loop device disk with a partition per volume and the cache"""
+        disk_size = parse_size(self.args.disk_size)
+        cache_size = parse_size(self.args.cache_size)
+        volume_size = (disk_size - cache_size - 2 * FIRST_SECTOR * SECTOR) // max(len(self.volumes), 1)
+        image = join(self.work, "disk.img")
+        with open(image, "wb") as _f:
+            _f.truncate(disk_size)
+        sizes = write_mbr(image, [volume_size] * len(self.volumes) + [cache_size])
+        self.volume_size = sizes[0] if self.volumes else 0
+
+        self.device = str(sh.losetup("-P", "--find", "--show", image)).strip()
+        try:
+            # Some kernels only scan the table when asked
+            sh.partx("-a", self.device)
+        except sh.ErrorReturnCode:
+            pass
+        self.settle()
+
+        parts = [f"{self.device}p{i + 1}" for i in range(len(sizes))]
+        for part in parts[:-1]:
+            sh.Command("mkfs.ext4")("-q", "-F", part)
+        sh.Command("mkfs.ext4")("-q", "-F", "-L", DEFAULT_CACHE_LABEL, parts[-1])
+        self.settle()
+
+        with open(join(self.configs, self.name), "w", encoding="utf-8") as _f:
+            _f.write(self.source)
+        self.volume_file = join(self.work, "volumes.yaml")
+        with open(self.volume_file, "w", encoding="utf-8") as _f:
+            _f.write("volumes:\n" + "".join(f"  {volume}:\n    index: {i + 1}\n"
+                                            for i, volume in enumerate(self.volumes)))
+
+    @staticmethod
+    def settle():
+        """waits for udev to pick up partition and filesystem changes"""
+        try:
+            sh.udevadm("settle")
+        except (sh.ErrorReturnCode, sh.CommandNotFound):
+            pass
+        invalidate_topology()
+
+    def build_images(self):
+        """publishes synthetic images for every image the RPFile uses"""
+        rng = random.Random(SEED)
+        image_size = parse_size(self.args.image_size)
+        deploys = {instruction.image: instruction.image_volume or DEFAULT_PART
+                   for instruction in self.rpfile.instructions
+                   if isinstance(instruction, DeployInstruction)}
+
+        for name in dict.fromkeys(self.rpfile.required_images):
+            image = join(self.repo, name)
+            if name in deploys:
+                self.build_deploy_image(image, deploys[name], rng)
+            elif archive_format(name):
+                self.build_archive(image, image_size, rng)
+            else:
+                write_random(image, image_size, rng)
+            publish_image(image)
+            _logger.info(f"Published {name} ({os.stat(image).st_size} bytes)")
+
+    def build_deploy_image(self, image: str, part: str, rng: random.Random):
+        """writes an image holding a filesystem for part, the directories
+            COPY and UNPACK write into exist in it like in a real system image"""
+        size = min(parse_size(self.args.deploy_size), self.volume_size)
+        tree = tempfile.mkdtemp(dir=self.work)
+        for instruction in self.rpfile.instructions:
+            if hasattr(instruction, "path"):
+                target = dirname(instruction.path.lstrip("/"))
+                os.makedirs(join(tree, target), exist_ok=True)
+        write_random(join(tree, "payload.bin"), size // 4, rng)
+
+        staging = tempfile.mkdtemp(dir=self.work)
+        make_filesystem(join(staging, f"{part}.img"), size, tree)
+        with open(join(staging, "parts"), "w", encoding="utf-8") as _f:
+            _f.write(part)
+        make_filesystem(image, size + size // 8 + 64 * 1024**2, staging)
+        shutil.rmtree(tree)
+        shutil.rmtree(staging)
+
+    @staticmethod
+    def build_archive(image: str, size: int, rng: random.Random):
+        """writes an archive of ARCHIVE_FILES random files"""
+        tree = tempfile.mkdtemp()
+        try:
+            for i in range(ARCHIVE_FILES):
+                write_random(join(tree, f"file-{i}.bin"), size // ARCHIVE_FILES, rng)
+            ext = archive_format(image)
+            base = image[:-len(ext)]
+            formats = {".zip": "zip", ".tar": "tar", ".tar.gz": "gztar", ".tgz": "gztar",
+                       ".tar.bz2": "bztar", ".tbz2": "bztar", ".tar.xz": "xztar", ".txz": "xztar"}
+            if ext not in formats:
+                raise NotImplementedError(f"Can't build {ext} archives")
+            shutil.move(shutil.make_archive(base, formats[ext], tree), image)
+        finally:
+            shutil.rmtree(tree)
+
+    def start_server(self):
+        """serves configs and images on localhost like the lab server"""
+        failrp_server.CONFIG_REPOSITORY = self.configs
+        failrp_server.VOLUME_FILE = self.volume_file
+        failrp_server.IMAGE_REPOSITORY = self.repo
+        failrp_server.REPORTS_FILE = join(self.work, "reports.jsonl")
+        failrp_server.app.debug = False
+        self.server = make_server("127.0.0.1", self.args.port, failrp_server.app, threaded=True)
+        self.link = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def client(self):
+        """returns the repositories and volume manager app.py would set up"""
+        invalidate_topology()
+        root_disk = Disk.from_device(self.device)
+        self.cache_part = get_topology().partition(self.device, len(self.volumes) + 1)
+        self.cache_part.mount(self.cache)
+        self.mounts.append(self.cache)
+
+        config_repo = ConfigRepository("127.0.0.1", str(self.server.server_port), True)
+        image_repo = ImageRepository(self.repo, self.cache, True,
+                                     transport=get_transport(self.args.transport, self.link))
+        volume_man = VolumeManager(root_disk, self.cache_part, config_repo.volume_file)
+        return config_repo, image_repo, volume_man
+
+    def close(self):
+        """tears the lab down"""
+        if self.server:
+            self.server.shutdown()
+        for mount_path in reversed(self.mounts):
+            try:
+                sh.umount(mount_path)
+            except sh.ErrorReturnCode as ex:
+                _logger.warning(f"Failed to unmount {mount_path}: {ex}")
+        if self.device:
+            sh.losetup("-d", self.device)
+        shutil.rmtree(self.work, ignore_errors=True)
+
+def run(lab: Lab, run_index: int) -> dict:
+    """compiles and executes the RPFile once, returns its timings"""
+    config_repo, image_repo, volume_man = lab.client()
+    config = config_repo.configs[lab.name]
+    executor = RPFileExecutor(config, image_repo, volume_man, max_workers=lab.args.workers,
+                              pull_through=not lab.args.no_pull_through, name=lab.name, room="e2e")
+
+    with wrapper:
+        start = time.perf_counter()
+        executor.compile()
+        compiled = time.perf_counter() - start
+        success = False
+        try:
+            executor.execute()
+            success = True
+        except RuntimeError as ex:
+            _logger.error(f"Run {run_index + 1} failed: {ex.__cause__ or ex}")
+
+    # The next run starts from a freshly mounted cache like a reboot would
+    lab.cache_part.umount()
+    lab.mounts.remove(lab.cache)
+    report = executor.report.to_dict()
+    report.update({"run": run_index, "compile": compiled, "success": success})
+    return report
+
+def summarize(reports: "list[dict]"):
+    """prints operation timings of every run"""
+    for report in reports:
+        console.print(f"Run {report['run'] + 1}: {report['duration']:.2f}s "
+                      f"(compile {report['compile']:.3f}s){'' if report['success'] else ' FAILED'}")
+        for operation in report["operations"]:
+            rate = f"{operation['mb_per_s']:8.1f} MB/s" if operation["mb_per_s"] else " " * 13
+            hit = {True: "hit", False: "miss", None: ""}[operation["cache_hit"]]
+            console.print(f"  {operation['index'] + 1:>3} {operation['operation']:<17} "
+                          f"{operation['duration']:8.2f}s {rate} {hit:<4} {' '.join(operation['instruction'].split())}")
+
+def main():
+    """Start method"""
+    parser = argparse.ArgumentParser(description="Run an RPFile end to end on a loop device disk")
+    parser.add_argument("rpfile", help="RPFile to run, e.g. configs/RPFile.linux")
+    parser.add_argument("-o", "--output", help="JSON file for the timings of every run")
+    parser.add_argument("--runs", type=int, default=1,
+                        help="times to run the RPFile, later runs start with a warm cache")
+    parser.add_argument("--disk-size", default="8G", help="size of the simulated disk")
+    parser.add_argument("--cache-size", default="4G", help="size of the cache partition")
+    parser.add_argument("--deploy-size", default="512M", help="size of deployed filesystems")
+    parser.add_argument("--image-size", default="128M", help="size of copied and unpacked images")
+    parser.add_argument("--ocs-rate", type=float, default=0,
+                        help="write rate of the fake ocs-sr in MB/s, 0 for unlimited")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS)
+    parser.add_argument("--transport", default="file", choices=["file", "http"])
+    parser.add_argument("--no-pull-through", action="store_true")
+    parser.add_argument("--block-backend", default=DEFAULT_BLOCK_BACKEND)
+    parser.add_argument("--port", type=int, default=0, help="port of the local server, any free one by default")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print("Loop devices and mounts need root")
+        return 1
+
+    os.environ["FAILRP_FAKE_OCS_RATE"] = str(args.ocs_rate)
+    set_block_backend(args.block_backend)
+    set_disk_types(["disk", "loop"])
+
+    lab = Lab(args)
+    reports = []
+    try:
+        lab.build_disk()
+        lab.build_images()
+        lab.start_server()
+        for i in range(args.runs):
+            reports.append(run(lab, i))
+    finally:
+        lab.close()
+
+    summarize(reports)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as _f:
+            json.dump({"rpfile": args.rpfile, "ocs_rate": args.ocs_rate,
+                       "transport": args.transport, "workers": args.workers,
+                       "runs": reports}, _f, indent=2)
+
+    return 0 if all([report["success"] for report in reports]) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+"""I/O benchmarks of the copy, hash, pull and sync paths.
+    run writes JSON results, compare diffs two result files, e.g.
+        io_bench.py run -o before.json
+        io_bench.py run -o after.json
+        io_bench.py compare before.json after.json
+    The loop mounted ext4 target needs root, it is skipped otherwise"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import sh
+from libs.pretty_copy import copy_with_callback
+from libs.repositories import Image, ImageRepository, compute_hash, write_image_hash
+from libs.constants import INDEX_FILE
+
+# sh logs every command it starts
+logging.getLogger("sh").setLevel(logging.WARNING)
+
+BENCHMARKS = ["copy", "hash", "pull", "sync"]
+FILESYSTEMS = ["tmpfs", "ext4"]
+FILE_KINDS = ["dense", "sparse"]
+DEFAULT_BLOCK_SIZES = ["64K", "1M", "4M", "16M", "64M"]
+# Data written into sparse files every SPARSE_STRIDE bytes
+SPARSE_STRIDE = 64 * 1024**2
+FILL_BLOCK = 1024**2
+SEED = 2022
+
+def parse_size(value: str) -> int:
+    """parses sizes like 64K, 16M or 1G"""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def format_size(size: int) -> str:
+    """formats sizes like parse_size reads them"""
+    for unit, factor in (("G", 1024**3), ("M", 1024**2), ("K", 1024)):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{unit}"
+    return str(size)
+
+def make_file(file_path: str, size: int, kind: str):
+    """writes a reproducible dense file or a mostly sparse one"""
+    rng = random.Random(SEED)
+    with open(file_path, "wb") as _f:
+        if kind == "sparse":
+            _f.truncate(size)
+            for offset in range(0, size, SPARSE_STRIDE):
+                _f.seek(offset)
+                _f.write(rng.randbytes(min(FILL_BLOCK, size - offset)))
+        else:
+            for offset in range(0, size, FILL_BLOCK):
+                _f.write(rng.randbytes(min(FILL_BLOCK, size - offset)))
+
+def drop_cache(*files: str):
+    """evicts files from the page cache so runs start cold, tmpfs keeps them"""
+    for file in files:
+        if not os.path.isfile(file):
+            continue
+        fd = os.open(file, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+class Target:
+    """A directory on the filesystem under test"""
+    def __init__(self, name: str, root: str, cleanup=None):
+        self.name = name
+        self.root = root
+        self.cleanup = cleanup
+
+    def close(self):
+        """removes the target"""
+        shutil.rmtree(self.root, ignore_errors=True)
+        if self.cleanup:
+            self.cleanup()
+
+def tmpfs_target(base: str) -> "Target | None":
+    """returns a directory on tmpfs"""
+    if not os.path.isdir(base):
+        print(f"Skipping tmpfs, {base} does not exist", file=sys.stderr)
+        return None
+    return Target("tmpfs", tempfile.mkdtemp(prefix="failrp-bench-", dir=base))
+
+def ext4_target(size: int) -> "Target | None":
+    """returns a directory on a loop mounted ext4 image"""
+    if os.geteuid() != 0:
+        print("Skipping ext4, mounting a loop device needs root", file=sys.stderr)
+        return None
+
+    work = tempfile.mkdtemp(prefix="failrp-bench-")
+    image = join(work, "ext4.img")
+    mount_path = join(work, "mnt")
+    os.mkdir(mount_path)
+    try:
+        with open(image, "wb") as _f:
+            _f.truncate(size)
+        sh.Command("mkfs.ext4")("-q", "-F", image)
+        sh.mount("-o", "loop", image, mount_path)
+    except (sh.ErrorReturnCode, sh.CommandNotFound) as ex:
+        print(f"Skipping ext4, failed to set up the loop mount: {ex}", file=sys.stderr)
+        shutil.rmtree(work, ignore_errors=True)
+        return None
+
+    def _cleanup():
+        sh.umount(mount_path)
+        shutil.rmtree(work, ignore_errors=True)
+
+    root = join(mount_path, "bench")
+    os.mkdir(root)
+    return Target("ext4", root, _cleanup)
+
+class Counter:
+    """Progress callback doing as little as possible"""
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, copied, copied_total, total):
+        self.calls += 1
+
+def timed(function, repeat: int, before=None) -> "list[float]":
+    """returns wall times of repeat calls of function, before runs untimed ahead of each"""
+    times = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+def bench_file(target: Target, kind: str, size: int, block_sizes: "list[int]",
+               benchmarks: "list[str]", repeat: int) -> "list[dict]":
+    """runs the copy, hash and pull benchmarks on one file"""
+    repo = join(target.root, "repo")
+    cache = join(target.root, "cache")
+    os.makedirs(repo, exist_ok=True)
+    os.makedirs(cache, exist_ok=True)
+    source = join(repo, f"{kind}.img")
+    destination = join(cache, f"{kind}.img")
+    make_file(source, size, kind)
+    __hash = compute_hash(source)
+    write_image_hash(source, __hash)
+
+    results = []
+    for block_size in block_sizes:
+        for callback in (False, True):
+            runs = {
+                "copy": lambda cb: copy_with_callback(source, destination, callback=cb,
+                                                      buffer_size=block_size),
+                "hash": lambda cb: compute_hash(source, cb, block_size=block_size),
+                "pull": lambda cb: Image(kind, source, None, __hash, None).pull(
+                    destination, progress_callback=cb, block_size=block_size),
+            }
+            for name in [name for name in BENCHMARKS if name in benchmarks and name in runs]:
+                counter = Counter() if callback else None
+                times = timed(lambda: runs[name](counter), repeat,
+                              before=lambda: drop_cache(source, destination))
+                results.append(result(name, target.name, kind, size, times,
+                                      block_size=block_size, callback=callback,
+                                      callbacks=counter.calls // repeat if counter else 0))
+                if os.path.exists(destination):
+                    os.remove(destination)
+
+    shutil.rmtree(repo)
+    shutil.rmtree(cache)
+    return results
+
+def bench_sync(target: Target, images: int, repeat: int) -> "list[dict]":
+    """runs ImageRepository.sync over many published images, cold without an index
+        and warm with the index of the previous sync"""
+    repo = join(target.root, "sync-repo")
+    cache = join(target.root, "sync-cache")
+    os.makedirs(repo)
+    os.makedirs(cache)
+    for i in range(images):
+        for directory in (repo, cache):
+            image = join(directory, f"image-{i}.img")
+            with open(image, "wb") as _f:
+                _f.write(i.to_bytes(8, "little"))
+            write_image_hash(image, f"{i:064x}")
+
+    def _cold():
+        index = join(cache, INDEX_FILE)
+        if os.path.exists(index):
+            os.remove(index)
+
+    cold = timed(lambda: ImageRepository(repo, cache).sync(), repeat, before=_cold)
+    warm = timed(lambda: ImageRepository(repo, cache).sync(), repeat)
+    shutil.rmtree(repo)
+    shutil.rmtree(cache)
+    return [result("sync", target.name, "cold", images, cold),
+            result("sync", target.name, "warm", images, warm)]
+
+def result(name: str, filesystem: str, kind: str, size: int, times: "list[float]",
+           block_size=None, callback=None, callbacks=0) -> dict:
+    """returns a result entry, size is bytes for files and images for sync"""
+    median = statistics.median(times)
+    return {
+        "bench": name,
+        "fs": filesystem,
+        "file": kind,
+        "size": size,
+        "block_size": block_size,
+        "callback": callback,
+        "callbacks": callbacks,
+        "seconds": times,
+        "median": median,
+        # images/s for sync
+        "rate": (size / 1024**2 if name != "sync" else size) / median if median else None
+    }
+
+def key(entry: dict) -> tuple:
+    """identifies a result across runs"""
+    return (entry["bench"], entry["fs"], entry["file"], entry["block_size"], entry["callback"])
+
+def describe(entry: dict) -> str:
+    """returns a readable name of a result"""
+    name = f"{entry['bench']:<5} {entry['fs']:<6} {entry['file']:<7}"
+    if entry["block_size"] is not None:
+        name += f" bs={format_size(entry['block_size']):<4} cb={'on' if entry['callback'] else 'off'}"
+    return name
+
+def git_commit() -> "str | None":
+    """returns the checked out commit"""
+    try:
+        return str(sh.git("rev-parse", "HEAD", _cwd=dirname(dirname(abspath(__file__))))).strip()
+    except (sh.ErrorReturnCode, sh.CommandNotFound):
+        return None
+
+def run(args) -> int:
+    """runs the benchmarks"""
+    size = parse_size(args.size)
+    block_sizes = [parse_size(value) for value in args.block_sizes]
+    targets = []
+    if "tmpfs" in args.fs:
+        targets.append(tmpfs_target(args.tmpfs))
+    if "ext4" in args.fs:
+        # Room for the source, the copy and the partial of a pull
+        targets.append(ext4_target(4 * size + 256 * 1024**2))
+    targets = [target for target in targets if target is not None]
+    if not targets:
+        print("No filesystem to benchmark", file=sys.stderr)
+        return 1
+
+    results = []
+    try:
+        for target in targets:
+            for kind in args.files:
+                print(f"Benchmarking {kind} file on {target.name}", file=sys.stderr)
+                results += bench_file(target, kind, size, block_sizes, args.bench, args.repeat)
+            if "sync" in args.bench:
+                print(f"Benchmarking sync on {target.name}", file=sys.stderr)
+                results += bench_sync(target, args.images, args.repeat)
+    finally:
+        for target in targets:
+            target.close()
+
+    for entry in results:
+        unit = "images/s" if entry["bench"] == "sync" else "MB/s"
+        print(f"{describe(entry)}  {entry['rate']:10.1f} {unit}", file=sys.stderr)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "kernel": platform.release(),
+        "time": time.time(),
+        "size": size,
+        "repeat": args.repeat,
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as _f:
+            json.dump(report, _f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    return 0
+
+def compare(args) -> int:
+    """compares two result files, fails if anything slowed down beyond the threshold"""
+    with open(args.before, "r", encoding="utf-8") as _f:
+        before = json.load(_f)
+    with open(args.after, "r", encoding="utf-8") as _f:
+        after = json.load(_f)
+
+    if before["size"] != after["size"]:
+        print(f"Warning: file sizes differ ({before['size']} and {after['size']} bytes)", file=sys.stderr)
+
+    old = {key(entry): entry for entry in before["results"]}
+    regressions = 0
+    print(f"{before.get('commit') or 'before'} -> {after.get('commit') or 'after'}")
+    for entry in after["results"]:
+        previous = old.get(key(entry))
+        if previous is None or not previous["rate"] or not entry["rate"]:
+            continue
+
+        change = (entry["rate"] / previous["rate"] - 1) * 100
+        flag = ""
+        if change < -args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{describe(entry)}  {previous['rate']:10.1f} -> {entry['rate']:10.1f}  {change:+6.1f}%{flag}")
+
+    return 1 if regressions else 0
+
+def main():
+    """Start method"""
+    parser = argparse.ArgumentParser(description="Benchmark failrp copy, hash, pull and sync paths")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run benchmarks")
+    run_parser.add_argument("-o", "--output", help="JSON result file, stdout by default")
+    run_parser.add_argument("--size", default="512M", help="size of the benchmarked files")
+    run_parser.add_argument("--block-sizes", nargs="+", default=DEFAULT_BLOCK_SIZES,
+                            help="block sizes to sweep")
+    run_parser.add_argument("--bench", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    run_parser.add_argument("--fs", nargs="+", choices=FILESYSTEMS, default=FILESYSTEMS)
+    run_parser.add_argument("--files", nargs="+", choices=FILE_KINDS, default=FILE_KINDS)
+    run_parser.add_argument("--tmpfs", default="/dev/shm", help="tmpfs directory")
+    run_parser.add_argument("--images", type=int, default=500, help="images in the sync benchmark")
+    run_parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the median is kept")
+    run_parser.set_defaults(function=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=10,
+                                help="percent slowdown reported as a regression")
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args()
+    return args.function(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,11 +3,12 @@ import time
 from banner import banner
 from rich.style import Style
 from rich.text import Text
-from libs.partitioning import Partition, Disk
+from libs.partitioning import Partition, Disk, invalidate_topology, set_block_backend
 from libs.formatting import format_partition
 from libs.kernel import KernelCmdlineParser
 from libs.picker import AnsiPicker
-from libs.constants import DEFAULT_REMOTE_MOUNTPOINT, DEFAULT_CACHE_MOUNTPOINT, DEFAULT_CACHE_LABEL
+from libs.constants import DEFAULT_REMOTE_MOUNTPOINT, DEFAULT_CACHE_MOUNTPOINT, DEFAULT_CACHE_LABEL, \
+    DEFAULT_BLOCK_BACKEND
 from sh import mount, beep, mkdir, cfdisk
 from libs.pretty import setup as r_setup
 
@@ -19,8 +20,11 @@ REMOTE_MOUNTPOINT = cmdline.get(
     "remote_mountpoint") or DEFAULT_REMOTE_MOUNTPOINT
 CACHE_MOUNTPOINT = cmdline.get("cache_mountpoint") or DEFAULT_CACHE_MOUNTPOINT
 CACHE_LABEL = cmdline.get("cache_label") or DEFAULT_CACHE_LABEL
+BLOCK_BACKEND = cmdline.get("block_backend") or DEFAULT_BLOCK_BACKEND
 ERROR_TIMEOUT = 10
 
+set_block_backend(BLOCK_BACKEND)
+
 print(Text(banner(), style=Style(color="blue")))
 
 def sizeof_fmt(num, suffix="B"):
@@ -58,6 +62,7 @@ def create_local_repo():
 
         logger.info("Now entering cfdisk")
         cfdisk(picked.path, _fg=True)
+        invalidate_topology()
         # recurse
         return create_local_repo()
     
@@ -1,8 +1,35 @@
 HASH_SIG = ".sha256"
+PART_SIG = ".part"
+CHECKPOINT_SIG = ".checkpoint"
+CHUNKS_SIG = ".chunks"
+INDEX_FILE = ".failrp-index.json"
+USAGE_FILE = ".failrp-usage.json"
+CONFIG_CACHE_FILE = ".failrp-configs.json"
+REPORTS_DIR = ".failrp-reports"
 HASH_BLOCK_SIZE=4096*4096
 COPY_BLOCK_SIZE=4096*4096
+PULL_RETRIES=2
+HASH_WORKERS=2
+CHECKPOINT_INTERVAL=16*COPY_BLOCK_SIZE
+CHUNK_SIZE=4*1024*1024
+HTTP_CONNECTIONS=4
+HTTP_CHUNK_SIZE=8*1024*1024
+HTTP_RETRIES=2
+PEER_ANNOUNCE_INTERVAL=30
+MULTICAST_PAYLOAD=1400
+MULTICAST_IDLE_TIMEOUT=5
+MULTICAST_POLL_INTERVAL=0.5
+UNPACK_WORKERS=4
+UNPACK_BUFFER_SIZE=1024*1024
+UNPACK_INLINE_SIZE=1024*1024
+OCS_STATUS_INTERVAL=0.5
+DEFAULT_OCS_SR="/usr/sbin/ocs-sr"
 LSBLK_DEFAULT_COLUMNS=["size", "rm", "partuuid", "uuid", "fstype", "partlabel", "label", "mountpoint"]
 DEFAULT_REMOTE_MOUNTPOINT="/mnt/repo"
 DEFAULT_CACHE_MOUNTPOINT="/mnt/cache"
 DEFAULT_CACHE_LABEL="FAILRP_CACHE"
-DEFAULT_PORT=2021
\ No newline at end of file
+DEFAULT_PORT=2021
+DEFAULT_MAX_WORKERS=2
+DEFAULT_EVICTION_POLICY="cost"
+DEFAULT_TRANSPORT="file"
+DEFAULT_BLOCK_BACKEND="auto"
@@ -0,0 +1,166 @@
+"""Cache eviction policies and usage history"""
+from __future__ import annotations
+from abc import ABC, abstractmethod
+import os
+import os.path as path
+import json
+import threading
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+    from .repositories import Image
+
+# Used until a pull has measured the real repository bandwidth, 100 MB/s
+DEFAULT_BANDWIDTH = 100 * 1024 * 1024
+# Weight of the newest sample in the bandwidth moving average
+BANDWIDTH_SMOOTHING = 0.3
+
+class UsageHistory:
+    """Image usage history stored on the cache partition"""
+    def __init__(self, history_path: "str | None"):
+        self.history_path = history_path
+        self.images: "dict[str, dict]" = {}
+        self.bandwidth: "float | None" = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """loads history from disk, a missing or broken history is empty"""
+        if not self.history_path or not path.isfile(self.history_path):
+            return
+
+        try:
+            with open(self.history_path, "r", encoding="utf-8") as _f:
+                data = json.load(_f)
+        except ValueError:
+            return
+
+        self.images = data.get("images", {})
+        self.bandwidth = data.get("bandwidth")
+
+    def save(self):
+        """writes history to disk"""
+        if not self.history_path:
+            return
+
+        with self._lock:
+            temp_path = self.history_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as _f:
+                json.dump({"images": self.images, "bandwidth": self.bandwidth}, _f)
+
+            os.replace(temp_path, self.history_path)
+
+    def get(self, name: str) -> dict:
+        """returns usage of an image"""
+        return self.images.get(name, {})
+
+    def record_use(self, name: str):
+        """records that an operation used an image"""
+        with self._lock:
+            usage = self.images.setdefault(name, {})
+            usage["uses"] = usage.get("uses", 0) + 1
+            usage["last_used"] = time.time()
+
+    def record_pull(self, name: str, size: int, seconds: float):
+        """records how fast an image was pulled"""
+        if seconds <= 0 or size <= 0:
+            return
+
+        bandwidth = size / seconds
+        with self._lock:
+            usage = self.images.setdefault(name, {})
+            usage["bandwidth"] = bandwidth
+            if self.bandwidth is None:
+                self.bandwidth = bandwidth
+            else:
+                self.bandwidth += BANDWIDTH_SMOOTHING * (bandwidth - self.bandwidth)
+
+    def forget(self, names: "typing.Iterable[str]"):
+        """drops history of images which no longer exist"""
+        with self._lock:
+            for name in names:
+                self.images.pop(name, None)
+
+    def bandwidth_of(self, name: str) -> float:
+        """returns the expected pull bandwidth of an image in bytes per second"""
+        return self.get(name).get("bandwidth") or self.bandwidth or DEFAULT_BANDWIDTH
+
+class EvictionPolicy(ABC):
+    """Generic eviction policy, images with the lowest score go first"""
+    name = None
+
+    @abstractmethod
+    def score(self, image: Image, usage: UsageHistory) -> "tuple | float":
+        """returns how valuable keeping the image is"""
+
+    def order(self, images: "list[Image]", usage: UsageHistory,
+              pins: "typing.Optional[set[str]]" = None) -> "list[Image]":
+        """returns images in eviction order, pinned images come last"""
+        pins = pins or set()
+        return sorted(images, key=lambda image: (image.name in pins, self.score(image, usage)))
+
+class LargestFirstPolicy(EvictionPolicy):
+    """Evicts the largest images first"""
+    name = "size"
+
+    def score(self, image, usage):
+        return -image.size
+
+class LRUPolicy(EvictionPolicy):
+    """Evicts the least recently used images first"""
+    name = "lru"
+
+    def score(self, image, usage):
+        return usage.get(image.name).get("last_used", 0)
+
+class LFUPolicy(EvictionPolicy):
+    """Evicts the least frequently used images first"""
+    name = "lfu"
+
+    def score(self, image, usage):
+        image_usage = usage.get(image.name)
+        return (image_usage.get("uses", 0), image_usage.get("last_used", 0))
+
+class CostAwarePolicy(EvictionPolicy):
+    """Evicts images which are cheapest to pull again, weighted by how
+        often they are used. re-pull cost = size / measured bandwidth"""
+    name = "cost"
+
+    def score(self, image, usage):
+        repull_seconds = image.size / usage.bandwidth_of(image.name)
+        return (usage.get(image.name).get("uses", 0) + 1) * repull_seconds
+
+POLICIES: "dict[str, type[EvictionPolicy]]" = {
+    policy.name: policy for policy in (LargestFirstPolicy, LRUPolicy, LFUPolicy, CostAwarePolicy)
+}
+
+def get_policy(name: str) -> EvictionPolicy:
+    """returns eviction policy by name"""
+    if name not in POLICIES:
+        raise ValueError(f"Unknown eviction policy: '{name}', \
+                         available policies: '{', '.join(POLICIES)}'")
+
+    return POLICIES[name]()
+
+def plan_eviction(images: "list[Image]", required_free: int, free_space: int,
+                  policy: EvictionPolicy, usage: UsageHistory,
+                  disallowed_deletions: "typing.Optional[list[str]]" = None,
+                  pins: "typing.Optional[set[str]]" = None) -> "list[Image] | None":
+    """picks images to evict so that more than required_free bytes are free.
+        returns None if that is impossible"""
+    disallowed_deletions = disallowed_deletions or []
+    candidates = [image for image in images if image.name not in disallowed_deletions]
+
+    evicted = []
+    for image in policy.order(candidates, usage, pins):
+        if free_space > required_free:
+            break
+
+        evicted.append(image)
+        free_space += image.size
+
+    if free_space <= required_free:
+        return None
+
+    return evicted
@@ -1,29 +1,50 @@
 from __future__ import annotations
 from abc import abstractmethod, ABC
 import os
-import re
-import sys
-from rich.progress import Progress
 import os.path as path
-import tempfile
-import shutil
+import threading
+import time
 from .pretty_copy import copy_with_callback
-from .parsing import format_ocs, parse_output_string
+from .unpacking import unpack, archive_format, supported_formats
+from .parsing import OcsProgressParser, ProgressEvent
 from .rpfile import RPFile, DeployInstruction, PullInstruction, \
     CopyInstruction, UnpackInstruction, FormatInstruction, MkdirInstruction, \
     ShellInstruction
 from .formatting import get_supported_filesystems, format_partition
-from .repositories import ImageRepository
+from .repositories import ImageRepository, ImageVerificationError
 from .volumes import VolumeManager
 from .imaging import deploy_image
-from .constants import COPY_BLOCK_SIZE
+from .planning import plan_storage, StoragePlan
+from .scheduling import OperationScheduler, instruction_resources, CACHE_RESOURCE
+from .metrics import OperationMetrics, RunReport
+from .constants import COPY_BLOCK_SIZE, DEFAULT_MAX_WORKERS, OCS_STATUS_INTERVAL, REPORTS_DIR
 from .pretty import setup as r_setup
-from sh import mount, umount, bash
+from sh import bash
 
 wrapper, print, console, status, logger, progress = r_setup()
 
 class Operation(ABC):
     """Generic Operation Class"""
+    instruction = None
+    # Exclusive operations never run alongside other operations
+    exclusive = False
+    # Set by the executor while the operation runs
+    metrics: "OperationMetrics | None" = None
+
+    @property
+    def resources(self) -> "set[tuple[str, str]]":
+        """returns resources touched by this operation"""
+        return instruction_resources(self.instruction)
+
+    def progress_callback(self, task, metrics: "OperationMetrics | None" = None):
+        """returns a transfer callback updating task and metrics,
+            the operation metrics by default"""
+        metrics = metrics or self.metrics
+        def _callback(copied, copied_total, total):
+            progress.update(task, completed=copied_total, total=total)
+            if metrics:
+                metrics.add_bytes(copied)
+        return _callback
 
     @abstractmethod
     def execute(self):
@@ -46,34 +67,110 @@ class DeployOperation(Operation):
             raise FileNotFoundError(f"Deploy destination '{instruction.volume}' \
                                     unavailable on this system")
 
+        self.executor = executor
         self.image = image
         self.source_volume = source_volume
         self.target_part = destination.target
+        # Set by the executor when this deploy also pulls the image to cache
+        self.pull_through = False
+
+    def _pull(self):
+        """pulls the image to cache alongside the deploy.
+            this is a second read of the repository image, not a tee of the
+            restore: ocs-sr loop-mounts the image and reads the partition files
+            in it by path, it can't be fed a stream. the copy starts right away,
+            only another pull of the same image (the repository's per-image
+            pull lock) holds it back, and it is verified like any other pull"""
+        task = progress.add_task(f"Caching {self.image.name}...")
+        # The cache copy is measured on its own, its bytes aren't deployed bytes
+        metrics = None
+        if self.metrics:
+            metrics = OperationMetrics(self.metrics.index, PullOperation.__name__,
+                                       f"PULL {self.image.name}", self.image.name,
+                                       cache_hit=False, parent=self.metrics.index)
+        error = None
+        try:
+            if metrics:
+                metrics.start()
+            self.executor.image_repo.pull(self.image.name,
+                disallowed_deletions=self.executor.protected_images(),
+                progress_callback=self.progress_callback(task, metrics))
+        except ImageVerificationError as ex:
+            error = ex
+            logger.warning(f"Cached copy of {self.image.name} failed verification, discarding it")
+        except IOError as ex:
+            error = ex
+            logger.warning("Cannot pull image, Insufficient space!")
+        except BaseException as ex:
+            error = ex
+            raise
+        finally:
+            progress.remove_task(task)
+            if metrics and metrics.started is not None:
+                metrics.finish(error)
+                self.executor.report.add(metrics)
 
     def execute(self):
         status.update(f"Deploying {self.image.name} to {self.target_part.path}...")
         if not self.image.best_path:
             raise FileNotFoundError("Image is unavailable")
-        logger.info(f"Using {self.image.best_path}")
+
+        # ocs-sr writes the raw device
+        self.executor.volume_man.release(self.target_part)
+
+        image_path = None
+        puller = None
+        if self.pull_through:
+            # The restore reads the repository copy while the cache copy is
+            # pulled through the image transport, neither waits for the other
+            image_path = self.image.remote_path
+            puller = threading.Thread(target=self._pull, daemon=True)
+            puller.start()
+
+        logger.info(f"Using {image_path or self.image.best_path}")
+        parser = OcsProgressParser()
+        last_update = 0.0
+        # ocs-sr runs in a child process, deployed bytes come from its progress
+        last_event: "ProgressEvent | None" = None
+        restored = 0
+        def handle(events):
+            nonlocal last_update, last_event, restored
+            for event in events:
+                if not isinstance(event, ProgressEvent):
+                    logger.info(event.text)
+                    continue
+
+                if last_event is not None and event.elapsed < last_event.elapsed:
+                    # The next partition restore started
+                    restored += last_event.done_bytes or 0
+                last_event = event
+                if event.finished:
+                    status.update("Cleaning up")
+                elif time.monotonic() - last_update >= OCS_STATUS_INTERVAL:
+                    # partclone redraws far more often than anyone can read
+                    last_update = time.monotonic()
+                    status.update(f"Remaining: {event.remaining}, Rate: {event.rate} GB/Min, Progress: {event.completed}%")
         def _logger(typ: str):
             def choose_output(out):
-                parsed_out = parse_output_string(format_ocs(out))
-                if parsed_out:
-                    if parsed_out[2] == 100:
-                        status.update("Cleaning up")
-                        return None
-                    status.update(f"Remaining: {parsed_out[1]}, Rate: {parsed_out[3]} GB/Min, Progress: {parsed_out[2]}%")
-                else:
-                    logger.info(out)
+                handle(parser.feed(out))
             def hook(*args, **kw):
                 try:
                     {"err": choose_output, 
                     "out": logger.info, 
                     "in": lambda x : x}[typ](*args, **kw)
-                except:
-                    pass
+                except Exception as ex:
+                    logger.warning(f"Failed to handle ocs-sr output: {ex}")
             return hook
-        deploy_image(self.image, self.target_part, self.source_volume, io=_logger)
+        try:
+            deploy_image(self.image, self.target_part, self.source_volume, io=_logger,
+                         image_path=image_path)
+            # The last line may lack a terminator
+            handle(parser.flush())
+        finally:
+            if self.metrics and last_event is not None:
+                self.metrics.add_bytes(restored + (last_event.done_bytes or 0))
+            if puller:
+                puller.join()
 
 
 class PullOperation(Operation):
@@ -86,24 +183,31 @@ class PullOperation(Operation):
 
         self.executor = executor
         self.image_name = image.name
+        # Set by the storage planner when the image can't fit into cache
+        self.skipped = False
 
     def execute(self):
-        status.update(f"Pulling {self.image_name}...")
-        # Get image blacklist
-        blacklist = []
-        for _op in self.executor.executed_operations:
-            if isinstance(_op, PullOperation):
-                blacklist.append(_op.image_name)
+        if self.skipped:
+            logger.warning(f"Skipping pull of {self.image_name}, it does not fit into cache")
+            return
 
+        status.update(f"Pulling {self.image_name}...")
+        blacklist = self.executor.protected_images()
         task = progress.add_task(f"Pulling {self.image_name}...")
 
         try:
-            self.executor.image_repo.pull(self.image_name, disallowed_deletions=blacklist, 
-            progress_callback=lambda copied, copied_total, total: progress.update(task, completed=copied_total, total=total))
+            self.executor.image_repo.pull(self.image_name, disallowed_deletions=blacklist,
+            progress_callback=self.progress_callback(task))
+        except ImageVerificationError:
+            logger.warning(f"Cannot pull image, {self.image_name} failed verification!")
         except IOError:
             logger.warning("Cannot pull image, Insufficient space!")
         progress.remove_task(task)
 
+    @property
+    def resources(self):
+        return super().resources | {CACHE_RESOURCE}
+
 class CopyOperation(Operation):
     """Operation Class for copying a file to device"""
     def __init__(self, executor: RPFileExecutor, instruction: CopyInstruction):
@@ -120,6 +224,7 @@ class CopyOperation(Operation):
             raise FileNotFoundError(f"Copy destination '{instruction.volume}' \
                                     unavailable on this system")
 
+        self.executor = executor
         self.image = image
         self.target_part = destination.target
         self.destination_path = instruction.path
@@ -128,11 +233,7 @@ class CopyOperation(Operation):
         if not self.image.best_path:
             raise FileNotFoundError("Image is unavailable")
 
-        mount_path = tempfile.mkdtemp()
-        logger.info(f"Mounting {self.target_part.path} at {mount_path}")
-        mount(self.target_part.path, mount_path)
-
-        try:
+        with self.executor.volume_man.mounted(self.target_part) as mount_path:
             volume_path = self.destination_path.lstrip('/')
             destination_path = path.join(mount_path, volume_path)
             destination_dir = path.dirname(destination_path)
@@ -147,15 +248,11 @@ class CopyOperation(Operation):
             copy_with_callback(
                 self.image.best_path, 
                 destination_path, 
-                callback=lambda copied, copied_total, total: progress.update(task, completed=copied_total, total=total),
+                callback=self.progress_callback(task),
                 follow_symlinks=False,
                 buffer_size=COPY_BLOCK_SIZE)
 
             progress.remove_task(task)
-        finally:
-            umount(mount_path)
-            os.rmdir(mount_path)
-            logger.info("Unmounted working volume")
 
 class UnpackOperation(Operation):
     """Operation Class for Unzipping archives to device"""
@@ -166,14 +263,9 @@ class UnpackOperation(Operation):
         if not image or (not image.available_local and not image.available_remote):
             raise FileNotFoundError(f"Image '{instruction.image}' unavailable")
 
-        ext = f".{'.'.join(path.basename(image.best_path).split('.')[1:])}"
-        supported_exts = []
-        for _type, exts, _name in shutil.get_unpack_formats():
-            supported_exts.extend(exts)
-
-        if ext not in supported_exts:
-            raise NotImplementedError(f"Image archive format '{ext}' not supported. \
-                                      Supported formats: '{', '.join(supported_exts)}'")
+        if not archive_format(image.name):
+            raise NotImplementedError(f"Image archive format of '{image.name}' not supported. \
+                                      Supported formats: '{', '.join(supported_formats())}'")
 
         if not destination:
             raise NameError(f"Deploy destination '{instruction.volume}' is not defined")
@@ -182,6 +274,7 @@ class UnpackOperation(Operation):
             raise FileNotFoundError(f"Copy destination '{instruction.volume}' \
                                     unavailable on this system")
 
+        self.executor = executor
         self.image = image
         self.target_part = destination.target
         self.destination_path = instruction.path
@@ -190,11 +283,7 @@ class UnpackOperation(Operation):
         if not self.image.best_path:
             raise FileNotFoundError("Image is unavailable")
 
-        mount_path = tempfile.mkdtemp()
-        logger.info(f"Mounting {self.target_part.path} at {mount_path}")
-        mount(self.target_part.path, mount_path)
-
-        try:
+        with self.executor.volume_man.mounted(self.target_part) as mount_path:
             volume_path = self.destination_path.lstrip('/')
             destination_path = path.join(mount_path, volume_path)
             destination_dir = path.dirname(destination_path)
@@ -204,11 +293,21 @@ class UnpackOperation(Operation):
 
             status.update(f"Unpacking {self.image.name} to {destination_path}...")
             logger.info(f"Using {self.image.best_path}")
-            shutil.unpack_archive(self.image.best_path, destination_path)
-        finally:
-            umount(mount_path)
-            os.rmdir(mount_path)
-            logger.info("Unmounted working volume")
+            task = progress.add_task(f"Unpacking {self.image.name}...")
+
+            unpacked = 0
+            def _callback(done, total, files):
+                nonlocal unpacked
+                progress.update(task, completed=done, total=total,
+                                description=f"Unpacking {self.image.name} ({files} files)...")
+                if self.metrics:
+                    self.metrics.add_bytes(done - unpacked)
+                unpacked = done
+
+            try:
+                unpack(self.image.best_path, destination_path, callback=_callback)
+            finally:
+                progress.remove_task(task)
 
 class FormatOperation(Operation):
     """Operation Class for Formatting a partition on device"""
@@ -228,11 +327,14 @@ class FormatOperation(Operation):
             raise FileNotFoundError(f"Copy destination '{instruction.volume}' \
                                     is unavailable on this system")
 
+        self.executor = executor
         self.fstype = fstype
         self.target_part = destination.target
 
     def execute(self):
         status.update(f"Formatting {self.target_part.path} to {self.fstype}...")
+        # mkfs needs the raw device
+        self.executor.volume_man.release(self.target_part)
         format_partition(self.target_part, self.fstype, verbose=True)
 
 class MkdirOperation(Operation):
@@ -247,52 +349,110 @@ class MkdirOperation(Operation):
             raise FileNotFoundError(f"Copy destination '{instruction.volume}' \
                                     unavailable on this system")
 
+        self.executor = executor
         self.target_part = destination.target
         self.destination_path = instruction.path
 
     def execute(self):
-        if not self.image.best_path:
-            raise FileNotFoundError("Image is unavailable")
-
-        mount_path = tempfile.mkdtemp()
-        logger.info(f"Mounting {self.target_part.path} at {mount_path}")
-        mount(self.target_part.path, mount_path)
-
-        try:
+        with self.executor.volume_man.mounted(self.target_part) as mount_path:
             volume_path = self.destination_path.lstrip('/')
             destination_path = path.join(mount_path, volume_path)
 
             status.update(f"Creating directory {self.destination_path}...")
-            os.makedirs(destination_path, parents=True, exist_ok=True)
-        finally:
-            umount(mount_path)
-            os.rmdir(mount_path)
-            logger.info("Unmounted working volume")
+            os.makedirs(destination_path, exist_ok=True)
 
 class ShellOperation(Operation):
+    """Operation Class for running shell commands"""
+    # Commands may touch anything, keep them in RPFile order
+    exclusive = True
+
     def __init__(self, executor: RPFileExecutor, instruction: ShellInstruction):
+        self.executor = executor
         self.command = instruction.command
 
     def execute(self):
+        # Commands may work on the raw devices
+        self.executor.volume_man.release_all()
         bash("-c", self.command, _fg=True)
 
 class RPFileExecutor:
     """RPFile execution class"""
-    def __init__(self, rpfile: RPFile, image_repo: ImageRepository, volume_man: VolumeManager):
+    def __init__(self, rpfile: RPFile, image_repo: ImageRepository, volume_man: VolumeManager,
+                 max_workers=DEFAULT_MAX_WORKERS, pull_through=True, name=None, room=None):
         self.rpfile = rpfile
+        # Recorded in run reports
+        self.name = name
+        self.room = room
+        self.report: "RunReport | None" = None
         self.image_repo = image_repo
         self.volume_man = volume_man
+        self.max_workers = max_workers
         self.operations = None
         self.executed_operations = None
-
-    def compile(self, skip_unsupported=True):
-        """Only God knows what happens here"""
+        self.running_operations = None
+        self.pull_through = pull_through
+        self.plan: "StoragePlan | None" = None
+        self._lock = threading.Lock()
+
+    def protected_images(self) -> "list[str]":
+        """returns images which must not be evicted from cache,
+            runtime evictions keep everything the storage plan protected"""
+        if self.plan:
+            blacklist = list(self.plan.protected)
+        else:
+            blacklist = list(self.rpfile.required_images)
+
+        with self._lock:
+            for _op in self.executed_operations:
+                if isinstance(_op, PullOperation):
+                    blacklist.append(_op.image_name)
+                elif isinstance(_op, DeployOperation) and _op.pull_through:
+                    blacklist.append(_op.image.name)
+
+            # Images used by concurrently running operations can't be evicted either
+            for _op in self.running_operations:
+                if hasattr(_op.instruction, "image"):
+                    blacklist.append(_op.instruction.image)
+
+        return blacklist
+
+    @staticmethod
+    def _plan_pull_through(operations: "list[Operation]") -> "list[Operation]":
+        """merges PULL x followed by DEPLOY x into a single pull-through deploy
+            when x is not cached yet, so the deploy starts without waiting for the pull"""
+        merged = list(operations)
+        for deploy in operations:
+            if not isinstance(deploy, DeployOperation):
+                continue
+
+            image = deploy.image
+            if not image.available_remote or (image.available_local and not image.outdated):
+                continue
+
+            # Find the pull of this image, nothing in between may use it
+            index = merged.index(deploy)
+            for _op in reversed(merged[:index]):
+                if isinstance(_op, PullOperation) and _op.image_name == image.name:
+                    merged.remove(_op)
+                    deploy.pull_through = True
+                    break
+
+                if _op.exclusive or ("image", image.name) in _op.resources:
+                    break
+
+        return merged
+
+    def compile(self, skip_unsupported=True, quiet=False):
+        """Only God knows what happens here.
+            quiet builds without printing, e.g. behind the config picker"""
         operations = []
         instructions = self.rpfile.instructions
 
-        logger.info("Starting build")
+        if not quiet:
+            logger.info("Starting build")
         for i, instruction in enumerate(instructions):
-            print(f"[{i+1}/{len(instructions)}] {instruction}")
+            if not quiet:
+                print(f"[{i+1}/{len(instructions)}] {instruction}")
             try:
                 # YandereDev Coding momentos
                 if isinstance(instruction, DeployInstruction):
@@ -311,35 +471,121 @@ class RPFileExecutor:
                     operation = ShellOperation(self, instruction)
                 else:
                     if skip_unsupported:
-                        logger.warning(f"Skipping unsupported instruction type: {type(instruction)}")
+                        if not quiet:
+                            logger.warning(f"Skipping unsupported instruction type: {type(instruction)}")
                         continue
                     else:
                         raise (f"Unsupported instruction type: {type(instruction)}")
             except Exception as ex:
                 raise RuntimeError("Build failed!") from ex
 
+            operation.instruction = instruction
             operations.append(operation)
 
+        if self.pull_through:
+            operations = self._plan_pull_through(operations)
+
         self.operations = operations
+        self.plan_storage(report=not quiet)
+
+    def plan_storage(self, report=True) -> StoragePlan:
+        """plans cache space for every pull of the compiled RPFile at once,
+            pulls which can't fit are skipped up front"""
+        pulls = {}
+        for _op in self.operations:
+            if isinstance(_op, PullOperation):
+                pulls[_op.image_name] = _op
+            elif isinstance(_op, DeployOperation) and _op.pull_through:
+                pulls[_op.image.name] = _op
+
+        self.plan = plan_storage(self.image_repo, list(pulls), self.rpfile.required_images)
+        if report:
+            self.plan.report(logger)
+        for image in self.plan.skipped:
+            _op = pulls[image.name]
+            if isinstance(_op, PullOperation):
+                _op.skipped = True
+            else:
+                _op.pull_through = False
+
+        return self.plan
+
+    def _measure(self, index: int, _op: Operation) -> OperationMetrics:
+        """returns metrics for an operation about to run"""
+        name = getattr(_op.instruction, "image", None)
+        image = self.image_repo.get(name) if name else None
+        cache_hit = None
+        if image is not None:
+            cached = image.available_local and not image.outdated
+            # Pull-through deploys read the repository
+            cache_hit = cached and not getattr(_op, "pull_through", False)
+
+        return OperationMetrics(index, type(_op).__name__, str(_op.instruction), name, cache_hit)
+
+    def write_report(self):
+        """writes the run report to the cache partition"""
+        try:
+            report_path = self.report.write(path.join(self.image_repo.storage_path, REPORTS_DIR))
+            logger.info(f"Run report written to {report_path}")
+        except OSError as ex:
+            logger.warning(f"Failed to write run report: {ex}")
 
     def execute(self):
-        """Executes RPFile"""
+        """Executes RPFile, operations which don't share
+            any images or volumes are run concurrently"""
         print("Starting execution")
         self.executed_operations = []
+        self.running_operations = []
 
         if not self.operations:
             raise RuntimeError("Executor was not compiled! \
                                Use .compile() to build an operation list.")
 
-        task = progress.add_task("Warming up....", total=len(self.operations))
-        for i, _op in enumerate(self.operations):
-            progress.update(task, completed=len(self.executed_operations), total=len(self.operations), description=f"Executing operation {i+1} of {len(self.operations)}: {type(_op).__name__}")
+        if self.plan:
+            for image in self.plan.evictions:
+                if image.available_local:
+                    self.image_repo.evict(image)
+
+        total = len(self.operations)
+        task = progress.add_task("Warming up....", total=total)
+        self.report = RunReport(self.name, self.room)
+
+        def _execute(i, _op):
+            with self._lock:
+                self.running_operations.append(_op)
+            progress.update(task, description=f"Executing operation {i+1} of {total}: {type(_op).__name__}")
+            _op.metrics = self._measure(i, _op)
+            _op.metrics.start()
             try:
                 _op.execute()
-            except Exception as ex:
-                raise RuntimeError("Execution failed!") from ex
-
-            self.executed_operations.append(_op)
+            except BaseException as ex:
+                _op.metrics.finish(ex)
+                raise
+            else:
+                _op.metrics.finish()
+            finally:
+                self.report.add(_op.metrics)
+                with self._lock:
+                    self.running_operations.remove(_op)
+
+            if hasattr(_op.instruction, "image"):
+                self.image_repo.touch(_op.instruction.image)
+
+            with self._lock:
+                self.executed_operations.append(_op)
+                progress.update(task, completed=len(self.executed_operations), total=total)
+
+        scheduler = OperationScheduler(self.operations, self.max_workers)
+        success = False
+        try:
+            scheduler.run(_execute)
+            success = True
+        except Exception as ex:
+            raise RuntimeError("Execution failed!") from ex
+        finally:
+            self.volume_man.release_all()
+            self.report.finish(success)
+            self.write_report()
 
         print("Done executing RPFile")
         self.executed_operations.clear()
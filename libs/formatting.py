@@ -2,7 +2,7 @@
 import shutil
 import os
 import os.path as path
-from .partitioning import Partition
+from .partitioning import Partition, invalidate_topology
 from sh import Command
 
 FS_EXTRA_PARAMS = {
@@ -58,3 +58,5 @@ def format_partition(part: Partition, _fs: str, verbose=False):
         format_command(params, _fg=True)
     else:
         format_command(params)
+
+    invalidate_topology()
@@ -6,16 +6,20 @@ import tempfile
 from sh import mount, umount, Command
 from .partitioning import Partition
 from .repositories import Image
+from .constants import DEFAULT_OCS_SR
 
-ocs_sr = Command("/usr/sbin/ocs-sr")
+# FAILRP_OCS_SR points deploys at a stand-in, e.g. in test harnesses
+ocs_sr = Command(os.environ.get("FAILRP_OCS_SR") or DEFAULT_OCS_SR)
 
-def mount_image(image: Image) -> str:
-    """Mounts image on system"""
+def mount_image(image: Image, image_path=None) -> str:
+    """Mounts image on system, image_path overrides the best available path"""
     if not image.available_local and not image.available_remote:
         raise FileNotFoundError("Image is not available in any repo")
 
     mount_dir = tempfile.mkdtemp()
-    mount(image.best_path, mount_dir)
+    # Read-only, a writable mount would change the image under its stored hash
+    # and under pulls reading it at the same time
+    mount("-o", "ro", image_path or image.best_path, mount_dir)
     return mount_dir
 
 def unmount_image(mount_path: str):
@@ -30,13 +34,14 @@ def unmount_image(mount_path: str):
 
 
 
-def deploy_image(image: Image, target_partition: Partition, source_part=None, io=None):
+def deploy_image(image: Image, target_partition: Partition, source_part=None, io=None,
+                 image_path=None):
     """deploys image to partition"""
     # Make sure partition is not busy
     if target_partition.mountpoint:
         umount(target_partition.mountpoint)
 
-    mount_path = mount_image(image)
+    mount_path = mount_image(image, image_path)
     parts_file = path.join(mount_path, "parts")
     try:
 
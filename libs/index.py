@@ -0,0 +1,90 @@
+"""Persistent image metadata index stored on the cache partition"""
+import os
+import os.path as path
+import json
+import threading
+import time
+
+INDEX_VERSION = 1
+
+def stat_key(*stats: "os.stat_result | None") -> "list[int]":
+    """returns a key identifying the exact version of one or more files"""
+    key = []
+    for stat in stats:
+        if stat is None:
+            key.extend([0, 0, 0])
+        else:
+            key.extend([stat.st_ino, stat.st_size, stat.st_mtime_ns])
+
+    return key
+
+class ImageIndex:
+    """Caches size and hash of image files keyed by (inode, size, mtime),
+        so unchanged images only need a stat to be revalidated"""
+    def __init__(self, index_path: "str | None"):
+        self.index_path = index_path
+        self.entries: "dict[str, dict]" = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """loads index from disk, a missing or broken index is empty"""
+        self.entries = {}
+        if not self.index_path or not path.isfile(self.index_path):
+            return
+
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as _f:
+                data = json.load(_f)
+        except ValueError:
+            return
+
+        if data.get("version") == INDEX_VERSION:
+            self.entries = data.get("entries", {})
+
+    def save(self):
+        """writes index to disk if anything changed"""
+        if not self.index_path or not self.dirty:
+            return
+
+        with self._lock:
+            temp_path = self.index_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as _f:
+                json.dump({"version": INDEX_VERSION, "entries": self.entries}, _f)
+
+            os.replace(temp_path, self.index_path)
+            self.dirty = False
+
+    def lookup(self, file_path: str, key: "list[int]") -> "dict | None":
+        """returns the entry for file_path if it is still valid for key"""
+        entry = self.entries.get(file_path)
+        if entry is None or entry.get("key") != key:
+            return None
+
+        return entry
+
+    def update(self, file_path: str, key: "list[int]", size: int, __hash: "str | None"):
+        """records size and hash of file_path"""
+        with self._lock:
+            self.entries[file_path] = {
+                "key": key,
+                "size": size,
+                "hash": __hash,
+                "verified": time.time()
+            }
+            self.dirty = True
+
+    def remove(self, file_path: str):
+        """forgets file_path"""
+        with self._lock:
+            if self.entries.pop(file_path, None) is not None:
+                self.dirty = True
+
+    def prune(self, file_paths: "set[str]"):
+        """forgets every file not in file_paths"""
+        with self._lock:
+            for file_path in list(self.entries):
+                if file_path not in file_paths:
+                    del self.entries[file_path]
+                    self.dirty = True
@@ -0,0 +1,158 @@
+"""Per-operation throughput metrics of an RPFile run"""
+import json
+import os
+import os.path as path
+import socket
+import threading
+import time
+import requests
+
+# Counters of this process only, I/O of child processes such as ocs-sr isn't included
+IO_FIELDS = ["rchar", "wchar", "read_bytes", "write_bytes"]
+
+def read_proc_io() -> "dict[str, int]":
+    """returns I/O counters of this process, empty if the kernel has no I/O accounting"""
+    counters = {}
+    try:
+        with open("/proc/self/io", "r", encoding="utf-8") as _f:
+            for line in _f:
+                key, _, value = line.partition(":")
+                if key in IO_FIELDS:
+                    counters[key] = int(value)
+    except (OSError, ValueError):
+        return {}
+
+    return counters
+
+class OperationMetrics:
+    """Measures a single operation"""
+    def __init__(self, index: int, operation: str, instruction: str,
+                 image: "str | None" = None, cache_hit: "bool | None" = None,
+                 parent: "int | None" = None):
+        self.index = index
+        # Index of the operation this is a part of, like the cache copy of a pull-through deploy
+        self.parent = parent
+        self.operation = operation
+        self.instruction = instruction
+        self.image = image
+        self.cache_hit = cache_hit
+        self.started = None
+        self.duration = None
+        self.io: "dict[str, int]" = {}
+        # Bytes reported by progress callbacks
+        self.transferred = 0
+        # Other operations ran at the same time, process I/O counters include theirs
+        self.overlapped = False
+        self.error: "str | None" = None
+        self._io_start: "dict[str, int]" = {}
+        self._clock_start = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """starts measuring"""
+        self.started = time.time()
+        self._clock_start = time.monotonic()
+        self._io_start = read_proc_io()
+
+    def finish(self, error: "BaseException | None" = None):
+        """stops measuring"""
+        self.duration = time.monotonic() - self._clock_start
+        io_end = read_proc_io()
+        self.io = {key: io_end[key] - self._io_start[key]
+                   for key in io_end if key in self._io_start}
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def add_bytes(self, size: int):
+        """records bytes moved by the operation"""
+        with self._lock:
+            self.transferred += size
+
+    @property
+    def throughput(self) -> "float | None":
+        """returns achieved MB/s, from reported bytes or else this process' disk I/O"""
+        if not self.duration:
+            return None
+
+        size = self.transferred or max(self.io.get("read_bytes", 0), self.io.get("write_bytes", 0))
+        return size / 1024**2 / self.duration
+
+    def to_dict(self) -> dict:
+        """returns the metrics as JSON serializable dict"""
+        return {
+            "index": self.index,
+            "parent": self.parent,
+            "operation": self.operation,
+            "instruction": self.instruction,
+            "image": self.image,
+            "cache_hit": self.cache_hit,
+            "started": self.started,
+            "duration": self.duration,
+            "transferred": self.transferred,
+            "io": self.io,
+            "overlapped": self.overlapped,
+            "mb_per_s": self.throughput,
+            "error": self.error
+        }
+
+class RunReport:
+    """Metrics of a whole RPFile run"""
+    def __init__(self, config: "str | None" = None, room: "str | None" = None):
+        self.host = socket.gethostname()
+        self.config = config
+        self.room = room
+        self.started = time.time()
+        self.duration = None
+        self.success = None
+        self.operations: "list[OperationMetrics]" = []
+        self._lock = threading.Lock()
+
+    def add(self, metrics: OperationMetrics):
+        """adds metrics of an operation"""
+        with self._lock:
+            self.operations.append(metrics)
+
+    def finish(self, success: bool):
+        """marks the run as done"""
+        self.duration = time.time() - self.started
+        self.success = success
+        # Mark operations whose process I/O counters overlap, parts of one
+        # operation like a pull-through cache copy share its index and don't count
+        timed = [_op for _op in self.operations if _op.duration is not None]
+        for _op in timed:
+            for other in timed:
+                if other.index == _op.index:
+                    continue
+                if other.started < _op.started + _op.duration and \
+                    _op.started < other.started + other.duration:
+                    _op.overlapped = True
+                    break
+
+    def to_dict(self) -> dict:
+        """returns the report as JSON serializable dict"""
+        return {
+            "host": self.host,
+            "config": self.config,
+            "room": self.room,
+            "started": self.started,
+            "duration": self.duration,
+            "success": self.success,
+            "operations": [_op.to_dict() for _op in sorted(self.operations, key=lambda _op: _op.index)]
+        }
+
+    def write(self, directory: str) -> str:
+        """writes the report into directory, returns its path"""
+        os.makedirs(directory, exist_ok=True)
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        report_path = path.join(directory, f"{name}-{self.host}.json")
+        temp_path = report_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as _f:
+            json.dump(self.to_dict(), _f, indent=2)
+
+        os.replace(temp_path, report_path)
+        return report_path
+
+    def post(self, link: str):
+        """uploads the report to the failrp server"""
+        req = requests.post(f"{link}/reports", json=self.to_dict(), timeout=10)
+        req.raise_for_status()
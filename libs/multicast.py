@@ -0,0 +1,264 @@
+"""UDP multicast distribution of images to a whole room"""
+from __future__ import annotations
+import os
+import socket
+import struct
+import time
+import typing
+from .pretty import setup
+from .transfer import Progress
+from .repositories import PullCancelled
+from .constants import MULTICAST_PAYLOAD, MULTICAST_IDLE_TIMEOUT, MULTICAST_POLL_INTERVAL, \
+    HTTP_CHUNK_SIZE
+
+if typing.TYPE_CHECKING:
+    from .repositories import Image
+
+wrapper, print, console, status, _logger, progress = setup()
+
+# image id (first 16 bytes of the sha256), offset, payload length
+HEADER = struct.Struct("!16sQI")
+# offset of the packet closing a pass, its length field carries the number of passes left
+END_OF_PASS = 2**64 - 1
+# end of pass packets are repeated since any of them may be lost
+END_OF_PASS_REPEATS = 3
+
+def image_id(__hash: str) -> bytes:
+    """returns the id of an image version in multicast packets"""
+    return bytes.fromhex(__hash)[:16]
+
+def repair_reads(ranges: "list[tuple[int, int]]", size: int,
+                 chunk_size=HTTP_CHUNK_SIZE) -> "list[tuple[int, int, int]]":
+    """merges missing (offset, length) ranges into chunk_size aligned reads.
+        returns (offset, length, missing bytes) of every read"""
+    missing = {}
+    for start, length in ranges:
+        end = start + length
+        while start < end:
+            chunk = start // chunk_size
+            boundary = min((chunk + 1) * chunk_size, end)
+            missing[chunk] = missing.get(chunk, 0) + boundary - start
+            start = boundary
+
+    return [(chunk * chunk_size, min(chunk_size, size - chunk * chunk_size), missing_bytes)
+            for chunk, missing_bytes in sorted(missing.items())]
+
+def _multicast_socket(ttl=1, loopback=True, interface=None) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(loopback))
+    if interface:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    return sock
+
+class MulticastSender:
+    """Sends an image to a multicast group, optionally in several passes
+        so clients joining late can fill their gaps from the next pass"""
+    def __init__(self, image_path: str, image_hash: str, group: str, port: int,
+                 rate: "int | None" = None, passes=1, payload=MULTICAST_PAYLOAD,
+                 ttl=1, interface=None):
+        self.image_path = image_path
+        self.id = image_id(image_hash)
+        self.address = (group, port)
+        self.rate = rate
+        self.passes = passes
+        self.payload = payload
+        self.sock = _multicast_socket(ttl, True, interface)
+
+    def send(self, progress_callback=None):
+        """sends every pass of the image"""
+        size = os.stat(self.image_path).st_size
+        with open(self.image_path, "rb", buffering=0) as _f:
+            for i in range(self.passes):
+                self._send_pass(_f, size, self.passes - i - 1, progress_callback)
+
+    def _send_pass(self, _f, size, passes_left, progress_callback=None):
+        started = time.monotonic()
+        offset = 0
+        while offset < size:
+            data = os.pread(_f.fileno(), self.payload, offset)
+            if not data:
+                break
+
+            self.sock.sendto(HEADER.pack(self.id, offset, len(data)) + data, self.address)
+            offset += len(data)
+            if progress_callback:
+                progress_callback(len(data), offset, size)
+
+            if self.rate:
+                # Stay below rate bytes per second
+                ahead = offset / self.rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        for _ in range(END_OF_PASS_REPEATS):
+            self.sock.sendto(HEADER.pack(self.id, END_OF_PASS, passes_left), self.address)
+
+    def close(self):
+        """closes the socket"""
+        self.sock.close()
+
+class MulticastReceiver:
+    """Receives one image version from a multicast group into a file"""
+    def __init__(self, group: str, port: int, image_hash: str, size: int, destination: str,
+                 payload=MULTICAST_PAYLOAD, idle_timeout=MULTICAST_IDLE_TIMEOUT, interface=None):
+        self.id = image_id(image_hash)
+        self.size = size
+        self.destination = destination
+        self.payload = payload
+        self.idle_timeout = idle_timeout
+        self.received = bytearray((size + payload - 1) // payload)
+        self.received_bytes = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        self.sock.bind(("", port))
+        membership = socket.inet_aton(group) + socket.inet_aton(interface or "0.0.0.0")
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.sock.settimeout(min(idle_timeout, MULTICAST_POLL_INTERVAL))
+
+    @property
+    def complete(self):
+        """checks if every packet arrived"""
+        return self.received_bytes >= self.size
+
+    def receive(self, progress_callback=None, cancel=None):
+        """receives until the image is complete, a full pass was observed,
+            the last pass ended, the group goes quiet for idle_timeout seconds
+            or cancel is set"""
+        passes_seen = 0
+        in_pass = False
+        joined_at_start = None
+        state = Progress(progress_callback, self.size, HTTP_CHUNK_SIZE)
+        buffer = bytearray(HEADER.size + self.payload)
+        view = memoryview(buffer)
+        with open(self.destination, "r+b" if os.path.isfile(self.destination) else "wb",
+                  buffering=0) as _f:
+            os.truncate(_f.fileno(), self.size)
+            last_packet = time.monotonic()
+            while not self.complete:
+                if cancel is not None and cancel.is_set():
+                    break
+
+                try:
+                    read = self.sock.recv_into(buffer)
+                except socket.timeout:
+                    if time.monotonic() - last_packet >= self.idle_timeout:
+                        break
+                    continue
+
+                if read < HEADER.size:
+                    continue
+
+                packet_id, offset, length = HEADER.unpack_from(buffer)
+                if packet_id != self.id:
+                    continue
+
+                last_packet = time.monotonic()
+                if offset == END_OF_PASS:
+                    # Only the repeats of one end of pass arrive without data between them
+                    if in_pass:
+                        passes_seen += 1
+                        in_pass = False
+                    # A pass we joined late doesn't count as observed
+                    if passes_seen >= 2 or (passes_seen and joined_at_start) or length == 0:
+                        break
+                    continue
+
+                if joined_at_start is None:
+                    joined_at_start = offset == 0
+                in_pass = True
+
+                index = offset // self.payload
+                if offset % self.payload or index >= len(self.received) or self.received[index]:
+                    continue
+
+                # Every packet but the last carries a full payload, anything else is corrupted
+                if length != min(self.payload, self.size - offset) or read != HEADER.size + length:
+                    continue
+
+                os.pwrite(_f.fileno(), view[HEADER.size:HEADER.size + length], offset)
+                self.received[index] = 1
+                self.received_bytes += length
+                state.update(length)
+
+        state.flush()
+
+    def missing_ranges(self) -> "list[tuple[int, int]]":
+        """returns (offset, length) of every byte range which did not arrive"""
+        ranges = []
+        start = None
+        for index, received in enumerate(self.received):
+            if not received and start is None:
+                start = index
+            elif received and start is not None:
+                ranges.append((start, index))
+                start = None
+
+        if start is not None:
+            ranges.append((start, len(self.received)))
+
+        return [(first * self.payload, min(last * self.payload, self.size) - first * self.payload)
+                for first, last in ranges]
+
+    def close(self):
+        """leaves the group"""
+        self.sock.close()
+
+class MulticastTransport:
+    """Receives images from a multicast session and repairs missing
+        ranges by unicast through another transport"""
+    name = "multicast"
+    # Data arrives out of order, Image.pull writes it with receive()
+    out_of_order = True
+
+    def __init__(self, group: str, port: int, repair, interface=None):
+        self.group = group
+        self.port = port
+        self.repair = repair
+        self.interface = interface
+
+    def open(self, image: Image, offset=0):
+        return self.repair.open(image, offset)
+
+    def read_range(self, image: Image, view: memoryview, offset: int) -> int:
+        return self.repair.read_range(image, view, offset)
+
+    def receive(self, image: Image, destination: str, progress_callback=None, cancel=None) -> bool:
+        """writes image into destination, missing ranges are repaired in chunks.
+            returns False without repairing if no session sends the image"""
+        receiver = MulticastReceiver(self.group, self.port, image.remote_hash, image.repository_size,
+                                     destination, interface=self.interface)
+        try:
+            receiver.receive(progress_callback, cancel)
+        finally:
+            receiver.close()
+
+        if cancel is not None and cancel.is_set():
+            raise PullCancelled(f"Multicast pull of {image.name} cancelled")
+
+        if not receiver.received_bytes:
+            return False
+
+        reads = repair_reads(receiver.missing_ranges(), image.repository_size)
+        if reads:
+            _logger.info(f"Repairing {len(reads)} chunk(s) of {image.name} missed by multicast")
+
+        state = Progress(progress_callback, image.repository_size, HTTP_CHUNK_SIZE)
+        state.copied = receiver.received_bytes
+        view = memoryview(bytearray(HTTP_CHUNK_SIZE))
+        with open(destination, "r+b", buffering=0) as _f:
+            for offset, size, missing in reads:
+                if cancel is not None and cancel.is_set():
+                    raise PullCancelled(f"Multicast repair of {image.name} cancelled")
+
+                read = self.repair.read_range(image, view[:size], offset)
+                if read != size:
+                    raise IOError(f"Repair of {image.name} at {offset} returned {read} of {size} bytes")
+
+                os.pwrite(_f.fileno(), view[:size], offset)
+                state.update(missing)
+
+        state.flush()
+        return True
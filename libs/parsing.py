@@ -1,38 +1,122 @@
+"""Incremental parser for partclone/ocs-sr progress output"""
 from datetime import timedelta
 import re
-# Regular expressions to extract values from the output string
-elapsed_re = re.compile(r"Elapsed: ([\d:]+)")
-remaining_re = re.compile(r"Remaining: ([\d:]+)")
-completed_re = re.compile(r"Completed: +([\d.]+)%")
-rate_re = re.compile(r"([\d.]+)GB/min")
-current_block_re = re.compile(r"current block: +([\d,]+)")
-total_block_re = re.compile(r"total block: +([\d,]+)")
-complete_block_re = re.compile(r"Complete: +([\d.]+)%")
+
+# One pattern for both progress lines partclone redraws:
+#   Elapsed: 00:01:02, Remaining: 00:10:00, Completed:  9.37%,  2.50GB/min,
+#   current block:  123,456, total block:  1,234,567, Complete:  10.00%
+# Cursor movement escapes around them are skipped by searching
+progress_re = re.compile(
+    r"Elapsed:\s*(?P<elapsed>\d+:\d{2}:\d{2}),\s*"
+    r"Remaining:\s*(?P<remaining>\d+:\d{2}:\d{2}),\s*"
+    r"Completed:\s*(?P<completed>[\d.]+)%"
+    r"(?:,\s*(?:Rate:\s*)?(?P<rate>[\d.]+)\s*(?P<rate_unit>[GM])B/min)?"
+    r"|current block:\s*(?P<current_block>[\d,]+),\s*"
+    r"total block:\s*(?P<total_block>[\d,]+),\s*"
+    r"Complete:\s*(?P<complete_block>[\d.]+)%")
+# partclone prints the filesystem block size before restoring
+block_size_re = re.compile(r"Block size:\s*(?P<block_size>\d+)\s*Byte")
 ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+line_break = re.compile(r"[\r\n]")
+
+def parse_duration(value: str) -> timedelta:
+    """parses hh:mm:ss"""
+    hours, minutes, seconds = value.split(":")
+    return timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds))
+
+class ProgressEvent:
+    """Latest restore progress, block fields stay None until partclone reports them"""
+    def __init__(self, elapsed: timedelta, remaining: timedelta, completed: float,
+                 rate: "float | None", current_block: "int | None" = None,
+                 total_block: "int | None" = None, complete_block: "float | None" = None,
+                 block_size: "int | None" = None):
+        self.elapsed = elapsed
+        self.remaining = remaining
+        self.completed = completed
+        # GB/min
+        self.rate = rate
+        self.current_block = current_block
+        self.total_block = total_block
+        self.complete_block = complete_block
+        self.block_size = block_size
+
+    @property
+    def done_bytes(self) -> "int | None":
+        """returns restored bytes, from the block count if the block size
+            is known, else estimated from the average rate"""
+        if self.current_block is not None and self.block_size:
+            return self.current_block * self.block_size
+
+        if self.rate is not None:
+            return int(self.rate * 1024**3 * self.elapsed.total_seconds() / 60)
+
+        return None
+
+    @property
+    def finished(self):
+        """checks if the restore reached 100%"""
+        return self.completed >= 100
+
+class OutputEvent:
+    """A line of output which is not progress"""
+    def __init__(self, text: str):
+        self.text = text
+
+class OcsProgressParser:
+    """Turns chunks of ocs-sr output into events.
+        Chunks may end mid line, lines may end with \\r or \\n"""
+    def __init__(self):
+        self.buffer = ""
+        self.last: "ProgressEvent | None" = None
+        self.block_size: "int | None" = None
+
+    def feed(self, chunk: str) -> "list[ProgressEvent | OutputEvent]":
+        """parses a chunk, returns events of every line it completed"""
+        lines = line_break.split(self.buffer + chunk)
+        self.buffer = lines.pop()
+        events = []
+        for line in lines:
+            event = self._parse(line)
+            if event is not None:
+                events.append(event)
+
+        return events
+
+    def flush(self) -> "list[ProgressEvent | OutputEvent]":
+        """parses whatever is left after the stream ended"""
+        return self.feed("\n")
+
+    def _parse(self, line: str) -> "ProgressEvent | OutputEvent | None":
+        match = progress_re.search(line)
+        if match is None:
+            text = ansi_escape.sub("", line).strip()
+            block_size = block_size_re.search(text)
+            if block_size:
+                self.block_size = int(block_size["block_size"])
+            return OutputEvent(text) if text else None
+
+        last = self.last
+        if match["elapsed"] is not None:
+            rate = None
+            if match["rate"] is not None:
+                rate = float(match["rate"]) / (1024 if match["rate_unit"] == "M" else 1)
+
+            event = ProgressEvent(parse_duration(match["elapsed"]),
+                                  parse_duration(match["remaining"]),
+                                  float(match["completed"]), rate)
+            if last is not None:
+                event.current_block = last.current_block
+                event.total_block = last.total_block
+                event.complete_block = last.complete_block
+        elif last is not None:
+            event = ProgressEvent(last.elapsed, last.remaining, last.completed, last.rate,
+                                  int(match["current_block"].replace(",", "")),
+                                  int(match["total_block"].replace(",", "")),
+                                  float(match["complete_block"]))
+        else:
+            # Block counts before any time line, nothing to report yet
+            return None
 
-def format_ocs(x):
-    return ansi_escape.sub("", x).strip().replace(r"\s\s+", " ").replace('\r', '').replace('\n', "n")
-
-def parse_output_string(output_str):
-
-    # Check if the output string matches the expected format
-    if not all(re.search(regex, output_str) for regex in [completed_re]):
-        return False
-
-    # Extract values from the output string using regular expressions
-    try:
-        elapsed = elapsed_re.search(output_str).group(1)
-        remaining = remaining_re.search(output_str).group(1)
-        completed = float(completed_re.search(output_str).group(1))
-        rate = float(rate_re.search(output_str).group(1))
-        current_block = int(current_block_re.search(output_str).group(1).replace(",", ""))
-        total_block = int(total_block_re.search(output_str).group(1).replace(",", ""))
-        complete_block = float(complete_block_re.search(output_str).group(1))
-
-        # Convert elapsed and remaining time strings to timedelta objects for easier manipulation
-        elapsed_td = timedelta(hours=int(elapsed[:2]), minutes=int(elapsed[3:5]), seconds=int(elapsed[6:]))
-        remaining_td = timedelta(hours=int(remaining[:2]), minutes=int(remaining[3:5]), seconds=int(remaining[6:]))
-    except: 
-        return False
-    # Return a list of extracted values
-    return [elapsed_td, remaining_td, completed, rate, current_block, total_block, complete_block]
\ No newline at end of file
+        event.block_size = self.block_size
+        self.last = event
+        return event
@@ -1,10 +1,12 @@
 """Utility Classes for partitioning on linux"""
 from __future__ import annotations
+import os
 import os.path as path
 import typing
 import json
 import re
-from .constants import LSBLK_DEFAULT_COLUMNS
+import threading
+from .constants import LSBLK_DEFAULT_COLUMNS, DEFAULT_BLOCK_BACKEND
 from sh import e2label, lsblk, mount, umount, mkdir, udevadm
 
 lsblk_unk_column = re.compile(r"lsblk: unknown column: (?P<column>.*)")
@@ -50,6 +52,236 @@ class LsblkHelper:
 
         return output["blockdevices"]
 
+# udev escapes unsafe characters of encoded properties as \xNN
+udev_escape = re.compile(r"\\x(?P<code>[0-9a-fA-F]{2})")
+# /proc/mounts escapes whitespace as octal
+mounts_escape = re.compile(r"\\(?P<code>[0-7]{3})")
+
+class SysfsHelper:
+    """Reads the block device tree from sysfs and the udev database,
+        returns the same structure as LsblkHelper.call without
+        starting any process. root allows reading a fake tree"""
+    def __init__(self, root="/"):
+        self.root = root
+        self.block_dir = path.join(root, "sys/class/block")
+        self.udev_dir = path.join(root, "run/udev/data")
+
+    @property
+    def available(self) -> bool:
+        """checks if sysfs and the udev database can be read"""
+        return path.isdir(self.block_dir) and path.isdir(self.udev_dir)
+
+    def _read(self, name: str, attribute: str) -> "str | None":
+        try:
+            with open(path.join(self.block_dir, name, attribute), "r", encoding="utf-8") as _f:
+                return _f.read().strip()
+        except OSError:
+            return None
+
+    def _udev_properties(self, name: str) -> "dict[str, str] | None":
+        """returns udev properties of a device, None if udev doesn't know it"""
+        dev = self._read(name, "dev")
+        if not dev:
+            return None
+
+        properties = {}
+        try:
+            with open(path.join(self.udev_dir, f"b{dev}"), "r", encoding="utf-8") as _f:
+                for line in _f:
+                    if line.startswith("E:") and "=" in line:
+                        key, value = line[2:].rstrip("\n").split("=", 1)
+                        properties[key] = value
+        except OSError:
+            return None
+
+        return properties
+
+    @staticmethod
+    def _property(properties: "dict[str, str]", key: str) -> "str | None":
+        if f"{key}_ENC" in properties:
+            return udev_escape.sub(lambda match: chr(int(match["code"], 16)),
+                                   properties[f"{key}_ENC"])
+        return properties.get(key) or None
+
+    def _mountpoints(self) -> "dict[str, str]":
+        mountpoints = {}
+        try:
+            with open(path.join(self.root, "proc/mounts"), "r", encoding="utf-8") as _f:
+                for line in _f:
+                    fields = line.split()
+                    if len(fields) > 1 and fields[0].startswith("/dev/"):
+                        mountpoints.setdefault(fields[0], mounts_escape.sub(
+                            lambda match: chr(int(match["code"], 8)), fields[1]))
+        except OSError:
+            pass
+
+        return mountpoints
+
+    def _device(self, name: str, _type: str, removable: bool,
+                mountpoints: "dict[str, str]") -> "dict[str, typing.Any]":
+        properties = self._udev_properties(name)
+        if properties is None:
+            raise LookupError(f"udev has no data for {name}")
+
+        _path = f"/dev/{name}"
+        partn = self._read(name, "partition")
+        return {
+            "path": _path,
+            "type": _type,
+            "size": int(self._read(name, "size") or 0) * 512,
+            "rm": removable,
+            "partuuid": self._property(properties, "ID_PART_ENTRY_UUID"),
+            "uuid": self._property(properties, "ID_FS_UUID"),
+            "fstype": self._property(properties, "ID_FS_TYPE"),
+            "partlabel": self._property(properties, "ID_PART_ENTRY_NAME"),
+            "label": self._property(properties, "ID_FS_LABEL"),
+            "mountpoint": mountpoints.get(_path),
+            "partn": int(partn) if partn else None
+        }
+
+    def _type_of(self, name: str) -> str:
+        if name.startswith("md"):
+            # lsblk names arrays by their level, e.g. raid1
+            return self._read(name, "md/level") or "raid"
+
+        for prefix, _type in (("loop", "loop"), ("dm-", "dm"), ("sr", "rom"),
+                              ("ram", "ram"), ("zram", "ram"), ("nbd", "nbd")):
+            if name.startswith(prefix):
+                return _type
+        return "disk"
+
+    def call(self) -> "list[dict[str, typing.Any]]":
+        """returns the block device tree.
+            raises LookupError if udev doesn't know a device yet"""
+        mountpoints = self._mountpoints()
+        devices = []
+        for name in sorted(os.listdir(self.block_dir)):
+            if self._read(name, "partition"):
+                # Listed below their disk
+                continue
+
+            removable = self._read(name, "removable") == "1"
+            device = self._device(name, self._type_of(name), removable, mountpoints)
+            device["children"] = [
+                self._device(child, "part", removable, mountpoints)
+                for child in sorted(os.listdir(path.join(self.block_dir, name)))
+                if path.isfile(path.join(self.block_dir, name, child, "partition"))
+            ]
+            devices.append(device)
+
+        return devices
+
+BLOCK_BACKENDS = ["auto", "sysfs", "lsblk"]
+
+_backend = DEFAULT_BLOCK_BACKEND
+_sysfs_root = "/"
+# Device types treated as disks
+_disk_types = {"disk"}
+
+def set_block_backend(name: str, root="/"):
+    """selects how block devices are read: sysfs, lsblk or auto
+        (sysfs, falling back to lsblk when sysfs or udev data is missing)"""
+    global _backend, _sysfs_root
+    if name not in BLOCK_BACKENDS:
+        raise ValueError(f"Unknown block device backend: '{name}'")
+
+    _backend = name
+    _sysfs_root = root
+    invalidate_topology()
+
+def set_disk_types(types: "typing.Iterable[str]"):
+    """selects which device types count as disks, e.g. loop for test harnesses"""
+    global _disk_types
+    _disk_types = set(types)
+    invalidate_topology()
+
+def read_block_devices() -> "list[dict[str, typing.Any]]":
+    """returns the block device tree from the selected backend"""
+    if _backend != "lsblk":
+        sysfs = SysfsHelper(_sysfs_root)
+        if _backend == "sysfs":
+            return sysfs.call()
+
+        if sysfs.available:
+            try:
+                return sysfs.call()
+            except (OSError, LookupError, ValueError):
+                pass
+
+    return LsblkHelper.call(list(LSBLK_DEFAULT_COLUMNS))
+
+def _walk_partitions(device: "dict[str, typing.Any]") -> "list[dict[str, typing.Any]]":
+    """returns all partitions below a device of the lsblk tree"""
+    parts = []
+    for child in device.get("children") or []:
+        if child["type"] == "part":
+            parts.append(child)
+        parts.extend(_walk_partitions(child))
+
+    return parts
+
+def _partition_number(_path: str) -> "int | None":
+    """reads the partition number of a device from sysfs"""
+    try:
+        with open(f"/sys/class/block/{path.basename(_path)}/partition", "r", encoding="utf-8") as _f:
+            return int(_f.read())
+    except (OSError, ValueError):
+        return None
+
+class Topology:
+    """Snapshot of disks and partitions built from a single read of the block device tree"""
+    def __init__(self, devices: "list[dict[str, typing.Any]]"):
+        self.disks: "dict[str, Disk]" = {}
+        self.partitions: "dict[str, Partition]" = {}
+        self._parents: "dict[str, Disk]" = {}
+
+        for device in devices:
+            if device["type"] not in _disk_types:
+                continue
+
+            disk = Disk.from_object(device)
+            self.disks[disk.path] = disk
+            for part in disk.partitions:
+                self.partitions[part.path] = part
+                self._parents[part.path] = disk
+
+    @classmethod
+    def load(cls) -> Topology:
+        """reads the current block device tree"""
+        return cls(read_block_devices())
+
+    def disk_of(self, part_path: str) -> "Disk | None":
+        """returns the disk owning a partition"""
+        return self._parents.get(part_path)
+
+    def partition(self, disk_path: str, number: int) -> "Partition | None":
+        """returns partition number of a disk"""
+        disk = self.disks.get(disk_path)
+        if disk is None:
+            return None
+
+        for part in disk.partitions:
+            if part.number == number:
+                return part
+
+        return None
+
+_topology: "Topology | None" = None
+_topology_lock = threading.Lock()
+
+def get_topology(refresh=False) -> Topology:
+    """returns the block device snapshot, taking it if there is none"""
+    global _topology
+    with _topology_lock:
+        if _topology is None or refresh:
+            _topology = Topology.load()
+        return _topology
+
+def invalidate_topology():
+    """drops the snapshot, call after anything that changes partitions or filesystems"""
+    global _topology
+    with _topology_lock:
+        _topology = None
 
 class Disk:
     """Disk management utility class"""
@@ -62,47 +294,23 @@ class Disk:
     @staticmethod
     def from_partition(_part: Partition) -> Disk:
         """returns the disk owning the given partition"""
-        disks = Disk.get_all().values()
-
-        for disk in disks:
-            for part in disk.partitions:
-                if _part.path != part.path:
-                    return disk
+        disk = get_topology().disk_of(_part.path)
+        if disk is None:
+            raise FileNotFoundError("Could not find any disk with the given partition")
 
-        raise FileNotFoundError("Could not find any disk with the given partition")
+        return disk
 
     @staticmethod
     def from_device(_path) -> Disk:
         """creates disk object from drive path"""
-        disk = None
-        devices = LsblkHelper.call(LSBLK_DEFAULT_COLUMNS, _path)
-        parts = []
+        topology = get_topology()
+        if _path in topology.disks:
+            return topology.disks[_path]
 
-        # Find disk
-        for device in devices:
-            if device["path"] != _path:
-                continue
-
-            if device["type"] != "disk":
-                raise ValueError(f"Not a disk: {_path}")
-
-            disk = device
+        if _path in topology.partitions:
+            raise ValueError(f"Not a disk: {_path}")
 
-        if disk is None:
-            raise FileNotFoundError("Could not find device info")
-
-        # Find children
-        for device in devices:
-            if not device["path"].startswith(disk["path"]):
-                continue
-
-            if device["type"] != "part":
-                continue
-
-            parts.append(device)
-
-        disk["children"] = parts
-        return Disk.from_object(devices)
+        raise FileNotFoundError("Could not find device info")
 
     @staticmethod
     def from_object(device: dict[str, str]) -> Disk:
@@ -112,7 +320,7 @@ class Disk:
         removable = device["rm"]
         parts = []
 
-        for part in device["children"]:
+        for part in _walk_partitions(device):
             parts.append(Partition.from_object(part))
 
         return Disk(_path, size, removable, parts)
@@ -120,31 +328,12 @@ class Disk:
     @staticmethod
     def get_all() -> dict[str, Disk]:
         """returns all Drives"""
-        disks = {}
-        devices = LsblkHelper.call(LSBLK_DEFAULT_COLUMNS)
-        for disk in devices:
-            if disk["type"] != "disk":
-                continue
-
-            parts = []
-            for part in devices:
-                if not part["path"].startswith(disk["path"]):
-                    continue
-
-                if part["type"] != "part":
-                    continue
-
-                parts.append(part)
-
-            disk["children"] = parts
-            disks[disk["path"]] = Disk.from_object(disk)
-
-        return disks
+        return dict(get_topology().disks)
 
 class Partition:
     """Partition utility class"""
     def __init__(self, _path, size, removable,
-                  partuuid, fsuuid, fstype, partlabel, fslabel, mountpoint):
+                  partuuid, fsuuid, fstype, partlabel, fslabel, mountpoint, number=None):
         self.path: str = _path
         self.size: int = size
         self.removable: bool = removable
@@ -154,18 +343,16 @@ class Partition:
         self.partlabel: str = partlabel
         self.fslabel: str = fslabel
         self.mountpoint: str = mountpoint
+        self.number: "int | None" = number
     @classmethod
     def from_device(cls, _path: str) -> Partition:
         """create partition from systems partition path"""
-        devices = LsblkHelper.call(LSBLK_DEFAULT_COLUMNS, _path)
-        for device in devices:
-            if device["path"] != _path:
-                continue
-
-            if device["type"] != "part":
-                raise ValueError(f"Not a partition: {_path}")
+        topology = get_topology()
+        if _path in topology.partitions:
+            return topology.partitions[_path]
 
-            return cls.from_object(device)
+        if _path in topology.disks:
+            raise ValueError(f"Not a partition: {_path}")
 
         raise FileNotFoundError("Could not find device info")
 
@@ -181,21 +368,14 @@ class Partition:
         partlabel = device["partlabel"]
         fslabel = device["label"]
         mountpoint = device["mountpoint"]
+        number = device.get("partn") or _partition_number(_path)
         return cls(_path, size, removable, partuuid, fsuuid, fstype,
-                         partlabel, fslabel, mountpoint)
+                         partlabel, fslabel, mountpoint, number)
 
     @staticmethod
     def get_all() -> dict[str, Partition]:
         """returns all available partitions"""
-        partitions = {}
-        devices = LsblkHelper.call(LSBLK_DEFAULT_COLUMNS)
-        for device in devices:
-            if device["type"] != "part":
-                continue
-
-            partitions[device["path"]] = Partition.from_object(device)
-
-        return partitions
+        return dict(get_topology().partitions)
 
     def set_fslabel(self, label: str):
         """sets label on partition"""
@@ -204,6 +384,8 @@ class Partition:
 
         e2label(self.path, label)
         udevadm("trigger")
+        udevadm("settle")
+        invalidate_topology()
 
     def mount(self, mountpoint: str, create_mountpoint=True):
         """mount partition to system"""
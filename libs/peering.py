@@ -0,0 +1,239 @@
+"""Peer-to-peer sharing of cached images between clients"""
+from __future__ import annotations
+import hashlib
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import quote, unquote
+import requests
+from .repositories import ImageRepository, Image, read_chunk_manifest
+from .transports import HttpTransport, FileTransport, RangedReader
+from .constants import PEER_ANNOUNCE_INTERVAL, HTTP_CHUNK_SIZE
+from .pretty import setup
+
+wrapper, print, console, status, _logger, progress = setup()
+
+range_re = re.compile(r"bytes=(?P<start>\d+)-(?P<end>\d*)")
+
+def shared_images(image_repo: ImageRepository) -> "dict[str, str]":
+    """returns cached images which can be served to peers with their hashes"""
+    images = {}
+    for image in image_repo.get_locals():
+        if image.hash_pending or not image.local_hash:
+            continue
+
+        images[image.name] = image.local_hash
+
+    return images
+
+class PeerRegistry:
+    """Client of the peer registry hosted by the failrp server"""
+    def __init__(self, link: str, port: int):
+        self.link = link
+        self.port = port
+        self.session = requests.Session()
+
+    def announce(self, images: "dict[str, str]"):
+        """tells the server which images this client can serve"""
+        self.session.post(f"{self.link}/peers/", timeout=10,
+                          json={"port": self.port, "images": images})
+
+    def find(self, name: str, __hash: str) -> "list[str]":
+        """returns links of peers serving the given image version"""
+        try:
+            req = self.session.get(f"{self.link}/peers/{quote(name)}", timeout=10,
+                                   params={"hash": __hash, "port": self.port})
+            req.raise_for_status()
+            return req.json()
+        except (requests.RequestException, ValueError) as ex:
+            _logger.warning(f"Peer lookup for {name} failed: {ex}")
+            return []
+
+class _PeerRequestHandler(BaseHTTPRequestHandler):
+    """Serves verified cached images with Range support"""
+    image_repo: ImageRepository = None
+
+    def do_GET(self):
+        match = re.fullmatch(r"/images/(?P<name>[^/]+)", self.path)
+        image = self.image_repo.get(unquote(match["name"])) if match else None
+        if image is None or image.name not in shared_images(self.image_repo):
+            self.send_error(404)
+            return
+
+        size = image.size
+        start, end = 0, size - 1
+        range_match = range_re.fullmatch(self.headers.get("Range", ""))
+        if range_match:
+            start = int(range_match["start"])
+            if range_match["end"]:
+                end = min(int(range_match["end"]), size - 1)
+
+        if start > end:
+            self.send_error(416)
+            return
+
+        self.send_response(206 if range_match else 200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("X-Image-Hash", image.local_hash)
+        self.end_headers()
+
+        with open(image.local_path, "rb") as _f:
+            self.connection.sendfile(_f, start, end - start + 1)
+
+    def log_message(self, format, *args):
+        _logger.debug(f"Peer request from {self.address_string()}: {format % args}")
+
+class PeerServer:
+    """Serves this client's cache to other clients and keeps the
+        server's peer registry up to date"""
+    def __init__(self, image_repo: ImageRepository, registry: PeerRegistry, port: int):
+        handler = type("PeerRequestHandler", (_PeerRequestHandler,), {"image_repo": image_repo})
+        self.image_repo = image_repo
+        self.registry = registry
+        self.httpd = ThreadingHTTPServer(("", port), handler)
+        self.httpd.daemon_threads = True
+        self._stopped = threading.Event()
+
+    def start(self):
+        """starts serving in background"""
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        threading.Thread(target=self._announce_loop, daemon=True).start()
+
+    def announce(self):
+        """announces cached images to the registry"""
+        try:
+            self.registry.announce(shared_images(self.image_repo))
+        except requests.RequestException as ex:
+            _logger.warning(f"Peer announce failed: {ex}")
+
+    def _announce_loop(self):
+        while not self._stopped.is_set():
+            self.announce()
+            self._stopped.wait(PEER_ANNOUNCE_INTERVAL)
+
+    def stop(self):
+        """stops serving"""
+        self._stopped.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class PeerSource:
+    """Peers serving one image version, shared by every thread fetching its chunks.
+        Peers which fail or send corrupted chunks are skipped from then on"""
+    def __init__(self, peers: "list[str]", size: int, chunk_size: int, chunks: "list[str] | None"):
+        self.peers = list(peers)
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunks = chunks
+        self.bad: "set[str]" = set()
+        self._lock = threading.Lock()
+
+    def candidates(self, offset: int) -> "list[str]":
+        """returns healthy peers in the order to try them, chunks are spread over peers"""
+        with self._lock:
+            healthy = [peer for peer in self.peers if peer not in self.bad]
+
+        if not healthy:
+            return []
+
+        start = offset // self.chunk_size % len(healthy)
+        return healthy[start:] + healthy[:start]
+
+    def drop(self, peer: str):
+        """stops using a peer"""
+        with self._lock:
+            self.bad.add(peer)
+
+    def verify(self, data: bytes, offset: int) -> bool:
+        """checks every whole chunk within data against the chunk manifest"""
+        if not self.chunks:
+            return True
+
+        for index in range(-(-offset // self.chunk_size), len(self.chunks)):
+            start = index * self.chunk_size - offset
+            end = start + min(self.chunk_size, self.size - index * self.chunk_size)
+            if end > len(data):
+                break
+
+            if hashlib.sha256(data[start:end]).hexdigest() != self.chunks[index]:
+                return False
+
+        return True
+
+class PeerTransport(HttpTransport):
+    """Reads images from peers that have them cached, falling back to
+        the central repository. Chunks are checked against the repository
+        chunk manifest, the whole image against the repository hash"""
+    name = "peer"
+
+    def __init__(self, link: str, registry: PeerRegistry, fallback=None, **kwargs):
+        super().__init__(link, **kwargs)
+        self.registry = registry
+        self.fallback = fallback or FileTransport()
+        # Peer lookups are reused until the next announce round
+        self._sources: "dict[tuple[str, str], tuple[PeerSource | None, float]]" = {}
+        self._sources_lock = threading.Lock()
+
+    def source(self, image: Image) -> "PeerSource | None":
+        """returns the peers serving image, None if no peer has it"""
+        key = (image.name, image.remote_hash)
+        with self._sources_lock:
+            source, found = self._sources.get(key, (None, 0.0))
+            if time.monotonic() - found < PEER_ANNOUNCE_INTERVAL:
+                return source
+
+            peers = self.registry.find(image.name, image.remote_hash)
+            source = None
+            if peers:
+                manifest = read_chunk_manifest(image.remote_path)
+                source = PeerSource(peers, image.repository_size,
+                                    manifest[0] if manifest else HTTP_CHUNK_SIZE,
+                                    manifest[1] if manifest else None)
+
+            self._sources[key] = (source, time.monotonic())
+            return source
+
+    def _fetch(self, image: Image, source: "PeerSource | None", offset: int, length: int) -> bytes:
+        """downloads length bytes at offset from a peer, or the fallback if every peer fails"""
+        for peer in source.candidates(offset) if source else []:
+            try:
+                data = self.fetch(f"{peer}/images/{quote(image.name)}", offset, length, retries=0)
+            except IOError:
+                _logger.warning(f"Peer {peer} failed, skipping it")
+                source.drop(peer)
+                continue
+
+            if not source.verify(data, offset):
+                _logger.warning(f"Peer {peer} sent a corrupted chunk, skipping it")
+                source.drop(peer)
+                continue
+
+            return data
+
+        buffer = bytearray(length)
+        read = self.fallback.read_range(image, memoryview(buffer), offset)
+        return bytes(buffer[:read])
+
+    def open(self, image: Image, offset=0):
+        source = self.source(image)
+        if source is None:
+            return self.fallback.open(image, offset)
+
+        _logger.info(f"Pulling {image.name} from {len(source.peers)} peer(s)")
+        return RangedReader(lambda chunk_offset, length: self._fetch(image, source, chunk_offset, length),
+                            offset, image.repository_size, source.chunk_size, self.connections)
+
+    def read_range(self, image: Image, view: memoryview, offset: int) -> int:
+        length = min(len(view), image.repository_size - offset)
+        if length <= 0:
+            return 0
+
+        source = self.source(image)
+        if source is None:
+            return self.fallback.read_range(image, view, offset)
+
+        data = self._fetch(image, source, offset, length)
+        view[:len(data)] = data
+        return len(data)
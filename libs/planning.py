@@ -0,0 +1,95 @@
+"""Whole-RPFile cache space planning"""
+from __future__ import annotations
+import os.path as path
+import typing
+from .constants import PART_SIG
+from .eviction import plan_eviction
+
+if typing.TYPE_CHECKING:
+    from .repositories import Image, ImageRepository
+
+def _gib(size):
+    return f"{size / 1024**3:.2f} GiB"
+
+class StoragePlan:
+    """Decides once which images a run pulls into cache and what gets evicted for them"""
+    def __init__(self, pulls: "list[Image]", skipped: "list[Image]",
+                 evictions: "list[Image]", required: int, free_space: int,
+                 protected: "typing.Optional[set[str]]" = None):
+        self.pulls = pulls
+        self.skipped = skipped
+        self.evictions = evictions
+        self.required = required
+        self.free_space = free_space
+        # Names of images the plan never evicts
+        self.protected = protected or set()
+
+    @property
+    def fits(self):
+        """checks if every pull of the run fits into cache"""
+        return not self.skipped
+
+    def report(self, logger):
+        """logs the plan"""
+        logger.info(f"Storage plan: {len(self.pulls)} pull(s) need {_gib(self.required)}, "
+                    f"{_gib(self.free_space)} free")
+        for image in self.evictions:
+            logger.info(f"Storage plan: evicting {image.name} ({_gib(image.size)})")
+
+        for image in self.skipped:
+            logger.warning(f"Storage plan: {image.name} does not fit into cache, \
+                           it will be used from the repository")
+
+def pull_cost(image_repo: ImageRepository, image: Image) -> int:
+    """returns the cache space a pull of image still needs"""
+    if not image.available_remote or (image.available_local and not image.outdated):
+        return 0
+
+    size = image.remote_size if image.remote_size is not None else path.getsize(image.remote_path)
+    part_path = path.join(image_repo.storage_path, image.name) + PART_SIG
+    if path.isfile(part_path):
+        size = max(size - path.getsize(part_path), 0)
+
+    return size
+
+def plan_storage(image_repo: ImageRepository, pulled: "list[str]",
+                 protected: "typing.Optional[list[str]]" = None) -> StoragePlan:
+    """plans cache space for pulling the given images in order.
+        protected images (e.g. everything the run uses) are never evicted,
+        pulls which can't fit even after evicting everything else are skipped"""
+    protected = set(protected or []) | set(pulled)
+    free_space = image_repo.free_storage
+    pulls: "list[tuple[Image, int]]" = []
+
+    for name in dict.fromkeys(pulled):
+        image = image_repo.get(name)
+        if image is None:
+            continue
+
+        cost = pull_cost(image_repo, image)
+        if cost == 0:
+            continue
+
+        if image.available_local:
+            # Outdated copies are replaced, their space comes back
+            free_space += image.size
+
+        pulls.append((image, cost))
+
+    candidates = [image for image in image_repo.get_locals() if image.name not in protected]
+    reclaimable = free_space + sum([image.size for image in candidates])
+
+    accepted, skipped, required = [], [], 0
+    for image, cost in pulls:
+        if required + cost < reclaimable:
+            accepted.append(image)
+            required += cost
+        else:
+            skipped.append(image)
+
+    evictions = []
+    if free_space <= required:
+        evictions = plan_eviction(candidates, required, free_space, image_repo.policy,
+                                  image_repo.usage, pins=image_repo.pins) or []
+
+    return StoragePlan(accepted, skipped, evictions, required, free_space, protected)
@@ -0,0 +1,114 @@
+"""Speculative pulls while the user picks a config"""
+from __future__ import annotations
+import logging
+import os.path as path
+import threading
+from .execution import RPFileExecutor
+from .repositories import PullCancelled, remove_partial
+from .rpfile import RPFile
+from .constants import PART_SIG
+from .pretty import setup
+
+wrapper, print, console, status, logger, progress = setup()
+
+class _HeldLogs(logging.Filter):
+    """Holds back records logged outside the main thread, the prefetch
+        and the transfer threads it starts, while the picker is on screen"""
+    def __init__(self):
+        super().__init__()
+        self.main = threading.main_thread().ident
+        # Every handler filters the same record, held records are kept once by id
+        self.records: "dict[int, logging.LogRecord]" = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.thread == self.main:
+            return True
+
+        with self._lock:
+            self.records[id(record)] = record
+        return False
+
+    def hold(self):
+        """starts holding records back"""
+        for handler in logging.getLogger().handlers:
+            handler.addFilter(self)
+
+    def release(self):
+        """stops holding records back and logs the held ones"""
+        handlers = logging.getLogger().handlers
+        for handler in handlers:
+            handler.removeFilter(self)
+
+        with self._lock:
+            records, self.records = self.records, {}
+
+        for record in records.values():
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+class Prefetcher:
+    """Pulls the images of the config the picker defaults to in background.
+        Prefetching only uses free cache space, the storage plan of the
+        config which actually runs decides about evictions"""
+    def __init__(self, executor: RPFileExecutor):
+        self.executor = executor
+        self.image_repo = executor.image_repo
+        self.cancelled = threading.Event()
+        # Set once the picked config is the prefetched one, no new pulls are started
+        self.draining = threading.Event()
+        self.started: "list[str]" = []
+        self.thread: "threading.Thread | None" = None
+        self.held_logs = _HeldLogs()
+
+    def start(self):
+        """starts prefetching, its logs are held back until stop()
+            so they don't draw over the picker"""
+        self.held_logs.hold()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.executor.compile(quiet=True)
+        except RuntimeError as ex:
+            logger.debug(f"Prefetch build failed: {ex}")
+            return
+
+        for image in self.executor.plan.pulls:
+            if self.cancelled.is_set() or self.draining.is_set():
+                return
+
+            self.started.append(image.name)
+            task = progress.add_task(f"Pulling {image.name}...")
+            try:
+                self.image_repo.pull(image.name, allow_deletion=False, cancel=self.cancelled,
+                    progress_callback=lambda copied, copied_total, total: progress.update(task, completed=copied_total, total=total))
+            except PullCancelled:
+                return
+            except IOError as ex:
+                logger.debug(f"Prefetch of {image.name} failed: {ex}")
+            finally:
+                progress.remove_task(task)
+
+    def stop(self, selected: RPFile):
+        """stops prefetching for the selected config.
+            if it is the prefetched one, the running pull carries on and the
+            executor waits for it like for any other pull of the same image.
+            otherwise the pull is cancelled and partial copies of images
+            selected doesn't use are removed"""
+        if selected is self.executor.rpfile:
+            self.draining.set()
+            self.held_logs.release()
+            return
+
+        self.cancelled.set()
+        if self.thread:
+            self.thread.join()
+        self.held_logs.release()
+
+        needed = set(selected.required_images)
+        for name in self.started:
+            if name not in needed:
+                remove_partial(path.join(self.image_repo.storage_path, name) + PART_SIG)
@@ -5,6 +5,7 @@ import os
 import pathlib
 import shutil
 from .constants import COPY_BLOCK_SIZE
+from .transfer import transfer
 
 
 class SameFileError(OSError):
@@ -22,6 +23,7 @@ def copy_with_callback(
     """ Copy file with a callback. 
         callback, if provided, must be a callable and will be 
         called after ever buffer_size bytes are copied.
+        Data is copied inside the kernel whenever possible.
     """
 
     srcfile = pathlib.Path(src)
@@ -57,30 +59,11 @@ def copy_with_callback(
         os.symlink(os.readlink(str(srcfile)), str(destfile))
     else:
         size = os.stat(src).st_size
-        with open(srcfile, "rb") as fsrc:
-            with open(destfile, "wb") as fdest:
-                _copyfileobj(
-                    fsrc, fdest, callback=callback, total=size, length=buffer_size
+        with open(srcfile, "rb", buffering=0) as fsrc:
+            with open(destfile, "wb", buffering=0) as fdest:
+                transfer(
+                    fsrc, fdest, total=size, callback=callback, block_size=buffer_size
                 )
     shutil.copymode(str(srcfile), str(destfile))
     return str(destfile)
 
-
-def _copyfileobj(fsrc, fdest, callback, total, length):
-    """ copy from fsrc to fdest
-    Args:
-        fsrc: filehandle to source file
-        fdest: filehandle to destination file
-        callback: callable callback that will be called after every length bytes copied
-        total: total bytes in source file (will be passed to callback)
-        length: how many bytes to copy at once (between calls to callback)
-    """
-    copied = 0
-    while True:
-        buf = fsrc.read(length)
-        if not buf:
-            break
-        fdest.write(buf)
-        copied += len(buf)
-        if callback is not None:
-            callback(len(buf), copied, total)
\ No newline at end of file
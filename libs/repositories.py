@@ -2,18 +2,33 @@
 import os
 import os.path as path
 import hashlib
+import json
 import shutil
+import time
+import threading
 import typing
-from rich.progress import Progress
+from concurrent.futures import ThreadPoolExecutor, Future
 from .rpfile import RPFile
 from .pretty import setup
-from .constants import HASH_SIG, HASH_BLOCK_SIZE, COPY_BLOCK_SIZE
+from .transfer import transfer, pread_exact
+from .index import ImageIndex, stat_key
+from .eviction import UsageHistory, get_policy, plan_eviction
+from .transports import FileTransport
+from .constants import HASH_SIG, PART_SIG, CHECKPOINT_SIG, CHUNKS_SIG, HASH_BLOCK_SIZE, \
+    PULL_RETRIES, CHECKPOINT_INTERVAL, CHUNK_SIZE, INDEX_FILE, HASH_WORKERS, USAGE_FILE, \
+    DEFAULT_EVICTION_POLICY, COPY_BLOCK_SIZE
 import logging
 
 wrapper, print, console, status, _logger, progress = setup()
 
-def compute_hash(file, progress_callback=None):
-    """computes hash from file"""
+class ImageVerificationError(IOError):
+    """Raised when a pulled image does not match the repository hash"""
+
+class PullCancelled(Exception):
+    """Raised when a pull is cancelled, the partial copy is checkpointed"""
+
+def compute_hash(file, progress_callback=None, block_size=HASH_BLOCK_SIZE):
+    """computes hash from file, reading block_size bytes at a time"""
 
     if progress_callback is not None and not callable(progress_callback):
         raise ValueError("Progress callback is not callable")
@@ -23,12 +38,12 @@ def compute_hash(file, progress_callback=None):
     total_size = os.stat(file).st_size
 
     with open(file, "rb") as _f:
-        for block in iter(lambda: _f.read(HASH_BLOCK_SIZE), b""):
+        for block in iter(lambda: _f.read(block_size), b""):
             __hash.update(block)
             if progress_callback:
-                block_size = len(block)
-                total_read += block_size
-                progress_callback(block_size, total_read, total_size)
+                read = len(block)
+                total_read += read
+                progress_callback(read, total_read, total_size)
 
     return __hash.hexdigest()
 
@@ -52,58 +67,368 @@ def write_image_hash(image_path, __hash):
     with open(hash_path, "w", encoding="utf-8") as _f:
         _f.write(__hash)
 
+def read_chunk_manifest(image_path):
+    """Reads the chunk manifest of an image.
+        returns the chunk size and a list of chunk hashes"""
+    manifest_path = image_path + CHUNKS_SIG
+    if not path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path, "r", encoding="utf-8") as _f:
+        lines = _f.read().split()
+
+    try:
+        return int(lines[0]), lines[1:]
+    except (IndexError, ValueError):
+        return None
+
+def write_chunk_manifest(image_path, chunk_size, chunks):
+    """Create a file containing the chunk hashes of provided image"""
+    manifest_path = image_path + CHUNKS_SIG
+    if chunks is None:
+        if path.isfile(manifest_path):
+            os.remove(manifest_path)
+        return
+
+    with open(manifest_path, "w", encoding="utf-8") as _f:
+        _f.write("\n".join([str(chunk_size), *chunks]))
+
+def publish_image(image_path, chunk_size=CHUNK_SIZE, progress_callback=None):
+    """Writes the hash and chunk manifest sidecars of a repository image
+        in a single read pass"""
+    if progress_callback is not None and not callable(progress_callback):
+        raise ValueError("Progress callback is not callable")
+
+    __hash = hashlib.sha256()
+    chunks = []
+    total_read = 0
+    total_size = os.stat(image_path).st_size
+
+    with open(image_path, "rb") as _f:
+        for block in iter(lambda: _f.read(chunk_size), b""):
+            __hash.update(block)
+            chunks.append(hashlib.sha256(block).hexdigest())
+            if progress_callback:
+                total_read += len(block)
+                progress_callback(len(block), total_read, total_size)
+
+    write_image_hash(image_path, __hash.hexdigest())
+    write_chunk_manifest(image_path, chunk_size, chunks)
+    return __hash.hexdigest()
+
+def read_checkpoint(part_path):
+    """Reads the checkpoint of a partially pulled image"""
+    checkpoint_path = part_path + CHECKPOINT_SIG
+    if not path.isfile(checkpoint_path) or not path.isfile(part_path):
+        return None
+
+    try:
+        with open(checkpoint_path, "r", encoding="utf-8") as _f:
+            return json.load(_f)
+    except ValueError:
+        return None
+
+def write_checkpoint(part_path, remote_hash, offset, __hash):
+    """Records how much of a partially pulled image is on disk,
+        the part file must be synced before calling this"""
+    checkpoint_path = part_path + CHECKPOINT_SIG
+    temp_path = checkpoint_path + PART_SIG
+    with open(temp_path, "w", encoding="utf-8") as _f:
+        json.dump({"remote_hash": remote_hash, "offset": offset, "hash": __hash}, _f)
+        _f.flush()
+        os.fsync(_f.fileno())
+
+    os.replace(temp_path, checkpoint_path)
+
+def remove_partial(part_path):
+    """Removes a partially pulled image and its checkpoint"""
+    for file in (part_path, part_path + CHECKPOINT_SIG):
+        if path.isfile(file):
+            os.remove(file)
+
+def restore_partial(part_path, remote_hash):
+    """Validates a partially pulled image against its checkpoint.
+        returns the offset to resume from and the hash state up to it"""
+    checkpoint = read_checkpoint(part_path)
+    if not checkpoint or checkpoint.get("remote_hash") != remote_hash:
+        remove_partial(part_path)
+        return 0, hashlib.sha256()
+
+    offset = checkpoint.get("offset", 0)
+    if path.getsize(part_path) < offset:
+        remove_partial(part_path)
+        return 0, hashlib.sha256()
+
+    # Hash state can't be stored, rebuild it from the local copy
+    __hash = hashlib.sha256()
+    remaining = offset
+    with open(part_path, "rb") as _f:
+        while remaining > 0:
+            block = _f.read(min(HASH_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            __hash.update(block)
+            remaining -= len(block)
+
+    if remaining or __hash.hexdigest() != checkpoint.get("hash"):
+        remove_partial(part_path)
+        return 0, hashlib.sha256()
+
+    os.truncate(part_path, offset)
+    return offset, __hash
+
+def _is_image_file(file):
+    """checks if a file name belongs to an image rather than failrp metadata"""
+    return not file.startswith(".") and \
+        not file.endswith((HASH_SIG, PART_SIG, CHECKPOINT_SIG, CHUNKS_SIG))
+
 def list_images(image_dir):
     """Lists images in directory"""
     images = []
     for file in os.listdir(image_dir):
-        if not path.isfile(path.join(image_dir, file)) or file.endswith(HASH_SIG):
+        if not path.isfile(path.join(image_dir, file)) or not _is_image_file(file):
             continue
 
         images.append(file)
 
     return images
 
+def scan_images(image_dir):
+    """Lists images in directory with a single directory read.
+        returns image names mapped to the stats of the image and its hash sidecar"""
+    stats: "dict[str, os.stat_result]" = {}
+    with os.scandir(image_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stats[entry.name] = entry.stat()
+
+    return {name: (stat, stats.get(name + HASH_SIG)) for name, stat in stats.items()
+            if _is_image_file(name)}
+
 class Image:
     """Python wrapper for clonezilla image"""
-    def __init__(self, name, remote_path, local_path, remote_hash, local_hash):
+    def __init__(self, name, remote_path, local_path, remote_hash, local_hash,
+                 remote_size=None, local_size=None):
         self.name = name
         self.remote_path = remote_path
         self.local_path = local_path
         self.remote_hash = remote_hash
+        self._local_hash = None
+        self._local_hash_future: "Future | None" = None
         self.local_hash = local_hash
+        self.remote_size = remote_size
+        self.local_size = local_size
+
+    @property
+    def local_hash(self):
+        """hash of the cached image, waits for background hashing if pending"""
+        if self._local_hash_future is not None:
+            self._local_hash = self._local_hash_future.result()
+            self._local_hash_future = None
+
+        return self._local_hash
+
+    @local_hash.setter
+    def local_hash(self, value):
+        if isinstance(value, Future):
+            self._local_hash_future = value
+            self._local_hash = None
+            return
 
-    def pull(self, destination, progress_callback=None):
-        """pulls newest image from repo"""
+        if self._local_hash_future is not None:
+            self._local_hash_future.cancel()
+        self._local_hash_future = None
+        self._local_hash = value
+
+    @property
+    def hash_pending(self):
+        """checks if the cached image is still being hashed"""
+        return self._local_hash_future is not None and not self._local_hash_future.done()
+
+    def pull(self, destination, progress_callback=None, verify=True, retries=PULL_RETRIES,
+             transport=None, cancel: "threading.Event | None" = None, block_size=COPY_BLOCK_SIZE):
+        """pulls newest image from repo through transport (the mounted repository by default).
+            with verify, the image is hashed while copying and only
+            committed to destination if it matches the repository hash,
+            corrupt copies are retried up to retries times.
+            verified pulls are checkpointed and resume after interruptions,
+            setting cancel stops them with PullCancelled.
+            block_size is the size of each copied block"""
         if progress_callback is not None and not callable(progress_callback):
             raise ValueError("Progress callback is not callable")
 
         if os.path.isfile(destination):
             os.remove(destination)
 
-        total_read = 0
+        transport = transport or FileTransport()
+        if not verify:
+            self._copy_remote(destination, transport, progress_callback, block_size)
+        else:
+            part_path = destination + PART_SIG
+            for attempt in range(retries + 1):
+                # Never trust a partial copy again after a failed verification
+                __hash = self._pull_partial(part_path, transport, progress_callback,
+                                            resume=attempt == 0, cancel=cancel,
+                                            block_size=block_size)
+                if __hash == self.remote_hash:
+                    break
+
+                remove_partial(part_path)
+                if attempt == retries:
+                    raise ImageVerificationError(f"Pulled image {self.name} does not match repository hash")
+
+                _logger.warning(f"Pulled image {self.name} is corrupted, retrying ({attempt+1}/{retries})")
+
+            os.replace(part_path, destination)
+            remove_partial(part_path)
+
+        self._commit(destination)
+
+    def pull_delta(self, progress_callback=None, transport=None,
+                   cancel: "threading.Event | None" = None) -> bool:
+        """rebuilds an outdated cached image from the chunks it shares with
+            the repository version, only fetching chunks that changed.
+            needs chunk manifests on both sides and space for the new image,
+            returns False if a full pull is needed instead"""
+        if progress_callback is not None and not callable(progress_callback):
+            raise ValueError("Progress callback is not callable")
+
+        if not self.available_local or not self.available_remote:
+            return False
+
+        local_manifest = read_chunk_manifest(self.local_path)
+        remote_manifest = read_chunk_manifest(self.remote_path)
+        if not local_manifest or not remote_manifest or local_manifest[0] != remote_manifest[0]:
+            return False
+
+        chunk_size, remote_chunks = remote_manifest
+        known_chunks = {}
+        for i, digest in enumerate(local_manifest[1]):
+            known_chunks.setdefault(digest, i * chunk_size)
+
+        missing = len([digest for digest in remote_chunks if digest not in known_chunks])
+        _logger.info(f"Delta pull of {self.name}: fetching {missing} of {len(remote_chunks)} chunks")
+
+        transport = transport or FileTransport()
         total_size = os.stat(self.remote_path).st_size
+        part_path = self.local_path + PART_SIG
+        remove_partial(part_path)
+        __hash = hashlib.sha256()
+        view = memoryview(bytearray(chunk_size))
+        copied = 0
+
+        with open(self.local_path, "rb", buffering=0) as _flocal, \
+            open(part_path, "wb", buffering=0) as _fdst:
+            for i, digest in enumerate(remote_chunks):
+                if cancel is not None and cancel.is_set():
+                    break
+
+                length = min(chunk_size, total_size - i * chunk_size)
+                if digest in known_chunks:
+                    read = pread_exact(_flocal.fileno(), view[:length], known_chunks[digest])
+                else:
+                    read = transport.read_range(self, view[:length], i * chunk_size)
+
+                block = view[:read]
+                _fdst.write(block)
+                __hash.update(block)
+                copied += read
+                if progress_callback:
+                    progress_callback(read, copied, total_size)
+
+        if cancel is not None and cancel.is_set():
+            remove_partial(part_path)
+            raise PullCancelled(f"Delta pull of {self.name} cancelled")
+
+        if copied != total_size or __hash.hexdigest() != self.remote_hash:
+            _logger.warning(f"Delta pull of {self.name} failed verification")
+            remove_partial(part_path)
+            return False
 
-        with open(self.remote_path, "rb") as _fsrc:
-            with open(destination, "wb") as _fdst:
-                for block in iter(lambda: _fsrc.read(COPY_BLOCK_SIZE), b""):
-                    _fdst.write(block)
-                    if progress_callback:
-                        block_size = len(block)
-                        total_read += block_size
-                        progress_callback(block_size, total_read, total_size)
+        os.replace(part_path, self.local_path)
+        self._commit(self.local_path)
+        return True
 
+    def _commit(self, destination):
+        """records a verified copy of the repository image at destination"""
         self.local_path = destination
+        self.local_size = path.getsize(destination)
         write_image_hash(destination, self.remote_hash)
+        manifest = read_chunk_manifest(self.remote_path)
+        write_chunk_manifest(destination, *(manifest or (None, None)))
         self.local_hash = self.remote_hash
 
+    def _copy_remote(self, destination, transport, progress_callback=None,
+                     block_size=COPY_BLOCK_SIZE):
+        """copies remote image to destination without verification"""
+        total_size = os.stat(self.remote_path).st_size
+
+        with transport.open(self) as _fsrc:
+            with open(destination, "wb", buffering=0) as _fdst:
+                transfer(_fsrc, _fdst, total=total_size, callback=progress_callback,
+                         block_size=block_size)
+
+    def _pull_partial(self, part_path, transport, progress_callback=None, resume=True,
+                      cancel=None, block_size=COPY_BLOCK_SIZE):
+        """copies remote image into part_path, checkpointing every
+            CHECKPOINT_INTERVAL bytes. returns the hash of the whole copy"""
+        if getattr(transport, "out_of_order", False):
+            offset = restore_partial(part_path, self.remote_hash)[0] if resume else 0
+            if not offset:
+                # Multicast data arrives out of order, it can't be hashed while copying
+                remove_partial(part_path)
+                if transport.receive(self, part_path, progress_callback, cancel):
+                    return compute_hash(part_path, block_size=block_size)
+                resume = False
+
+            # Resumed pulls and images no session sends take the hashed, checkpointed path
+            transport = transport.repair
+
+        total_size = os.stat(self.remote_path).st_size
+        if resume:
+            offset, __hash = restore_partial(part_path, self.remote_hash)
+        else:
+            remove_partial(part_path)
+            offset, __hash = 0, hashlib.sha256()
+
+        if offset:
+            _logger.info(f"Resuming pull of {self.name} at {offset} bytes")
+
+        with transport.open(self, offset) as _fsrc:
+            with open(part_path, "r+b" if offset else "wb", buffering=0) as _fdst:
+                _fdst.seek(offset)
+                checkpointed = offset
+
+                def _callback(copied, copied_total, total):
+                    nonlocal checkpointed
+                    cancelled = cancel is not None and cancel.is_set()
+                    if cancelled or offset + copied_total - checkpointed >= CHECKPOINT_INTERVAL:
+                        checkpointed = offset + copied_total
+                        os.fsync(_fdst.fileno())
+                        write_checkpoint(part_path, self.remote_hash, checkpointed,
+                                         __hash.copy().hexdigest())
+
+                    if cancelled:
+                        raise PullCancelled(f"Pull of {self.name} cancelled at {checkpointed} bytes")
+
+                    if progress_callback:
+                        progress_callback(copied, offset + copied_total, total)
+
+                transfer(_fsrc, _fdst, total=total_size, callback=_callback, hasher=__hash,
+                         block_size=block_size)
+
+        return __hash.hexdigest()
+
     def delete(self):
         """deletes image from cache"""
         if path.exists(self.local_path):
             os.remove(self.local_path)
             write_image_hash(self.local_path, None)
+            write_chunk_manifest(self.local_path, None, None)
 
         self.local_path = None
         self.local_hash = None
+        self.local_size = None
 
     @property
     def available_remote(self):
@@ -136,16 +461,28 @@ class Image:
     def size(self):
         """returns size of image"""
         if self.available_local:
-            return path.getsize(self.local_path)
+            if self.local_size is None:
+                self.local_size = path.getsize(self.local_path)
+            return self.local_size
 
         if self.available_remote:
-            return path.getsize(self.remote_path)
+            if self.remote_size is None:
+                self.remote_size = path.getsize(self.remote_path)
+            return self.remote_size
 
         return None
 
+    @property
+    def repository_size(self):
+        """returns size of the repository version of image"""
+        if self.remote_size is None:
+            self.remote_size = path.getsize(self.remote_path)
+        return self.remote_size
+
 class ImageRepository:
     """ImageRepository utility class"""
-    def __init__(self, repo_path, storage_path, eager_mode=False):
+    def __init__(self, repo_path, storage_path, eager_mode=False,
+                 eviction_policy=DEFAULT_EVICTION_POLICY, transport=None):
         if not path.exists(repo_path):
             raise ValueError(f"Non-existent repository path provided: {repo_path}")
 
@@ -155,40 +492,56 @@ class ImageRepository:
         self.repo_path: str = repo_path
         self.storage_path: str = storage_path
         self.images: "dict[str, Image]" = {}
+        self.transport = transport or FileTransport()
+        self.index = ImageIndex(path.join(storage_path, INDEX_FILE))
+        self._hasher: "ThreadPoolExecutor | None" = None
+        self.policy = get_policy(eviction_policy)
+        self.usage = UsageHistory(path.join(storage_path, USAGE_FILE))
+        # Images referenced by server configs, evicted only as a last resort
+        self.pins: "set[str]" = set()
+        # Concurrent pulls of one image wait for each other instead of sharing a .part
+        self._pull_locks: "dict[str, threading.Lock]" = {}
+        self._pull_locks_lock = threading.Lock()
 
         if eager_mode:
             self.sync()
 
     def sync(self):
-        """syncs with repository"""
-        image_files = list(set(list_images(self.storage_path) + list_images(self.repo_path)))
+        """syncs with repository.
+            images unchanged since the last sync are revalidated
+            with a stat instead of reading sidecars or rehashing"""
+        local_files = scan_images(self.storage_path)
+        remote_files = scan_images(self.repo_path)
         images: "dict[str, Image]" = {}
 
         # Build image list
-        for name in image_files:
+        for name in set(local_files) | set(remote_files):
             try:
                 local_path = path.join(self.storage_path, name)
                 remote_path = path.join(self.repo_path, name)
 
-                local_exists = path.isfile(local_path)
-                remote_exists = path.isfile(remote_path)
-
-                local_hash = read_image_hash(local_path) if local_exists else None
-                remote_hash = read_image_hash(remote_path) if remote_exists else None
+                local_stat, _ = local_files.get(name, (None, None))
+                remote_stat, remote_hash_stat = remote_files.get(name, (None, None))
 
-                if local_exists and not local_hash:
-                    hash_progress = Progress()
-                    task = hash_progress.add_task(f"Computing checksum for image '{name}'")
-                    local_hash = compute_hash(local_path, lambda copied, copied_total, total: hash_progress.update(task, completed=copied_total, total=total))
-                    hash_progress.remove_task(task)
-                    write_image_hash(local_path, local_hash)
+                local_hash = self._local_hash(name, local_path, local_stat) if local_stat else None
+                remote_hash = None
+                if remote_stat and remote_hash_stat:
+                    key = stat_key(remote_stat, remote_hash_stat)
+                    entry = self.index.lookup(remote_path, key)
+                    if entry:
+                        remote_hash = entry["hash"]
+                    else:
+                        remote_hash = read_image_hash(remote_path)
+                        self.index.update(remote_path, key, remote_stat.st_size, remote_hash)
 
                 image = Image(
                     name,
-                    remote_path if remote_exists else None,
-                    local_path if local_exists else None,
+                    remote_path if remote_stat else None,
+                    local_path if local_stat else None,
                     remote_hash,
-                    local_hash
+                    local_hash,
+                    remote_stat.st_size if remote_stat else None,
+                    local_stat.st_size if local_stat else None
                 )
 
                 images[name] = image
@@ -196,48 +549,117 @@ class ImageRepository:
                 logging.warning(f"WARNING: Failed to sync image {name}: {ex}")
 
         self.images = images
+        # Evicted images keep their history for when they are pulled again,
+        # images gone from the repository too won't be
+        removed = [name for name in list(self.usage.images) if name not in images]
+        if removed:
+            self.usage.forget(removed)
+            self.usage.save()
+        self.index.prune({path.join(self.storage_path, name) for name in local_files} |
+                         {path.join(self.repo_path, name) for name in remote_files})
+        self.index.save()
+
+    def _local_hash(self, name, local_path, local_stat):
+        """returns hash of a cached image from the index or its sidecar.
+            images without either are hashed in the background and a
+            Future is returned instead"""
+        key = stat_key(local_stat)
+        entry = self.index.lookup(local_path, key)
+        if entry:
+            return entry["hash"]
+
+        local_hash = read_image_hash(local_path)
+        if not local_hash:
+            if self._hasher is None:
+                self._hasher = ThreadPoolExecutor(max_workers=HASH_WORKERS,
+                                                  thread_name_prefix="hasher")
+            _logger.info(f"Computing checksum for image '{name}' in background")
+            return self._hasher.submit(self._hash_local, name, local_path, key)
+
+        self.index.update(local_path, key, local_stat.st_size, local_hash)
+        return local_hash
+
+    def _hash_local(self, name, local_path, key):
+        """hashes a cached image, runs on the hasher pool"""
+        local_hash = compute_hash(local_path)
+
+        # The image may have been replaced or evicted meanwhile
+        try:
+            local_stat = os.stat(local_path)
+        except FileNotFoundError:
+            return None
+
+        if stat_key(local_stat) != key:
+            return None
+
+        write_image_hash(local_path, local_hash)
+        self.index.update(local_path, key, local_stat.st_size, local_hash)
+        self.index.save()
+        _logger.info(f"Checksum for image '{name}' ready")
+        return local_hash
+
+    def _record_local(self, image: Image):
+        """updates the index after an image changed in cache"""
+        if not image.available_local:
+            return
+
+        local_stat = os.stat(image.local_path)
+        self.index.update(image.local_path, stat_key(local_stat), local_stat.st_size, image.local_hash)
+        self.index.save()
 
     def shrink_storage(self, required_free,
                        disallowed_deletions: "typing.Optional[list[Image]]" = None):
-        """Deletes old or not used image from cache"""
-
-        if not disallowed_deletions:
-            disallowed_deletions = []
-
-        free_space = self.free_storage
+        """Deletes images from cache in the order chosen by the eviction policy"""
         local_images: "list[Image]" = [image for image in self.images.values() \
                                        if image.available_local]
 
-        shrinkable_space = sum([x.size for x in local_images if x.name not in disallowed_deletions])
-        if free_space + shrinkable_space < required_free:
+        evicted = plan_eviction(local_images, required_free, self.free_storage, self.policy,
+                                self.usage, disallowed_deletions, self.pins)
+        if evicted is None:
             # impossible to free space up to the required point
             return False
 
-        # Shrink storage
-        local_images = sorted(local_images, key=lambda x: x.size, reverse=True)
-        for image in local_images:
-            if image.name in disallowed_deletions:
-                continue
+        for image in evicted:
+            self.evict(image)
 
-            image_size = image.size
-            image.delete()
+        return self.free_storage > required_free
 
-            free_space += image_size
-            if free_space > required_free:
-                break
+    def evict(self, image: Image):
+        """deletes an image from cache"""
+        _logger.info(f"Evicting {image.name} from cache ({self.policy.name} policy)")
+        self.index.remove(image.local_path)
+        image.delete()
 
-        return free_space > required_free
+    def pin(self, names: "typing.Iterable[str]"):
+        """marks images which should stay cached for as long as possible"""
+        self.pins = set(names)
 
+    def touch(self, name):
+        """records that an operation used an image"""
+        self.usage.record_use(name)
+        self.usage.save()
+
+    def _pull_lock(self, name) -> threading.Lock:
+        with self._pull_locks_lock:
+            return self._pull_locks.setdefault(name, threading.Lock())
 
     def pull(self, name, force=False, allow_deletion=True,
-             disallowed_deletions: "typing.Optional[list[Image]]" =None, progress_callback=None):
-        """Pulls latest image from repository"""
+             disallowed_deletions: "typing.Optional[list[Image]]" =None, progress_callback=None,
+             verify=True, cancel: "threading.Event | None" = None):
+        """Pulls latest image from repository.
+            a pull of an image which is already being pulled waits for it first"""
         if not disallowed_deletions:
             disallowed_deletions = []
 
         if name not in self.images:
             raise ValueError(f"Image {name} unavailable in repo")
 
+        with self._pull_lock(name):
+            self._pull(name, force, allow_deletion, disallowed_deletions, progress_callback,
+                       verify, cancel)
+
+    def _pull(self, name, force, allow_deletion, disallowed_deletions, progress_callback,
+              verify, cancel):
         image = self.images[name]
         if not image.available_remote:
             raise FileNotFoundError(f"Image {name} unavailable in repo")
@@ -246,20 +668,36 @@ class ImageRepository:
             if not image.outdated and not force:
                 # Image is up to date, don't pull
                 return
-            else:
-                # Delete locally cached image
-                image.delete()
 
+            if not force and self.free_storage >= path.getsize(image.remote_path) and \
+                image.pull_delta(progress_callback=progress_callback, transport=self.transport,
+                                 cancel=cancel):
+                # Rebuilt from the chunks which changed
+                self._record_local(image)
+                return
+
+            # Delete locally cached image
+            self.index.remove(image.local_path)
+            image.delete()
+
+        destination = path.join(self.storage_path, name)
         free_space = self.free_storage
         image_size = image.size
+        # Interrupted pulls resume, only the remainder needs space
+        part_path = destination + PART_SIG
+        if path.isfile(part_path):
+            image_size = max(image_size - path.getsize(part_path), 0)
 
         if free_space < image_size:
             if not allow_deletion or not self.shrink_storage(image_size, disallowed_deletions):
                 raise IOError("Insufficient storage space to save image")
-            return
 
-        destination = path.join(self.storage_path, name)
-        image.pull(destination, progress_callback=progress_callback)
+        started = time.monotonic()
+        image.pull(destination, progress_callback=progress_callback, verify=verify,
+                   transport=self.transport, cancel=cancel)
+        self.usage.record_pull(name, image_size, time.monotonic() - started)
+        self.usage.save()
+        self._record_local(image)
 
     def get(self, name, default=None):
         """returns image with given name"""
@@ -301,6 +739,10 @@ class ImageRepository:
         """returns size of cache partition"""
         return shutil.disk_usage(self.storage_path).total
 import requests
+
+# Bumped whenever the config cache changes shape
+CONFIG_CACHE_VERSION = 3
+
 class ConfigRepository:
     """RPfile configuration repository"""
     # def __init__(self, repo_path, eager_mode=False):
@@ -312,26 +754,144 @@ class ConfigRepository:
 
     #     if eager_mode:
     #         self.sync()
-    def __init__(self, host: str, port: str, eager_mode=False):
+    def __init__(self, host: str, port: str, eager_mode=False, cache_path=None):
         self.link = f"http://{host}:{port}"
         self.configs: "dict[str, RPFile]" = {}
+        self.volume_file: "str | None" = None
+        self.etag: "str | None" = None
+        # Parsed configs survive reboots here, keyed by the server's ETag
+        self.cache_path = cache_path
+        # sha256 of the source of every compiled config
+        self._sources: "dict[str, str]" = {}
+        # One pooled keep-alive connection for every config request
+        self.session = requests.Session()
+        self.load_cache()
         if eager_mode:
             self.sync()
 
     def sync(self):
-        """sync configuration with remote"""
-        req = requests.get(f"{self.link}/configs/", timeout=10)
-        configs = {}
-        configurations = req.json()
-        for name in configurations:
+        """sync configuration with remote, unchanged configs cost a single
+            conditional request. the last known good configs are kept
+            if the server can't be reached"""
+        try:
+            self._sync_remote()
+        except (requests.RequestException, ValueError) as ex:
+            if not self.configs:
+                raise
+            _logger.warning(f"Config server unreachable, using cached configs: {ex}")
+            return
+
+        self.save_cache()
+
+    def _sync_remote(self):
+        headers = {"If-None-Match": self.etag} if self.etag else {}
+        req = self.session.get(f"{self.link}/bundle", timeout=20, headers=headers)
+        if req.status_code == 404:
+            # Older servers have no bundle endpoint
+            self._sync_files()
+            return
+
+        if req.status_code == 304:
+            return
+
+        req.raise_for_status()
+        data = req.json()
+        self.configs = self._compile(data["configs"])
+        self.volume_file = data["volumes"]
+        self.etag = req.headers.get("ETag")
+
+    def _sync_files(self):
+        """sync configuration file by file"""
+        names = self.session.get(f"{self.link}/configs/", timeout=10).json()
+        bodies = {}
+        for name in names:
             try:
-                config_body = requests.get(f"{self.link}/configs/{name}", timeout=20).text
-                config = RPFile(config_body)
-                configs[name] = config
+                bodies[name] = self.session.get(f"{self.link}/configs/{name}", timeout=20).text
+            except requests.RequestException as ex:
+                logging.warning(f"WARNING: Failed to sync config {name}: {ex}")
+
+        self.configs = self._compile(bodies)
+        self.volume_file = self.session.get(f"{self.link}/labels", timeout=10).text
+        self.etag = None
+
+    def _compile(self, bodies: "dict[str, str]") -> "dict[str, RPFile]":
+        """compiles config sources, configs with unchanged sources are reused"""
+        configs, sources = {}, {}
+        for name, body in bodies.items():
+            digest = hashlib.sha256(body.encode("utf-8")).hexdigest()
+            if self._sources.get(name) == digest and name in self.configs:
+                configs[name] = self.configs[name]
+                sources[name] = digest
+                continue
+
+            try:
+                configs[name] = RPFile(body)
+                sources[name] = digest
             except Exception as ex:
                 logging.warning(f"WARNING: Failed to sync config {name}: {ex}")
 
+        self._sources = sources
+        return configs
+
+    @staticmethod
+    def _steps_digest(steps: list) -> str:
+        return hashlib.sha256(json.dumps(steps).encode("utf-8")).hexdigest()
+
+    def load_cache(self):
+        """loads parsed configs from cache without running the parser,
+            a missing or broken cache is ignored"""
+        if not self.cache_path or not path.isfile(self.cache_path):
+            return
+
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as _f:
+                data = json.load(_f)
+
+            if data.get("version") != CONFIG_CACHE_VERSION:
+                return
+
+            configs, sources = {}, {}
+            for name, entry in data["configs"].items():
+                if self._steps_digest(entry["steps"]) != entry["checksum"]:
+                    raise ValueError(f"config {name} does not match its checksum")
+
+                configs[name] = RPFile.from_steps(entry["steps"])
+                sources[name] = entry["source"]
+
+            volume_file = data["volume_file"]
+            etag = data["etag"]
+        except Exception as ex:
+            _logger.warning(f"Ignoring broken config cache: {ex}")
+            return
+
         self.configs = configs
+        self._sources = sources
+        self.volume_file = volume_file
+        self.etag = etag
+
+    def save_cache(self):
+        """writes parsed configs to cache"""
+        if not self.cache_path:
+            return
+
+        configs = {}
+        for name, source in self._sources.items():
+            steps = [list(step) for step in self.configs[name].steps]
+            configs[name] = {"source": source, "steps": steps, "checksum": self._steps_digest(steps)}
+
+        temp_path = self.cache_path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as _f:
+                json.dump({
+                    "version": CONFIG_CACHE_VERSION,
+                    "configs": configs,
+                    "volume_file": self.volume_file,
+                    "etag": self.etag
+                }, _f)
+
+            os.replace(temp_path, self.cache_path)
+        except OSError as ex:
+            _logger.warning(f"Failed to write config cache: {ex}")
 
     def get(self, name, default=None):
         """get configuration by name"""
@@ -259,22 +259,34 @@ class RPFile:
     """RPFile type extension"""
     def __init__(self, source=None):
         self.instructions: "list[Instruction] | None" = None
+        # (instruction type, value) pairs the parser produced
+        self.steps: "list[tuple[str, str]] | None" = None
         if source:
             self.compile(source)
 
     def compile(self, source):
         """Compiles RPFile to Python"""
         source_bytes = source.encode("utf-8")
-        instructions = []
         with io.BytesIO(source_bytes) as _f:
             parser = RPFileParser(fileobj=_f)
-            self.instructions = []
-            for step in parser.structure:
-                instrucion_type = step["instruction"].upper()
-                instructions.append(compile_instruction(instrucion_type, step["value"]))
+            self.compile_steps([(step["instruction"], step["value"]) for step in parser.structure])
+
+    def compile_steps(self, steps: "list[tuple[str, str]]"):
+        """Compiles parsed steps, skipping the parser"""
+        instructions = []
+        for instrucion_type, value in steps:
+            instructions.append(compile_instruction(instrucion_type.upper(), value))
 
+        self.steps = [(instrucion_type, value) for instrucion_type, value in steps]
         self.instructions = instructions
 
+    @classmethod
+    def from_steps(cls, steps: "list[tuple[str, str]]") -> "RPFile":
+        """returns an RPFile of already parsed steps"""
+        rpfile = cls()
+        rpfile.compile_steps(steps)
+        return rpfile
+
     def add_instruction(self, instruction):
         """appends instruction to instruction stack"""
         self.instructions.append(instruction)
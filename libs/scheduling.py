@@ -0,0 +1,98 @@
+"""Dependency-aware scheduling of RPFile operations"""
+from __future__ import annotations
+import typing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Shared by every operation writing to the image cache, pulls compete for
+# the same link and the same free space so they never overlap.
+CACHE_RESOURCE = ("cache", "")
+
+def instruction_resources(instruction) -> "set[tuple[str, str]]":
+    """returns the images and volumes touched by an instruction"""
+    resources = set()
+    if instruction is None:
+        return resources
+
+    if hasattr(instruction, "image"):
+        resources.add(("image", instruction.image))
+
+    if hasattr(instruction, "volume"):
+        resources.add(("volume", instruction.volume))
+
+    return resources
+
+class OperationGraph:
+    """Dependency graph of compiled operations.
+        An operation depends on every earlier operation sharing a resource
+        with it, exclusive operations depend on (and block) everything."""
+    def __init__(self, operations: "list"):
+        self.operations = list(operations)
+        self.dependencies: "list[set[int]]" = []
+
+        for i, operation in enumerate(self.operations):
+            dependencies = set()
+            for j in range(i):
+                if self.conflicts(self.operations[j], operation):
+                    dependencies.add(j)
+
+            self.dependencies.append(dependencies)
+
+    @staticmethod
+    def conflicts(first, second) -> bool:
+        """checks if two operations have to keep their RPFile order"""
+        if first.exclusive or second.exclusive:
+            return True
+
+        return not first.resources.isdisjoint(second.resources)
+
+    def ready(self, done: "set[int]", started: "set[int]") -> "list[int]":
+        """returns indexes of operations which can be started"""
+        return [i for i in range(len(self.operations))
+                if i not in started and self.dependencies[i] <= done]
+
+    def __len__(self):
+        return len(self.operations)
+
+class OperationScheduler:
+    """Runs an operation graph on a bounded worker pool"""
+    def __init__(self, operations: "list", max_workers=1):
+        if max_workers < 1:
+            raise ValueError(f"Invalid worker count: {max_workers}")
+
+        self.graph = OperationGraph(operations)
+        self.max_workers = max_workers
+
+    def run(self, callback: "typing.Callable[[int, typing.Any], None]"):
+        """calls callback(index, operation) for every operation,
+            independent operations are run concurrently"""
+        done: "set[int]" = set()
+        started: "set[int]" = set()
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while len(done) < len(self.graph):
+                if error is None:
+                    for i in self.graph.ready(done, started):
+                        if len(running) >= self.max_workers:
+                            break
+
+                        started.add(i)
+                        running[pool.submit(callback, i, self.graph.operations[i])] = i
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    i = running.pop(future)
+                    ex = future.exception()
+                    if ex is not None:
+                        # Let running operations finish but don't start new ones
+                        error = error or ex
+                        continue
+
+                    done.add(i)
+
+        if error is not None:
+            raise error
@@ -0,0 +1,125 @@
+"""Kernel assisted file transfers with progress callbacks"""
+import errno
+import os
+from .constants import COPY_BLOCK_SIZE
+
+# Errors meaning the kernel can't do this transfer method for these files,
+# e.g. copy_file_range across filesystems or sendfile from some FUSE mounts
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.EPERM,
+}
+
+class Progress:
+    """Calls a progress callback every interval bytes"""
+    def __init__(self, callback, total, interval):
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.copied = 0
+        self.pending = 0
+
+    def update(self, size):
+        """records size transferred bytes"""
+        self.copied += size
+        self.pending += size
+        if self.callback and self.pending >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """reports all pending bytes"""
+        if self.callback and self.pending:
+            self.callback(self.pending, self.copied, self.total)
+        self.pending = 0
+
+def _kernel_copy(method, src_fd, dst_fd, block_size, state: Progress) -> bool:
+    """copies using a kernel method until EOF.
+        returns False if the method is unsupported, file offsets are left
+        after the last copied byte so another method can carry on"""
+    while True:
+        try:
+            copied = method(src_fd, dst_fd, block_size)
+        except OSError as ex:
+            if ex.errno in _UNSUPPORTED_ERRNOS:
+                return False
+            raise
+
+        if copied == 0:
+            return True
+
+        state.update(copied)
+
+def _copy_file_range(src_fd, dst_fd, count):
+    return os.copy_file_range(src_fd, dst_fd, count)
+
+def _sendfile(src_fd, dst_fd, count):
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+def pread_exact(fd, view, offset) -> int:
+    """reads len(view) bytes at offset, returns the number of bytes read"""
+    read = 0
+    while read < len(view):
+        size = os.preadv(fd, [view[read:]], offset + read)
+        if not size:
+            break
+        read += size
+
+    return read
+
+def _has_fileno(_f) -> bool:
+    """checks if a file object is backed by a file descriptor"""
+    try:
+        _f.fileno()
+    except (OSError, ValueError):
+        return False
+    return True
+
+def _userspace_copy(fsrc, fdst, block_size, state: Progress, hasher=None):
+    """copies through a single reused buffer"""
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    while True:
+        read = fsrc.readinto(view)
+        if not read:
+            return
+
+        block = view[:read]
+        written = 0
+        while written < read:
+            written += fdst.write(block[written:])
+
+        if hasher is not None:
+            hasher.update(block)
+
+        state.update(read)
+
+def transfer(fsrc, fdst, total=None, callback=None, hasher=None,
+             block_size=COPY_BLOCK_SIZE, callback_interval=None):
+    """Copies fsrc to fdst from their current positions until EOF.
+        Both must be unbuffered file objects (opened with buffering=0).
+        Data stays in the kernel (copy_file_range, then sendfile) unless a
+        hasher is given, either file has no descriptor (e.g. network
+        streams) or the kernel can't copy between these files.
+        callback(copied, copied_total, total) is called every
+        callback_interval bytes (block_size by default).
+        returns the number of copied bytes"""
+    if callback is not None and not callable(callback):
+        raise ValueError("callback is not callable")
+
+    state = Progress(callback, total, callback_interval or block_size)
+
+    if hasher is None and _has_fileno(fsrc) and _has_fileno(fdst):
+        src_fd = fsrc.fileno()
+        dst_fd = fdst.fileno()
+        for method in (_copy_file_range, _sendfile):
+            if _kernel_copy(method, src_fd, dst_fd, block_size, state):
+                state.flush()
+                return state.copied
+
+    _userspace_copy(fsrc, fdst, block_size, state, hasher)
+    state.flush()
+    return state.copied
@@ -0,0 +1,148 @@
+"""Transports used to read repository images"""
+from __future__ import annotations
+import io
+import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
+from .transfer import pread_exact
+from .constants import HTTP_CONNECTIONS, HTTP_CHUNK_SIZE, HTTP_RETRIES
+
+if typing.TYPE_CHECKING:
+    from .repositories import Image
+
+class FileTransport:
+    """Reads images through the mounted repository"""
+    name = "file"
+
+    def open(self, image: Image, offset=0):
+        """opens remote image for sequential reading from offset"""
+        _f = open(image.remote_path, "rb", buffering=0)
+        _f.seek(offset)
+        return _f
+
+    def read_range(self, image: Image, view: memoryview, offset: int) -> int:
+        """reads len(view) bytes of remote image at offset"""
+        with open(image.remote_path, "rb", buffering=0) as _f:
+            return pread_exact(_f.fileno(), view, offset)
+
+class HttpTransport:
+    """Reads images from the failrp server, one image is downloaded
+        over several connections using HTTP range requests"""
+    name = "http"
+
+    def __init__(self, link: str, connections=HTTP_CONNECTIONS, chunk_size=HTTP_CHUNK_SIZE):
+        if connections < 1:
+            raise ValueError(f"Invalid connection count: {connections}")
+
+        self.link = link
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, image: Image) -> str:
+        """returns download url of an image"""
+        return f"{self.link}/images/{quote(image.name)}"
+
+    def fetch(self, url: str, offset: int, length: int, retries=HTTP_RETRIES) -> bytes:
+        """downloads length bytes at offset"""
+        error = None
+        for _ in range(retries + 1):
+            try:
+                req = self.session.get(url, timeout=60,
+                                       headers={"Range": f"bytes={offset}-{offset + length - 1}"})
+                if req.status_code != 206:
+                    raise IOError(f"Range request for {url} failed: HTTP {req.status_code}")
+
+                if len(req.content) != length:
+                    raise IOError(f"Short range response from {url}: \
+                                  {len(req.content)} of {length} bytes")
+
+                return req.content
+            except (IOError, requests.RequestException) as ex:
+                error = ex
+
+        raise IOError(f"Failed to download {url}") from error
+
+    def open(self, image: Image, offset=0):
+        """opens remote image for sequential reading from offset"""
+        url = self.url(image)
+        return RangedReader(lambda chunk_offset, length: self.fetch(url, chunk_offset, length),
+                            offset, image.repository_size, self.chunk_size, self.connections)
+
+    def read_range(self, image: Image, view: memoryview, offset: int) -> int:
+        """reads len(view) bytes of remote image at offset"""
+        length = min(len(view), image.repository_size - offset)
+        if length <= 0:
+            return 0
+
+        data = self.fetch(self.url(image), offset, length)
+        view[:len(data)] = data
+        return len(data)
+
+class RangedReader(io.RawIOBase):
+    """Sequential reader fetching the chunks ahead of it in parallel.
+        fetch(offset, length) returns the bytes of one chunk, chunks are
+        aligned to chunk_size so they can be verified individually"""
+    def __init__(self, fetch: "typing.Callable[[int, int], bytes]", offset: int, size: int,
+                 chunk_size: int, connections: int):
+        super().__init__()
+        self.fetch = fetch
+        self.size = size
+        self.chunk_size = chunk_size
+        self.next_offset = offset
+        self.window = connections * 2
+        self.pending = deque()
+        self.buffer = memoryview(b"")
+        self.buffer_pos = 0
+        self.pool = ThreadPoolExecutor(max_workers=connections,
+                                       thread_name_prefix="ranged-reader")
+        self._schedule()
+
+    def _schedule(self):
+        """keeps window chunks in flight"""
+        while len(self.pending) < self.window and self.next_offset < self.size:
+            boundary = (self.next_offset // self.chunk_size + 1) * self.chunk_size
+            length = min(boundary, self.size) - self.next_offset
+            self.pending.append(self.pool.submit(self.fetch, self.next_offset, length))
+            self.next_offset += length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.buffer_pos >= len(self.buffer):
+            if not self.pending:
+                return 0
+
+            self.buffer = memoryview(self.pending.popleft().result())
+            self.buffer_pos = 0
+            self._schedule()
+
+        size = min(len(buffer), len(self.buffer) - self.buffer_pos)
+        buffer[:size] = self.buffer[self.buffer_pos:self.buffer_pos + size]
+        self.buffer_pos += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pending.clear()
+        super().close()
+
+def get_transport(name: str, link: "str | None" = None):
+    """returns image transport by name"""
+    if name == FileTransport.name:
+        return FileTransport()
+
+    if name == HttpTransport.name:
+        if not link:
+            raise ValueError("HTTP transport needs a server link")
+        return HttpTransport(link)
+
+    raise ValueError(f"Unknown image transport: '{name}'")
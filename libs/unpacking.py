@@ -0,0 +1,287 @@
+"""Streaming archive extraction with progress callbacks"""
+import os
+import os.path as path
+import stat
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, Future
+from .constants import UNPACK_WORKERS, UNPACK_BUFFER_SIZE, UNPACK_INLINE_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# extension -> tarfile stream mode, None for zip
+ARCHIVE_FORMATS = {
+    ".zip": None,
+    ".tar": "r|",
+    ".tar.gz": "r|gz",
+    ".tgz": "r|gz",
+    ".tar.bz2": "r|bz2",
+    ".tbz2": "r|bz2",
+    ".tar.xz": "r|xz",
+    ".txz": "r|xz",
+    ".tar.zst": "zst",
+    ".tzst": "zst",
+}
+
+def supported_formats() -> "list[str]":
+    """returns archive extensions which can be unpacked"""
+    return [ext for ext, mode in ARCHIVE_FORMATS.items() if mode != "zst" or zstandard]
+
+def archive_format(file: str) -> "str | None":
+    """returns the archive extension of file, None if it can't be unpacked"""
+    name = path.basename(file).lower()
+    for ext in supported_formats():
+        if name.endswith(ext):
+            return ext
+    return None
+
+def _safe_path(destination: str, name: str) -> str:
+    """returns where an archive member goes, refusing paths outside destination.
+        the last component is not resolved, links in the archive replace it"""
+    name = path.normpath(name)
+    parent = path.realpath(path.join(destination, path.dirname(name)))
+    root = path.realpath(destination)
+    if path.isabs(name) or (parent != root and not parent.startswith(root + os.sep)) \
+        or path.basename(name) == "..":
+        raise ValueError(f"Archive member '{name}' points outside of the destination")
+    return path.join(parent, path.basename(name))
+
+class _Progress:
+    """Thread safe byte and file counter, calls back at most every interval seconds"""
+    def __init__(self, callback, total, interval=0.1):
+        self.callback = callback
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.files = 0
+        self.reported = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, size=0, files=0):
+        """records size unpacked bytes and files finished files"""
+        with self._lock:
+            self.done += size
+            self.files += files
+            now = time.monotonic()
+            if self.callback and now - self.reported >= self.interval:
+                self.reported = now
+                self.callback(self.done, self.total, self.files)
+
+    def flush(self):
+        """reports the final state"""
+        if self.callback:
+            self.callback(self.done, self.total, self.files)
+
+def _set_attributes(target: str, mode=None, mtime=None, owner=None):
+    """applies the owner (uid, gid), mode and modification time of a member to target,
+        owners are only restored when running as root"""
+    if owner is not None and os.geteuid() == 0:
+        os.chown(target, *owner, follow_symlinks=False)
+
+    if path.islink(target):
+        return
+
+    if mode is not None:
+        os.chmod(target, mode)
+
+    if mtime is not None:
+        os.utime(target, (mtime, mtime))
+
+def _set_directory_attributes(directories: "list[tuple[str, int | None, float | None, tuple | None]]"):
+    """applies directory attributes once every member is written, deepest first,
+        so read-only modes and times aren't undone by writing their children"""
+    for target, mode, mtime, owner in sorted(directories, reverse=True):
+        _set_attributes(target, mode, mtime, owner)
+
+def _zip_mtime(info: zipfile.ZipInfo) -> float:
+    """returns the modification time of a zip member, stored in local time"""
+    return time.mktime(info.date_time + (0, 0, -1))
+
+def _write(source, target: str, state: "_Progress | None" = None, mode=None, mtime=None,
+           owner=None):
+    """copies a member stream into target, replacing whatever was there.
+        hard links to an earlier member keep its content"""
+    if path.lexists(target):
+        os.unlink(target)
+
+    with open(target, "wb") as _f:
+        while True:
+            block = source.read(UNPACK_BUFFER_SIZE)
+            if not block:
+                break
+            _f.write(block)
+            if state:
+                state.update(len(block))
+
+    _set_attributes(target, mode, mtime, owner)
+
+def _unpack_zip(archive: str, destination: str, callback=None, workers=UNPACK_WORKERS):
+    """extracts zip members in parallel, each worker reads its own
+        contiguous slice of the archive front to back"""
+    with zipfile.ZipFile(archive) as _zip:
+        # The last member of a name wins, like extracting them in order
+        latest = {info.filename: info for info in _zip.infolist()}
+        members = sorted(latest.values(), key=lambda info: info.header_offset)
+
+    state = _Progress(callback, sum([info.file_size for info in members]))
+
+    # Directories first, members may come before their parents
+    directories = []
+    for info in members:
+        target = _safe_path(destination, info.filename)
+        os.makedirs(target if info.is_dir() else path.dirname(target), exist_ok=True)
+        if info.is_dir():
+            directories.append((target, (info.external_attr >> 16) & 0o7777 or None,
+                                _zip_mtime(info), None))
+
+    # Links are created once every file is written, so no file is written through one
+    links = [info for info in members if stat.S_ISLNK(info.external_attr >> 16)]
+    files = [info for info in members if not info.is_dir() and info not in links]
+    size = sum([info.compress_size for info in files])
+    slices, current, current_size = [], [], 0
+    for info in files:
+        current.append(info)
+        current_size += info.compress_size
+        if current_size >= size / workers:
+            slices.append(current)
+            current, current_size = [], 0
+    if current:
+        slices.append(current)
+
+    def _extract(members: "list[zipfile.ZipInfo]"):
+        with open(archive, "rb", buffering=UNPACK_BUFFER_SIZE) as _f:
+            os.posix_fadvise(_f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            with zipfile.ZipFile(_f) as _zip:
+                for info in members:
+                    mode = (info.external_attr >> 16) & 0o7777 or None
+                    with _zip.open(info) as source:
+                        _write(source, _safe_path(destination, info.filename), state, mode,
+                               _zip_mtime(info))
+                    state.update(files=1)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="unpack") as pool:
+        for future in [pool.submit(_extract, members) for members in slices]:
+            future.result()
+
+    with zipfile.ZipFile(archive) as _zip:
+        for info in links:
+            target = _safe_path(destination, info.filename)
+            if path.lexists(target):
+                os.unlink(target)
+            os.symlink(_zip.read(info).decode("utf-8"), target)
+            state.update(info.file_size, files=1)
+
+    _set_directory_attributes(directories)
+    state.flush()
+
+class _CountingReader:
+    """Counts bytes read from the compressed stream"""
+    def __init__(self, _f, state: _Progress):
+        self._f = _f
+        self.state = state
+
+    def read(self, size=-1):
+        block = self._f.read(size)
+        self.state.update(len(block))
+        return block
+
+def _unpack_tar(archive: str, destination: str, mode: str, callback=None,
+                workers=UNPACK_WORKERS):
+    """extracts a tar stream in one sequential pass, small files are
+        written by worker threads while the stream is decompressed"""
+    # Only the compressed size is known up front
+    state = _Progress(callback, path.getsize(archive))
+    in_flight = threading.BoundedSemaphore(workers * 4)
+
+    def _write_small(data: bytes, target: str, member: tarfile.TarInfo):
+        try:
+            if path.lexists(target):
+                os.unlink(target)
+            with open(target, "wb") as _f:
+                _f.write(data)
+            _set_attributes(target, stat.S_IMODE(member.mode), member.mtime,
+                            (member.uid, member.gid))
+            state.update(files=1)
+        finally:
+            in_flight.release()
+
+    with open(archive, "rb", buffering=UNPACK_BUFFER_SIZE) as _raw, \
+        ThreadPoolExecutor(max_workers=workers, thread_name_prefix="unpack") as pool:
+        os.posix_fadvise(_raw.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        source = _CountingReader(_raw, state)
+        if mode == "zst":
+            source = zstandard.ZstdDecompressor().stream_reader(source)
+            mode = "r|"
+
+        # Small files written in background by target, members touching
+        # a target wait for its write so links and later members see it
+        pending: "dict[str, Future]" = {}
+
+        def _settle(target: str):
+            future = pending.pop(target, None)
+            if future is not None:
+                future.result()
+
+        directories = []
+        with tarfile.open(fileobj=source, mode=mode) as _tar:
+            for member in _tar:
+                target = _safe_path(destination, member.name)
+                owner = (member.uid, member.gid)
+                _settle(target)
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                    directories.append((target, stat.S_IMODE(member.mode), member.mtime, owner))
+                    continue
+
+                os.makedirs(path.dirname(target), exist_ok=True)
+                if member.issym():
+                    if path.lexists(target):
+                        os.unlink(target)
+                    os.symlink(member.linkname, target)
+                    _set_attributes(target, owner=owner)
+                elif member.islnk():
+                    link_source = _safe_path(destination, member.linkname)
+                    _settle(link_source)
+                    if path.lexists(target):
+                        os.unlink(target)
+                    os.link(link_source, target)
+                elif member.isfile():
+                    data = _tar.extractfile(member)
+                    if member.size <= UNPACK_INLINE_SIZE:
+                        in_flight.acquire()
+                        pending[target] = pool.submit(_write_small, data.read(), target, member)
+                        continue
+                    _write(data, target, mode=stat.S_IMODE(member.mode), mtime=member.mtime,
+                           owner=owner)
+                # Devices and fifos are skipped
+                state.update(files=1)
+
+        for future in pending.values():
+            future.result()
+
+    _set_directory_attributes(directories)
+    state.flush()
+
+def unpack(archive: str, destination: str, callback=None, workers=UNPACK_WORKERS):
+    """Extracts archive into destination.
+        callback(done, total, files) reports progress, done and total are
+        uncompressed bytes for zip and archive bytes for tar streams"""
+    if callback is not None and not callable(callback):
+        raise ValueError("callback is not callable")
+
+    ext = archive_format(archive)
+    if ext is None:
+        raise NotImplementedError(f"Archive format of '{archive}' not supported. \
+                                  Supported formats: '{', '.join(supported_formats())}'")
+
+    os.makedirs(destination, exist_ok=True)
+    mode = ARCHIVE_FORMATS[ext]
+    if mode is None:
+        _unpack_zip(archive, destination, callback, workers)
+    else:
+        _unpack_tar(archive, destination, mode, callback, workers)
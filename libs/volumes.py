@@ -1,7 +1,15 @@
 """Utility Classes for managing Volumes"""
-from .partitioning import Disk, Partition
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from .partitioning import Disk, Partition, get_topology
+from .pretty import setup
+from sh import mount, umount
 import yaml
 
+wrapper, print, console, status, logger, progress = setup()
+
 class Volume:
     """Defines a Volume"""
     def __init__(self, name: str, target: "Partition | None", index: int):
@@ -14,6 +22,13 @@ class Volume:
         """Checks if volume exists on computer"""
         return self.target is not None
 
+class MountSession:
+    """A volume mount shared by consecutive operations"""
+    def __init__(self, part: Partition, mount_path: str):
+        self.part = part
+        self.mount_path = mount_path
+        self.refs = 0
+
 def parse_volume_file(volume_file: str) -> "list[Volume]":
     """Parses a Volume Definition yaml file"""
     volumes = []
@@ -38,6 +53,9 @@ class VolumeManager:
         self.root = root_drive
         self.local_repo = local_repo
         self.volumes = {}
+        # Volumes stay mounted between operations, keyed by partition path
+        self.mounts: "dict[str, MountSession]" = {}
+        self._mounts_lock = threading.Lock()
 
         if volume_file:
             self.sync(volume_file)
@@ -51,20 +69,60 @@ class VolumeManager:
             for volume in volumes:
                 self.volumes[volume.name] = volume
 
+        topology = get_topology()
         for name, volume in self.volumes.items():
-            target_path = f"{self.root.path}{volume.index}"
-            target_part = None
-            for part in self.root.partitions:
-                if part.path.startswith(self.root.path) and part.path.endswith(str(volume.index)):
-                    if self.local_repo is not None and self.local_repo.path.startswith(self.root.path) and self.local_repo.path.endswith(str(volume.index)):
-                        raise ValueError(f"Volume {name} targets the local image repository. \
-                                        Executing operations on this partition is not allowed.")
-
-                    target_part = part
-                    break
+            target_part = topology.partition(self.root.path, volume.index)
+            if target_part is not None and self.local_repo is not None and \
+                target_part.path == self.local_repo.path:
+                raise ValueError(f"Volume {name} targets the local image repository. \
+                                Executing operations on this partition is not allowed.")
 
             volume.target = target_part
 
+    @contextmanager
+    def mounted(self, part: Partition):
+        """yields the mount path of a partition, mounting it unless a
+            previous operation left it mounted"""
+        with self._mounts_lock:
+            session = self.mounts.get(part.path)
+            if session is None:
+                mount_path = tempfile.mkdtemp()
+                logger.info(f"Mounting {part.path} at {mount_path}")
+                try:
+                    mount(part.path, mount_path)
+                except Exception:
+                    os.rmdir(mount_path)
+                    raise
+                session = MountSession(part, mount_path)
+                self.mounts[part.path] = session
+            session.refs += 1
+
+        try:
+            yield session.mount_path
+        finally:
+            with self._mounts_lock:
+                session.refs -= 1
+
+    def release(self, part: Partition):
+        """unmounts a partition, e.g. before its raw device is written"""
+        with self._mounts_lock:
+            session = self.mounts.get(part.path)
+            if session is None:
+                return
+
+            if session.refs:
+                raise RuntimeError(f"Volume {part.path} is still in use")
+
+            umount(session.mount_path)
+            os.rmdir(session.mount_path)
+            del self.mounts[part.path]
+            logger.info(f"Unmounted {part.path}")
+
+    def release_all(self):
+        """unmounts every volume"""
+        for session in list(self.mounts.values()):
+            self.release(session.part)
+
     def get(self, name, default=None):
         """returns given volume from name"""
         return self.volumes.get(name, default)
@@ -1,19 +1,317 @@
+import gzip
+import hashlib
+import json
 import os
-from flask import Flask, render_template
+import threading
+import time
+from flask import Flask, send_from_directory, request, jsonify, Response
+
+# Same directory the clients mount over NFS
+IMAGE_REPOSITORY = os.environ.get("FAILRP_IMAGES", "images")
+
+# Peers are forgotten when they stop announcing themselves
+PEER_TTL = 120
+
+peers = {}
+peers_lock = threading.Lock()
+
+# Configs are read from disk again only when a file changes
+CONFIG_REPOSITORY = "rpository"
+VOLUME_FILE = "volumes.yaml"
+
+bundle = {}
+bundle_lock = threading.Lock()
+
+# Client run reports, one JSON object per line
+REPORTS_FILE = os.environ.get("FAILRP_REPORTS", "reports.jsonl")
+PERCENTILES = [50, 90, 99]
+
+reports = []
+reports_lock = threading.Lock()
+reports_loaded = False
 
 app = Flask(__name__, template_folder="views")
 app.debug = True
 
+def _config_state():
+    """returns what identifies the current version of every config file"""
+    files = [os.path.join(CONFIG_REPOSITORY, name) for name in sorted(os.listdir(CONFIG_REPOSITORY))]
+    files.append(VOLUME_FILE)
+    stats = [(file, os.stat(file)) for file in files]
+    return [(file, stat.st_mtime_ns, stat.st_size) for file, stat in stats]
+
+def get_bundle():
+    """returns all configs and the volume file, reloaded if any file changed"""
+    state = _config_state()
+    with bundle_lock:
+        if bundle.get("state") != state:
+            configs = {}
+            for name in sorted(os.listdir(CONFIG_REPOSITORY)):
+                with open(os.path.join(CONFIG_REPOSITORY, name), "r", encoding="utf-8") as _f:
+                    configs[name] = _f.read()
+
+            with open(VOLUME_FILE, "r", encoding="utf-8") as _f:
+                volumes = _f.read()
+
+            body = json.dumps({"configs": configs, "volumes": volumes}).encode("utf-8")
+            bundle.update({
+                "state": state,
+                "configs": configs,
+                "volumes": volumes,
+                "body": body,
+                "gzip": gzip.compress(body),
+                "etag": hashlib.sha256(body).hexdigest()
+            })
+
+        return bundle
+
+def get_reports() -> list:
+    """returns every stored run report, read from the store on first use"""
+    global reports_loaded
+    with reports_lock:
+        if not reports_loaded:
+            if os.path.exists(REPORTS_FILE):
+                with open(REPORTS_FILE, "r", encoding="utf-8") as _f:
+                    for line in _f:
+                        try:
+                            reports.append(json.loads(line))
+                        except ValueError:
+                            # Torn write, skip the line
+                            continue
+            reports_loaded = True
+
+        return list(reports)
+
+def percentile(values: list, rank: int):
+    """returns the nearest-rank percentile of values"""
+    values = sorted(values)
+    index = max(0, -(-rank * len(values) // 100) - 1)
+    return values[index]
+
+def _operations(name: "str | None" = None):
+    """yields (report, operation) of every stored operation"""
+    for report in get_reports():
+        for operation in report.get("operations", []):
+            if name is None or operation.get("operation") == name:
+                yield report, operation
+
+def _summary(values: list) -> dict:
+    """returns count, mean and percentiles of values"""
+    summary = {"count": len(values), "mean": sum(values) / len(values)}
+    for rank in PERCENTILES:
+        summary[f"p{rank}"] = percentile(values, rank)
+    return summary
+
+def _transfers(name: str, overlapped: "list | None" = None):
+    """yields (report, operation, MB/s) of every successful transfer by name operations.
+        operations which ran alongside others shared the bandwidth, they are
+        left out and collected into overlapped instead"""
+    for report, operation in _operations(name):
+        if operation.get("error") or not operation.get("transferred") \
+            or not operation.get("duration"):
+            continue
+
+        if operation.get("overlapped"):
+            if overlapped is not None:
+                overlapped.append((report, operation))
+            continue
+
+        yield report, operation, operation["transferred"] / 1024**2 / operation["duration"]
+
+def _bandwidth(name: str) -> dict:
+    """returns MB/s achieved by name operations for every image,
+        with the number of overlapped operations left out"""
+    samples, overlapped = {}, []
+    for _, operation, rate in _transfers(name, overlapped):
+        samples.setdefault(operation["image"], []).append((rate, operation["transferred"]))
+
+    shared = {}
+    for _, operation in overlapped:
+        shared[operation["image"]] = shared.get(operation["image"], 0) + 1
+
+    return {image: {**_summary([rate for rate, _ in values]),
+                    "bytes": sum([size for _, size in values]),
+                    "overlapped": shared.get(image, 0)}
+            for image, values in samples.items()}
+
+def image_bandwidth() -> dict:
+    """returns MB/s achieved by pulls of every image"""
+    return _bandwidth("PullOperation")
+
+def deploy_bandwidth() -> dict:
+    """returns MB/s achieved by deploys of every image"""
+    return _bandwidth("DeployOperation")
+
+def client_bandwidth() -> dict:
+    """returns MB/s achieved by pulls of every client, slow clients stand out here"""
+    samples = {}
+    for report, _, rate in _transfers("PullOperation"):
+        samples.setdefault(report.get("host"), []).append(rate)
+
+    return {host: _summary(values) for host, values in samples.items()}
+
+def deploy_durations() -> dict:
+    """returns deploy duration percentiles of every config"""
+    samples = {}
+    for report, operation in _operations("DeployOperation"):
+        if operation.get("error") or operation.get("duration") is None:
+            continue
+        samples.setdefault(report.get("config"), []).append(operation["duration"])
+
+    return {config: _summary(values) for config, values in samples.items()}
+
+def cache_hits() -> dict:
+    """returns the cache hit ratio of every room, configs stand in for rooms clients don't report"""
+    counts = {}
+    for report, operation in _operations():
+        if operation.get("cache_hit") is None:
+            continue
+        room = report.get("room") or report.get("config")
+        hits, total = counts.get(room, (0, 0))
+        counts[room] = (hits + bool(operation["cache_hit"]), total + 1)
+
+    return {room: {"hits": hits, "total": total, "ratio": hits / total}
+            for room, (hits, total) in counts.items()}
+
+def _label(value) -> str:
+    """returns value escaped for a prometheus label"""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
 @app.route("/configs/<config>")
 def host_file(config: str):
-    with open(f"rpository/{config}", "r", encoding="utf-8") as _f:
-        return _f.read()
-    
+    configs = get_bundle()["configs"]
+    if config not in configs:
+        return "", 404
+    return configs[config]
+
 @app.route("/configs/")
 def list_files():
-    return os.listdir("rpository")
+    return list(get_bundle()["configs"])
+
+@app.route("/bundle")
+def host_bundle():
+    current = get_bundle()
+    headers = {"ETag": f'"{current["etag"]}"', "Vary": "Accept-Encoding"}
+    if request.if_none_match.contains(current["etag"]):
+        return Response(status=304, headers=headers)
+
+    body = current["body"]
+    if "gzip" in request.accept_encodings:
+        body = current["gzip"]
+        headers["Content-Encoding"] = "gzip"
+
+    return Response(body, mimetype="application/json", headers=headers)
 
 @app.route("/labels")
 def host_label():
-    with open(f"volumes.yaml", "r", encoding="utf-8") as _f:
-        return _f.read()
\ No newline at end of file
+    return get_bundle()["volumes"]
+
+@app.route("/images/<image>")
+def host_image(image: str):
+    # conditional responses handle Range requests for parallel downloads
+    return send_from_directory(IMAGE_REPOSITORY, image, conditional=True)
+
+@app.route("/peers/", methods=["POST"])
+def register_peer():
+    data = request.get_json(force=True, silent=True)
+    port = data.get("port") if isinstance(data, dict) else None
+    if not isinstance(port, int) or not 0 < port < 65536 \
+       or not isinstance(data.get("images", {}), dict):
+        return "Invalid peer", 400
+
+    peer = f"http://{request.remote_addr}:{port}"
+    with peers_lock:
+        peers[peer] = {"images": data.get("images", {}), "seen": time.time()}
+    return "", 204
+
+@app.route("/peers/<image>")
+def find_peers(image: str):
+    image_hash = request.args.get("hash")
+    if not image_hash:
+        return "Invalid peer lookup", 400
+
+    requester = f"http://{request.remote_addr}:{request.args.get('port')}"
+    now = time.time()
+    with peers_lock:
+        for peer in [peer for peer, info in peers.items() if now - info["seen"] > PEER_TTL]:
+            del peers[peer]
+
+        return jsonify([peer for peer, info in peers.items()
+                        if peer != requester and info["images"].get(image) == image_hash])
+
+@app.route("/reports", methods=["POST"])
+def store_report():
+    report = request.get_json(force=True, silent=True)
+    if not isinstance(report, dict) or not isinstance(report.get("operations"), list):
+        return "Invalid report", 400
+
+    report["address"] = request.remote_addr
+    report["received"] = time.time()
+    get_reports()
+    with reports_lock:
+        with open(REPORTS_FILE, "a", encoding="utf-8") as _f:
+            _f.write(json.dumps(report) + "\n")
+        reports.append(report)
+    return "", 204
+
+@app.route("/reports/images")
+def report_images():
+    return jsonify(image_bandwidth())
+
+@app.route("/reports/deploys")
+def report_deploys():
+    return jsonify(deploy_bandwidth())
+
+@app.route("/reports/clients")
+def report_clients():
+    return jsonify(client_bandwidth())
+
+@app.route("/reports/configs")
+def report_configs():
+    return jsonify(deploy_durations())
+
+@app.route("/reports/rooms")
+def report_rooms():
+    return jsonify(cache_hits())
+
+@app.route("/metrics")
+def host_metrics():
+    lines = [
+        "# HELP failrp_reports_total Run reports received",
+        "# TYPE failrp_reports_total counter",
+        f"failrp_reports_total {len(get_reports())}",
+        "# HELP failrp_image_bandwidth_mbps Transfer rate of images in MB/s",
+        "# TYPE failrp_image_bandwidth_mbps summary"
+    ]
+    images = image_bandwidth()
+    for image, summary in images.items():
+        for rank in PERCENTILES:
+            lines.append(f'failrp_image_bandwidth_mbps{{image="{_label(image)}",quantile="{rank / 100}"}} {summary[f"p{rank}"]}')
+        lines.append(f'failrp_image_bandwidth_mbps_sum{{image="{_label(image)}"}} {summary["mean"] * summary["count"]}')
+        lines.append(f'failrp_image_bandwidth_mbps_count{{image="{_label(image)}"}} {summary["count"]}')
+
+    lines += [
+        "# HELP failrp_image_transferred_bytes Bytes of images transferred",
+        "# TYPE failrp_image_transferred_bytes counter"
+    ]
+    for image, summary in images.items():
+        lines.append(f'failrp_image_transferred_bytes{{image="{_label(image)}"}} {summary["bytes"]}')
+
+    lines += [
+        "# HELP failrp_deploy_duration_seconds Duration of image deploys",
+        "# TYPE failrp_deploy_duration_seconds summary"
+    ]
+    for config, summary in deploy_durations().items():
+        for rank in PERCENTILES:
+            lines.append(f'failrp_deploy_duration_seconds{{config="{_label(config)}",quantile="{rank / 100}"}} {summary[f"p{rank}"]}')
+        lines.append(f'failrp_deploy_duration_seconds_sum{{config="{_label(config)}"}} {summary["mean"] * summary["count"]}')
+        lines.append(f'failrp_deploy_duration_seconds_count{{config="{_label(config)}"}} {summary["count"]}')
+
+    lines += [
+        "# HELP failrp_cache_hit_ratio Share of image operations served from the local cache",
+        "# TYPE failrp_cache_hit_ratio gauge"
+    ]
+    for room, counts in cache_hits().items():
+        lines.append(f'failrp_cache_hit_ratio{{room="{_label(room)}"}} {counts["ratio"]}')
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
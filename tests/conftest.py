@@ -0,0 +1,10 @@
+"""Shared test setup"""
+import os
+import sys
+from os.path import dirname, abspath, join
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Deploys are never run by the tests, but libs.imaging resolves ocs-sr on import
+os.environ.setdefault("FAILRP_OCS_SR", join(ROOT, "benchmarks", "fake-ocs-sr"))
@@ -0,0 +1,67 @@
+"""Tests of the on-disk config cache"""
+import json
+from libs import rpfile
+from libs.repositories import ConfigRepository
+
+SOURCE = "PULL ubuntu.img\n"
+
+def cached_repository(tmp_path):
+    cache_path = str(tmp_path / "configs.json")
+    repo = ConfigRepository("localhost", "1", cache_path=cache_path)
+    repo.configs = repo._compile({"RPFile.linux": SOURCE})
+    repo.volume_file = "volumes: {}"
+    repo.etag = '"abc"'
+    repo.save_cache()
+    return cache_path
+
+def test_cache_round_trip(tmp_path):
+    repo = ConfigRepository("localhost", "1", cache_path=cached_repository(tmp_path))
+
+    assert list(repo.configs) == ["RPFile.linux"]
+    assert repo.configs["RPFile.linux"].required_images == ["ubuntu.img"]
+    assert repo.volume_file == "volumes: {}"
+    assert repo.etag == '"abc"'
+
+def test_truncated_cache_is_ignored(tmp_path):
+    cache_path = cached_repository(tmp_path)
+    with open(cache_path, "r+", encoding="utf-8") as _f:
+        _f.truncate(20)
+
+    repo = ConfigRepository("localhost", "1", cache_path=cache_path)
+    assert repo.configs == {}
+    assert repo.etag is None
+
+def test_tampered_cache_is_ignored(tmp_path):
+    cache_path = cached_repository(tmp_path)
+    with open(cache_path, "r", encoding="utf-8") as _f:
+        data = json.load(_f)
+    data["configs"]["RPFile.linux"]["steps"] = [["RUN", "reboot"]]
+    with open(cache_path, "w", encoding="utf-8") as _f:
+        json.dump(data, _f)
+
+    repo = ConfigRepository("localhost", "1", cache_path=cache_path)
+    assert repo.configs == {}
+
+def test_old_format_cache_is_ignored(tmp_path):
+    cache_path = tmp_path / "configs.json"
+    cache_path.write_bytes(b"\x80\x04\x95 not json")
+
+    repo = ConfigRepository("localhost", "1", cache_path=str(cache_path))
+    assert repo.configs == {}
+
+def test_cache_hit_skips_parsing(tmp_path, monkeypatch):
+    cache_path = cached_repository(tmp_path)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("cached config was parsed again")
+    monkeypatch.setattr(rpfile, "RPFileParser", _fail)
+    monkeypatch.setattr(rpfile.RPFile, "compile", _fail)
+
+    repo = ConfigRepository("localhost", "1", cache_path=cache_path)
+    assert repo.configs["RPFile.linux"].required_images == ["ubuntu.img"]
+
+def test_unchanged_synced_config_is_not_parsed_again(tmp_path):
+    repo = ConfigRepository("localhost", "1", cache_path=cached_repository(tmp_path))
+    cached = repo.configs["RPFile.linux"]
+
+    assert repo._compile({"RPFile.linux": SOURCE})["RPFile.linux"] is cached
@@ -0,0 +1,90 @@
+"""Tests of cache eviction policies"""
+import pytest
+from libs.eviction import UsageHistory, get_policy, plan_eviction, DEFAULT_BANDWIDTH
+from libs.repositories import ImageRepository
+
+MB = 1024**2
+
+class FakeImage:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+@pytest.fixture
+def images():
+    return [FakeImage("small.img", 10 * MB), FakeImage("large.img", 100 * MB),
+            FakeImage("medium.img", 40 * MB)]
+
+@pytest.fixture
+def usage(tmp_path):
+    usage = UsageHistory(str(tmp_path / "usage.json"))
+    usage.images = {
+        "small.img": {"uses": 9, "last_used": 100},
+        "large.img": {"uses": 1, "last_used": 300},
+        "medium.img": {"uses": 1, "last_used": 200},
+    }
+    return usage
+
+def names(images):
+    return [image.name for image in images]
+
+@pytest.mark.parametrize("policy, expected", [
+    ("size", ["large.img", "medium.img", "small.img"]),
+    ("lru", ["small.img", "medium.img", "large.img"]),
+    # Equal use counts fall back to recency
+    ("lfu", ["medium.img", "large.img", "small.img"]),
+    # (uses + 1) * size at the default bandwidth: 100, 200 and 80 MB
+    ("cost", ["medium.img", "small.img", "large.img"]),
+])
+def test_policy_order(images, usage, policy, expected):
+    assert names(get_policy(policy).order(images, usage)) == expected
+
+def test_pinned_images_go_last(images, usage):
+    order = get_policy("size").order(images, usage, pins={"large.img"})
+
+    assert names(order) == ["medium.img", "small.img", "large.img"]
+
+def test_cost_uses_measured_bandwidth(images, usage):
+    # large.img comes from a far slower server than the rest
+    usage.record_pull("large.img", 100 * MB, 100)
+    usage.record_pull("medium.img", 40 * MB, 0.4)
+
+    assert names(get_policy("cost").order(images, usage))[-1] == "large.img"
+    assert usage.bandwidth_of("small.img") < DEFAULT_BANDWIDTH
+
+def test_plan_evicts_until_enough_is_free(images, usage):
+    policy = get_policy("size")
+
+    assert names(plan_eviction(images, 60 * MB, 20 * MB, policy, usage)) == ["large.img"]
+    assert names(plan_eviction(images, 60 * MB, 70 * MB, policy, usage)) == []
+    assert names(plan_eviction(images, 60 * MB, 20 * MB, policy, usage,
+                               disallowed_deletions=["large.img"])) == ["medium.img", "small.img"]
+
+def test_impossible_plan(images, usage):
+    assert plan_eviction(images, 200 * MB, 20 * MB, get_policy("lru"), usage) is None
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        get_policy("random")
+
+def test_history_persists(tmp_path, usage):
+    usage.record_use("small.img")
+    usage.record_pull("small.img", 10 * MB, 1)
+    usage.save()
+
+    reloaded = UsageHistory(usage.history_path)
+    assert reloaded.get("small.img")["uses"] == 10
+    assert reloaded.bandwidth_of("small.img") == 10 * MB
+
+def test_sync_forgets_removed_images_only(tmp_path):
+    repo_path, storage_path = tmp_path / "repo", tmp_path / "cache"
+    repo_path.mkdir()
+    storage_path.mkdir()
+    (repo_path / "ubuntu.img").write_bytes(b"ubuntu")
+    repo = ImageRepository(str(repo_path), str(storage_path))
+    for name in ("ubuntu.img", "removed.img"):
+        repo.touch(name)
+
+    repo.sync()
+
+    assert list(UsageHistory(repo.usage.history_path).images) == ["ubuntu.img"]
@@ -0,0 +1,136 @@
+"""Tests of operation compilation and pull-through planning"""
+import hashlib
+import os
+from types import SimpleNamespace
+from libs import execution
+from libs.execution import RPFileExecutor, DeployOperation, PullOperation, CopyOperation
+from libs.metrics import OperationMetrics
+from libs.repositories import ImageRepository, write_image_hash
+from libs.rpfile import PullInstruction, DeployInstruction, CopyInstruction
+from libs.scheduling import OperationGraph
+from libs.volumes import Volume
+
+class FakeImage:
+    def __init__(self, name, cached=False):
+        self.name = name
+        self.available_remote = True
+        self.available_local = cached
+        self.outdated = False
+
+class FakeImageRepository:
+    def __init__(self, *images):
+        self.images = {image.name: image for image in images}
+
+    def get(self, name, default=None):
+        return self.images.get(name, default)
+
+class FakeVolumeManager:
+    def get(self, name, default=None):
+        return Volume(name, SimpleNamespace(path=f"/dev/{name}"), 1)
+
+    def release(self, target):
+        pass
+
+OPERATIONS = {
+    "PULL": (PullOperation, PullInstruction),
+    "DEPLOY": (DeployOperation, DeployInstruction),
+    "COPY": (CopyOperation, CopyInstruction),
+}
+
+def build(executor, *lines):
+    """returns operations of RPFile lines like ("PULL", "a.img")"""
+    operations = []
+    for instruction_type, *params in lines:
+        operation_class, instruction_class = OPERATIONS[instruction_type]
+        instruction = instruction_class(list(params))
+        operation = operation_class(executor, instruction)
+        operation.instruction = instruction
+        operations.append(operation)
+    return operations
+
+def linux_executor(cached=False):
+    repo = FakeImageRepository(*[FakeImage(name, cached) for name in
+                                 ("ubuntu.img", "exams.zip", "windows.qcow2", "linux.qcow2")])
+    return RPFileExecutor(None, repo, FakeVolumeManager())
+
+LINUX = [
+    ("PULL", "ubuntu.img"),
+    ("PULL", "exams.zip"),
+    ("PULL", "windows.qcow2"),
+    ("PULL", "linux.qcow2"),
+    ("DEPLOY", "ubuntu.img", "system"),
+    ("COPY", "windows.qcow2", "system:/VMs/"),
+]
+
+def test_pull_through_merges_pull_into_deploy():
+    executor = linux_executor()
+    merged = RPFileExecutor._plan_pull_through(build(executor, *LINUX))
+
+    assert [type(_op) for _op in merged] == [PullOperation] * 3 + [DeployOperation, CopyOperation]
+    assert merged[3].pull_through
+
+def test_pull_through_deploy_does_not_wait_for_unrelated_pulls():
+    executor = linux_executor()
+    graph = OperationGraph(RPFileExecutor._plan_pull_through(build(executor, *LINUX)))
+
+    assert graph.dependencies[3] == set()
+
+def test_deploy_waits_for_its_own_pull():
+    executor = linux_executor()
+    graph = OperationGraph(build(executor, *LINUX))
+
+    assert graph.dependencies[4] == {0}
+    # The copy needs the deployed volume and the pulled image
+    assert graph.dependencies[5] == {2, 4}
+
+def test_cached_images_are_not_pulled_through():
+    executor = linux_executor(cached=True)
+    merged = RPFileExecutor._plan_pull_through(build(executor, *LINUX))
+
+    assert len(merged) == len(LINUX)
+    assert not any(getattr(_op, "pull_through", False) for _op in merged)
+
+def test_corrupted_pull_through_copy_is_not_cached(tmp_path):
+    repo_path, storage_path = tmp_path / "repo", tmp_path / "cache"
+    repo_path.mkdir()
+    storage_path.mkdir()
+    (repo_path / "ubuntu.img").write_bytes(b"restored image")
+    # The repository hash doesn't match what the copy reads
+    write_image_hash(str(repo_path / "ubuntu.img"), hashlib.sha256(b"other image").hexdigest())
+    image_repo = ImageRepository(str(repo_path), str(storage_path), eager_mode=True)
+    executor = RPFileExecutor(SimpleNamespace(required_images=["ubuntu.img"]), image_repo,
+                              FakeVolumeManager())
+    executor.executed_operations, executor.running_operations = [], []
+    deploy, = build(executor, ("DEPLOY", "ubuntu.img", "system"))
+    deploy.pull_through = True
+
+    deploy._pull()
+
+    assert not image_repo.get("ubuntu.img").available_local
+    assert [name for name in os.listdir(storage_path) if name.startswith("ubuntu.img")] == []
+
+def test_deploy_counts_unterminated_last_progress_line(monkeypatch):
+    def fake_deploy(image, target, source, io, image_path):
+        io("err")("Block size: 4096 Byte\n")
+        # ocs-sr exits right after redrawing its final progress line
+        io("err")("Elapsed: 00:00:02, Remaining: 00:00:00, Completed: 100.00%, 1.00GB/min,\r"
+                  "current block:  256, total block:  256, Complete: 100.00%")
+    monkeypatch.setattr(execution, "deploy_image", fake_deploy)
+    executor = linux_executor(cached=True)
+    deploy, = build(executor, ("DEPLOY", "ubuntu.img", "system"))
+    deploy.image.best_path = "ubuntu.img"
+    deploy.metrics = OperationMetrics(0, "DeployOperation", "DEPLOY ubuntu.img system")
+
+    deploy.execute()
+
+    assert deploy.metrics.transferred == 256 * 4096
+
+def test_deploy_survives_broken_output_handling(monkeypatch):
+    def fake_deploy(image, target, source, io, image_path):
+        io("err")(None)
+    monkeypatch.setattr(execution, "deploy_image", fake_deploy)
+    executor = linux_executor(cached=True)
+    deploy, = build(executor, ("DEPLOY", "ubuntu.img", "system"))
+    deploy.image.best_path = "ubuntu.img"
+
+    deploy.execute()
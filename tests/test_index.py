@@ -0,0 +1,95 @@
+"""Tests of the persistent image metadata index"""
+import hashlib
+import json
+import os
+import pytest
+from libs import repositories
+from libs.index import ImageIndex, INDEX_VERSION, stat_key
+from libs.repositories import ImageRepository, write_image_hash, read_image_hash
+
+def test_entries_are_valid_for_their_key_only(tmp_path):
+    image_path = tmp_path / "image.img"
+    image_path.write_bytes(b"image")
+    index = ImageIndex(str(tmp_path / "index.json"))
+    key = stat_key(os.stat(image_path))
+    index.update(str(image_path), key, 5, "hash")
+
+    assert index.lookup(str(image_path), key)["hash"] == "hash"
+    # Same size, newer mtime
+    os.utime(image_path, ns=(0, os.stat(image_path).st_mtime_ns + 1))
+    assert index.lookup(str(image_path), stat_key(os.stat(image_path))) is None
+    # Replaced by a new file of the same size and mtime
+    stat = os.stat(image_path)
+    assert index.lookup(str(image_path), [stat.st_ino + 1, stat.st_size, stat.st_mtime_ns]) is None
+
+def test_index_persists_changes_only(tmp_path):
+    index_path = str(tmp_path / "index.json")
+    index = ImageIndex(index_path)
+    index.save()
+    assert not os.path.exists(index_path)
+
+    index.update("/cache/a.img", [1, 2, 3], 2, "a")
+    index.update("/cache/b.img", [4, 5, 6], 5, "b")
+    index.prune({"/cache/a.img"})
+    index.save()
+
+    reloaded = ImageIndex(index_path)
+    assert list(reloaded.entries) == ["/cache/a.img"]
+    assert reloaded.lookup("/cache/a.img", [1, 2, 3])["size"] == 2
+
+@pytest.mark.parametrize("content", ["{broken", json.dumps({"version": INDEX_VERSION + 1,
+                                                            "entries": {"a": {}}})])
+def test_unreadable_index_is_empty(tmp_path, content):
+    index_path = tmp_path / "index.json"
+    index_path.write_text(content)
+
+    assert ImageIndex(str(index_path)).entries == {}
+
+@pytest.fixture
+def repository(tmp_path):
+    repo_path, storage_path = tmp_path / "repo", tmp_path / "cache"
+    repo_path.mkdir()
+    storage_path.mkdir()
+    (repo_path / "ubuntu.img").write_bytes(b"ubuntu")
+    write_image_hash(str(repo_path / "ubuntu.img"), "remote-hash")
+    (storage_path / "ubuntu.img").write_bytes(b"cached ubuntu")
+    return str(repo_path), str(storage_path)
+
+def fail(*args):
+    raise AssertionError("unchanged image was read again")
+
+def test_unchanged_images_are_revalidated_by_stat(repository, monkeypatch):
+    repo_path, storage_path = repository
+    repo = ImageRepository(repo_path, storage_path, eager_mode=True)
+    expected = hashlib.sha256(b"cached ubuntu").hexdigest()
+    assert repo.get("ubuntu.img").local_hash == expected
+    assert read_image_hash(os.path.join(storage_path, "ubuntu.img")) == expected
+
+    monkeypatch.setattr(repositories, "read_image_hash", fail)
+    monkeypatch.setattr(repositories, "compute_hash", fail)
+    # A restarted client only has the index on disk
+    image = ImageRepository(repo_path, storage_path, eager_mode=True).get("ubuntu.img")
+
+    assert image.remote_hash == "remote-hash"
+    assert image.local_hash == expected
+
+def test_changed_sidecar_is_read_again(repository):
+    repo_path, storage_path = repository
+    repo = ImageRepository(repo_path, storage_path, eager_mode=True)
+    hash_path = os.path.join(repo_path, "ubuntu.img.sha256")
+    write_image_hash(os.path.join(repo_path, "ubuntu.img"), "new-hash")
+    os.utime(hash_path, ns=(0, os.stat(hash_path).st_mtime_ns + 1000))
+
+    repo.sync()
+
+    assert repo.get("ubuntu.img").remote_hash == "new-hash"
+
+def test_removed_images_leave_the_index(repository):
+    repo_path, storage_path = repository
+    repo = ImageRepository(repo_path, storage_path, eager_mode=True)
+    assert repo.get("ubuntu.img").local_hash
+    os.remove(os.path.join(storage_path, "ubuntu.img"))
+
+    repo.sync()
+
+    assert os.path.join(storage_path, "ubuntu.img") not in ImageIndex(repo.index.index_path).entries
@@ -0,0 +1,84 @@
+"""Tests of operation metrics and run reports"""
+import json
+import os
+from libs.metrics import OperationMetrics, RunReport
+
+def timed(index, started, duration, parent=None, transferred=0):
+    metrics = OperationMetrics(index, "PullOperation", f"PULL {index}.img", f"{index}.img",
+                               cache_hit=False, parent=parent)
+    metrics.started, metrics.duration = started, duration
+    metrics.transferred = transferred
+    return metrics
+
+def test_throughput_from_reported_bytes():
+    metrics = timed(0, 0, 2, transferred=4 * 1024**2)
+
+    assert metrics.throughput == 2
+
+def test_throughput_falls_back_to_process_io():
+    metrics = timed(0, 0, 2)
+    metrics.io = {"read_bytes": 2 * 1024**2, "write_bytes": 6 * 1024**2}
+
+    assert metrics.throughput == 3
+
+def test_unfinished_operation_has_no_throughput():
+    metrics = OperationMetrics(0, "PullOperation", "PULL a.img")
+    metrics.start()
+
+    assert metrics.throughput is None
+
+def test_finish_records_error_and_io_delta():
+    metrics = OperationMetrics(0, "PullOperation", "PULL a.img")
+    metrics.start()
+    metrics.finish(IOError("disk full"))
+
+    assert metrics.duration >= 0
+    assert metrics.error == "OSError: disk full"
+    assert all(value >= 0 for value in metrics.io.values())
+
+def test_overlapping_operations_are_marked():
+    report = RunReport()
+    first, second, later = timed(0, 0, 10), timed(1, 5, 10), timed(2, 20, 5)
+    for metrics in (first, second, later):
+        report.add(metrics)
+
+    report.finish(True)
+
+    assert first.overlapped and second.overlapped
+    assert not later.overlapped
+
+def test_cache_copy_does_not_overlap_its_deploy():
+    report = RunReport()
+    deploy = timed(0, 0, 10)
+    copy = timed(0, 1, 5, parent=0)
+    report.add(deploy)
+    report.add(copy)
+
+    report.finish(True)
+
+    assert not deploy.overlapped and not copy.overlapped
+
+def test_cache_copy_overlaps_other_operations():
+    report = RunReport()
+    copy = timed(0, 1, 5, parent=0)
+    pull = timed(1, 2, 1)
+    report.add(copy)
+    report.add(pull)
+
+    report.finish(True)
+
+    assert copy.overlapped and pull.overlapped
+
+def test_write_sorts_operations(tmp_path):
+    report = RunReport("RPFile.linux", "lab")
+    report.add(timed(1, 0, 1))
+    report.add(timed(0, 0, 1))
+    report.finish(False)
+
+    report_path = report.write(str(tmp_path))
+
+    with open(report_path, "r", encoding="utf-8") as _f:
+        data = json.load(_f)
+    assert [operation["index"] for operation in data["operations"]] == [0, 1]
+    assert data["config"] == "RPFile.linux" and data["room"] == "lab" and not data["success"]
+    assert os.listdir(tmp_path) == [os.path.basename(report_path)]
@@ -0,0 +1,121 @@
+"""Tests of multicast image distribution and its unicast repair"""
+import hashlib
+import os
+import threading
+import pytest
+from libs import multicast
+from libs.multicast import HEADER, END_OF_PASS, MulticastTransport, repair_reads, image_id
+from libs.repositories import Image, PullCancelled
+from libs.transports import FileTransport
+
+GROUP = "239.255.42.1"
+INTERFACE = "127.0.0.1"
+PAYLOAD = multicast.MULTICAST_PAYLOAD
+DATA = os.urandom(PAYLOAD * 40 + 100)
+
+class RecordingTransport(FileTransport):
+    def __init__(self):
+        self.reads = []
+        self.opened = False
+
+    def open(self, image, offset=0):
+        self.opened = True
+        return super().open(image, offset)
+
+    def read_range(self, image, view, offset):
+        self.reads.append((offset, len(view)))
+        return super().read_range(image, view, offset)
+
+def make_image(tmp_path):
+    remote_path = str(tmp_path / "image.img")
+    with open(remote_path, "wb") as _f:
+        _f.write(DATA)
+    return Image("image.img", remote_path, None, hashlib.sha256(DATA).hexdigest(), None)
+
+def send(port, image, packets):
+    """sends (offset, length, payload) packets followed by the last end of pass"""
+    sock = multicast._multicast_socket(interface=INTERFACE)
+    packet_id = image_id(image.remote_hash)
+    for offset, length, payload in packets:
+        sock.sendto(HEADER.pack(packet_id, offset, length) + payload, (GROUP, port))
+    for _ in range(multicast.END_OF_PASS_REPEATS):
+        sock.sendto(HEADER.pack(packet_id, END_OF_PASS, 0), (GROUP, port))
+    sock.close()
+
+def receive(port, image, destination, packets, repair, cancel=None):
+    transport = MulticastTransport(GROUP, port, repair, interface=INTERFACE)
+    try:
+        receiver = multicast.MulticastReceiver(GROUP, port, image.remote_hash, 1, os.devnull,
+                                               interface=INTERFACE)
+        receiver.close()
+    except OSError:
+        pytest.skip("multicast is not available")
+
+    sender = threading.Timer(0.2, send, (port, image, packets))
+    sender.start()
+    try:
+        return transport.receive(image, destination, cancel=cancel)
+    finally:
+        sender.join()
+
+def packets(offsets):
+    return [(offset, min(PAYLOAD, len(DATA) - offset), DATA[offset:offset + PAYLOAD])
+            for offset in offsets]
+
+def test_repair_reads_are_chunk_aligned():
+    ranges = [(10, 20), (100, 50), (1000, 100), (4090, 20), (9000, 100)]
+    assert repair_reads(ranges, 9100, chunk_size=4096) == [
+        (0, 4096, 176),
+        (4096, 4096, 14),
+        (8192, 908, 100),
+    ]
+
+def test_missing_packets_are_repaired_in_chunks(tmp_path):
+    image = make_image(tmp_path)
+    destination = str(tmp_path / "image.img.part")
+    repair = RecordingTransport()
+    offsets = [offset for offset in range(0, len(DATA), PAYLOAD) if offset // PAYLOAD % 3]
+
+    assert receive(45801, image, destination, packets(offsets), repair)
+    with open(destination, "rb") as _f:
+        assert _f.read() == DATA
+    assert repair.reads == [(0, len(DATA))]
+
+def test_malformed_packets_are_ignored(tmp_path):
+    image = make_image(tmp_path)
+    destination = str(tmp_path / "image.img.part")
+    good = packets(range(0, len(DATA), PAYLOAD))
+    bad = [(0, PAYLOAD, b"\0" * (PAYLOAD - 1)),
+           (PAYLOAD, PAYLOAD - 1, b"\0" * (PAYLOAD - 1)),
+           (2 * PAYLOAD, PAYLOAD + 50, b"\0" * PAYLOAD)]
+
+    assert receive(45802, image, destination, bad + good, RecordingTransport())
+    with open(destination, "rb") as _f:
+        assert _f.read() == DATA
+
+def test_cancel_stops_receiving(tmp_path):
+    image = make_image(tmp_path)
+    cancel = threading.Event()
+    cancel.set()
+
+    with pytest.raises(PullCancelled):
+        receive(45803, image, str(tmp_path / "image.img.part"), [], RecordingTransport(), cancel)
+
+class SilentTransport(MulticastTransport):
+    """Multicast transport of a group nobody sends to"""
+    def receive(self, image, destination, progress_callback=None, cancel=None):
+        with open(destination, "wb") as _f:
+            _f.truncate(image.repository_size)
+        return False
+
+def test_pull_without_sender_uses_repair_transport(tmp_path):
+    image = make_image(tmp_path)
+    repair = RecordingTransport()
+    destination = str(tmp_path / "cache.img")
+
+    image.pull(destination, transport=SilentTransport(GROUP, 45804, repair))
+
+    assert repair.opened
+    assert image.local_hash == image.remote_hash
+    with open(destination, "rb") as _f:
+        assert _f.read() == DATA
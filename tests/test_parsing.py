@@ -0,0 +1,69 @@
+"""Tests of the ocs-sr progress parser"""
+from libs.parsing import OcsProgressParser, ProgressEvent
+
+TIME_LINE = "Elapsed: 00:01:00, Remaining: 00:01:00, Completed:  50.00%,   1.00GB/min,"
+BLOCK_LINE = "current block:  1,024, total block:  2,048, Complete:  50.00%"
+
+def progress(events):
+    return [event for event in events if isinstance(event, ProgressEvent)]
+
+def test_done_bytes_from_blocks():
+    parser = OcsProgressParser()
+    events = parser.feed(f"Block size:   4096 Byte\n{TIME_LINE}\n{BLOCK_LINE}\r")
+
+    assert progress(events)[-1].done_bytes == 1024 * 4096
+
+def test_done_bytes_from_rate_without_block_size():
+    parser = OcsProgressParser()
+    events = progress(parser.feed(f"{TIME_LINE}\n{BLOCK_LINE}\r"))
+
+    assert events[-1].done_bytes == 1024**3
+
+def test_progress_line_fields():
+    parser = OcsProgressParser()
+    event, = parser.feed("Elapsed: 00:01:02, Remaining: 01:00:00, Completed:   9.37%,  2.50GB/min,\n")
+
+    assert event.elapsed.total_seconds() == 62
+    assert event.remaining.total_seconds() == 3600
+    assert event.completed == 9.37 and event.rate == 2.5
+    assert event.current_block is None and not event.finished
+
+def test_rate_in_megabytes():
+    parser = OcsProgressParser()
+    event, = parser.feed("Elapsed: 00:00:01, Remaining: 00:00:01, Completed: 50.00%, Rate: 512.00MB/min,\n")
+
+    assert event.rate == 0.5
+
+def test_block_line_extends_last_progress():
+    parser = OcsProgressParser()
+    events = parser.feed(f"{TIME_LINE}\r{BLOCK_LINE}\r")
+
+    assert len(events) == 2
+    assert events[1].completed == 50.0 and events[1].rate == 1.0
+    assert (events[1].current_block, events[1].total_block) == (1024, 2048)
+    assert events[1].complete_block == 50.0
+
+def test_block_line_before_any_progress_is_ignored():
+    assert OcsProgressParser().feed(f"{BLOCK_LINE}\n") == []
+
+def test_lines_split_across_chunks():
+    parser = OcsProgressParser()
+    assert parser.feed(TIME_LINE[:20]) == []
+
+    event, = parser.feed(TIME_LINE[20:] + "\r")
+    assert event.completed == 50.0
+
+def test_output_lines_and_escapes():
+    parser = OcsProgressParser()
+    events = parser.feed("\x1b[1mStarting restore\x1b[0m\n\n\x1b[A" + TIME_LINE + "\n")
+
+    assert events[0].text == "Starting restore"
+    assert isinstance(events[1], ProgressEvent)
+    assert len(events) == 2
+
+def test_flush_parses_unterminated_line():
+    parser = OcsProgressParser()
+    parser.feed("Elapsed: 00:02:00, Remaining: 00:00:00, Completed: 100.00%, 1.00GB/min,")
+    event, = parser.flush()
+
+    assert event.finished
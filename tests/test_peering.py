@@ -0,0 +1,99 @@
+"""Tests of reading images from peers"""
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from libs.peering import PeerTransport
+from libs.repositories import Image, write_chunk_manifest
+
+CHUNK_SIZE = 1024
+DATA = bytes(range(256)) * 18
+
+class FakeRegistry:
+    def __init__(self, peers):
+        self.peers = peers
+        self.lookups = 0
+
+    def find(self, name, __hash):
+        self.lookups += 1
+        return list(self.peers)
+
+class FakePeerTransport(PeerTransport):
+    """Serves peer ranges from memory, peers map a link to their copy of the image"""
+    def __init__(self, peers, **kwargs):
+        super().__init__("http://server", FakeRegistry(peers), connections=4, **kwargs)
+        self.peers = peers
+        self.requests = []
+
+    def fetch(self, url, offset, length, retries=0):
+        peer = url.split("/images/")[0]
+        self.requests.append(peer)
+        data = self.peers[peer]
+        if data is None:
+            raise IOError(f"{peer} is down")
+        return data[offset:offset + length]
+
+def make_image(tmp_path):
+    remote_path = str(tmp_path / "image.img")
+    with open(remote_path, "wb") as _f:
+        _f.write(DATA)
+
+    chunks = [hashlib.sha256(DATA[i:i + CHUNK_SIZE]).hexdigest()
+              for i in range(0, len(DATA), CHUNK_SIZE)]
+    write_chunk_manifest(remote_path, CHUNK_SIZE, chunks)
+    return Image("image.img", remote_path, None, "hash", None)
+
+def corrupt(data):
+    return b"\0" * CHUNK_SIZE + data[CHUNK_SIZE:]
+
+def test_open_skips_corrupted_and_failed_peers(tmp_path):
+    transport = FakePeerTransport({"http://a": corrupt(DATA), "http://b": None, "http://c": DATA})
+    with transport.open(make_image(tmp_path)) as reader:
+        assert reader.read() == DATA
+
+    assert transport.source(make_image(tmp_path)).bad == {"http://a", "http://b"}
+
+def test_open_falls_back_without_peers(tmp_path):
+    transport = FakePeerTransport({})
+    with transport.open(make_image(tmp_path)) as reader:
+        assert reader.read() == DATA
+    assert transport.requests == []
+
+def test_read_range_uses_peers(tmp_path):
+    transport = FakePeerTransport({"http://a": DATA})
+    buffer = bytearray(CHUNK_SIZE)
+
+    assert transport.read_range(make_image(tmp_path), memoryview(buffer), CHUNK_SIZE) == CHUNK_SIZE
+    assert bytes(buffer) == DATA[CHUNK_SIZE:2 * CHUNK_SIZE]
+    assert transport.requests == ["http://a"]
+
+def test_read_range_falls_back_when_peers_are_corrupted(tmp_path):
+    transport = FakePeerTransport({"http://a": corrupt(DATA)})
+    image = make_image(tmp_path)
+    buffer = bytearray(2 * CHUNK_SIZE)
+
+    assert transport.read_range(image, memoryview(buffer), 0) == 2 * CHUNK_SIZE
+    assert bytes(buffer) == DATA[:2 * CHUNK_SIZE]
+    assert transport.source(image).bad == {"http://a"}
+
+def test_read_range_last_partial_chunk(tmp_path):
+    transport = FakePeerTransport({"http://a": DATA})
+    offset = len(DATA) // CHUNK_SIZE * CHUNK_SIZE
+    buffer = bytearray(CHUNK_SIZE)
+
+    assert transport.read_range(make_image(tmp_path), memoryview(buffer), offset) == len(DATA) - offset
+    assert bytes(buffer[:len(DATA) - offset]) == DATA[offset:]
+    assert transport.requests == ["http://a"]
+
+def test_concurrent_reads_share_one_lookup(tmp_path):
+    transport = FakePeerTransport({"http://a": None, "http://b": DATA})
+    image = make_image(tmp_path)
+
+    def read(offset):
+        buffer = bytearray(CHUNK_SIZE)
+        read = transport.read_range(image, memoryview(buffer), offset)
+        return bytes(buffer[:read])
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        chunks = list(pool.map(read, range(0, len(DATA), CHUNK_SIZE)))
+
+    assert b"".join(chunks) == DATA
+    assert transport.registry.lookups == 1
@@ -0,0 +1,80 @@
+"""Tests of whole-RPFile cache space planning"""
+from types import SimpleNamespace
+from libs.constants import PART_SIG
+from libs.eviction import LargestFirstPolicy, UsageHistory
+from libs.execution import RPFileExecutor
+from libs.planning import plan_storage
+from libs.repositories import Image
+
+MB = 1024**2
+
+class FakeImageRepository:
+    def __init__(self, storage_path, free_storage, *images):
+        self.storage_path = str(storage_path)
+        self.free_storage = free_storage
+        self.images = {image.name: image for image in images}
+        self.policy = LargestFirstPolicy()
+        self.usage = UsageHistory(None)
+        self.pins = set()
+
+    def get(self, name, default=None):
+        return self.images.get(name, default)
+
+    def get_locals(self):
+        return [image for image in self.images.values() if image.available_local]
+
+def remote(name, size):
+    return Image(name, f"/repo/{name}", None, "new", None, remote_size=size)
+
+def cached(name, size):
+    return Image(name, f"/repo/{name}", f"/cache/{name}", "same", "same",
+                 remote_size=size, local_size=size)
+
+def test_plan_fits_without_evictions(tmp_path):
+    repo = FakeImageRepository(tmp_path, 100 * MB, remote("a.img", 30 * MB))
+    plan = plan_storage(repo, ["a.img"])
+
+    assert [image.name for image in plan.pulls] == ["a.img"]
+    assert plan.evictions == [] and plan.fits
+    assert plan.required == 30 * MB
+
+def test_plan_never_evicts_protected_images(tmp_path):
+    repo = FakeImageRepository(tmp_path, 10 * MB, remote("a.img", 60 * MB),
+                               cached("used.img", 80 * MB), cached("unused.img", 70 * MB))
+    plan = plan_storage(repo, ["a.img"], ["used.img"])
+
+    assert [image.name for image in plan.evictions] == ["unused.img"]
+    assert plan.protected == {"a.img", "used.img"}
+
+def test_plan_skips_pulls_that_cannot_fit(tmp_path):
+    repo = FakeImageRepository(tmp_path, 10 * MB, remote("a.img", 20 * MB),
+                               remote("huge.img", 500 * MB), cached("used.img", 80 * MB))
+    plan = plan_storage(repo, ["a.img", "huge.img"], ["used.img"])
+
+    assert [image.name for image in plan.pulls] == []
+    assert [image.name for image in plan.skipped] == ["a.img", "huge.img"]
+
+    plan = plan_storage(repo, ["a.img", "huge.img"])
+    assert [image.name for image in plan.pulls] == ["a.img"]
+    assert [image.name for image in plan.skipped] == ["huge.img"]
+    assert [image.name for image in plan.evictions] == ["used.img"]
+
+def test_partial_pulls_only_need_the_remainder(tmp_path):
+    with open(tmp_path / f"a.img{PART_SIG}", "wb") as _f:
+        _f.truncate(20 * MB)
+    repo = FakeImageRepository(tmp_path, 15 * MB, remote("a.img", 30 * MB))
+    plan = plan_storage(repo, ["a.img"])
+
+    assert plan.required == 10 * MB and plan.fits
+
+def test_runtime_evictions_keep_planned_images(tmp_path):
+    repo = FakeImageRepository(tmp_path, 10 * MB, remote("a.img", 60 * MB),
+                               cached("used.img", 80 * MB), cached("unused.img", 70 * MB))
+    rpfile = SimpleNamespace(required_images=["a.img", "used.img"])
+    executor = RPFileExecutor(rpfile, repo, None)
+    executor.executed_operations, executor.running_operations = [], []
+
+    assert set(executor.protected_images()) == {"a.img", "used.img"}
+
+    executor.plan = plan_storage(repo, ["a.img"], rpfile.required_images)
+    assert set(executor.protected_images()) == {"a.img", "used.img"}
@@ -0,0 +1,31 @@
+"""Tests of prefetching while the picker is on screen"""
+import logging
+import threading
+from libs.prefetch import _HeldLogs
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def test_background_logs_are_held_until_released():
+    handler = ListHandler()
+    root = logging.getLogger()
+    root.addHandler(handler)
+    logger = logging.getLogger("rich")
+    held = _HeldLogs()
+    try:
+        held.hold()
+        thread = threading.Thread(target=logger.warning, args=("from prefetch",))
+        thread.start()
+        thread.join()
+        logger.warning("from picker")
+        assert handler.messages == ["from picker"]
+
+        held.release()
+        assert handler.messages == ["from picker", "from prefetch"]
+    finally:
+        root.removeHandler(handler)
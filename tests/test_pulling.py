@@ -0,0 +1,212 @@
+"""Tests of verified image pulls"""
+import hashlib
+import os
+import threading
+import pytest
+from libs.repositories import Image, ImageVerificationError, PullCancelled, read_image_hash, \
+    read_checkpoint, write_checkpoint, publish_image, read_chunk_manifest, write_chunk_manifest
+from libs.transports import FileTransport
+
+DATA = os.urandom(300 * 1024)
+BLOCK_SIZE = 64 * 1024
+
+class FlakyTransport(FileTransport):
+    """Corrupts the first failures reads of the image"""
+    def __init__(self, failures):
+        self.failures = failures
+        self.opened = 0
+
+    def open(self, image, offset=0):
+        self.opened += 1
+        if self.opened > self.failures:
+            return super().open(image, offset)
+
+        corrupt_path = image.remote_path + ".corrupt"
+        with open(corrupt_path, "wb") as _f:
+            _f.write(bytes([DATA[0] ^ 0xff]) + DATA[1:])
+        _f = open(corrupt_path, "rb", buffering=0)
+        _f.seek(offset)
+        return _f
+
+class RecordingTransport(FileTransport):
+    """Records the offsets images are opened at"""
+    def __init__(self):
+        self.offsets = []
+
+    def open(self, image, offset=0):
+        self.offsets.append(offset)
+        return super().open(image, offset)
+
+class RangeTransport(FileTransport):
+    """Records the offsets of range reads"""
+    def __init__(self):
+        self.ranges = []
+
+    def read_range(self, image, view, offset):
+        self.ranges.append(offset)
+        return super().read_range(image, view, offset)
+
+def make_image(tmp_path, remote_hash=None):
+    remote_path = str(tmp_path / "image.img")
+    with open(remote_path, "wb") as _f:
+        _f.write(DATA)
+    return Image("image.img", remote_path, None,
+                 remote_hash or hashlib.sha256(DATA).hexdigest(), None)
+
+def cached(tmp_path):
+    return sorted([name for name in os.listdir(tmp_path) if name.startswith("cached.img")])
+
+def test_verified_pull_commits_copy_and_hash(tmp_path):
+    image = make_image(tmp_path)
+    destination = str(tmp_path / "cached.img")
+    progress = []
+
+    image.pull(destination, progress_callback=lambda *args: progress.append(args),
+               block_size=BLOCK_SIZE)
+
+    with open(destination, "rb") as _f:
+        assert _f.read() == DATA
+    assert read_image_hash(destination) == image.remote_hash
+    assert image.local_hash == image.remote_hash and not image.outdated
+    assert progress[-1][1:] == (len(DATA), len(DATA))
+    assert cached(tmp_path) == ["cached.img", "cached.img.sha256"]
+
+def test_corrupted_read_is_retried(tmp_path):
+    image = make_image(tmp_path)
+    transport = FlakyTransport(failures=1)
+    destination = str(tmp_path / "cached.img")
+
+    image.pull(destination, transport=transport, block_size=BLOCK_SIZE)
+
+    assert transport.opened == 2
+    with open(destination, "rb") as _f:
+        assert _f.read() == DATA
+
+def test_mismatched_image_is_never_committed(tmp_path):
+    image = make_image(tmp_path, remote_hash=hashlib.sha256(b"other").hexdigest())
+    destination = str(tmp_path / "cached.img")
+
+    with pytest.raises(ImageVerificationError):
+        image.pull(destination, retries=1, block_size=BLOCK_SIZE)
+
+    assert not image.available_local
+    assert cached(tmp_path) == []
+
+def test_unverified_pull_copies_as_is(tmp_path):
+    image = make_image(tmp_path, remote_hash=hashlib.sha256(b"other").hexdigest())
+    destination = str(tmp_path / "cached.img")
+
+    image.pull(destination, verify=False, block_size=BLOCK_SIZE)
+
+    with open(destination, "rb") as _f:
+        assert _f.read() == DATA
+
+def cancelled_pull(image, destination):
+    """pulls until two blocks are copied, returns the part file"""
+    cancel = threading.Event()
+    with pytest.raises(PullCancelled):
+        image.pull(destination, progress_callback=lambda *args: cancel.set(),
+                   cancel=cancel, block_size=BLOCK_SIZE)
+    return destination + ".part"
+
+def test_cancelled_pull_resumes_from_checkpoint(tmp_path):
+    image = make_image(tmp_path)
+    destination = str(tmp_path / "cached.img")
+    part_path = cancelled_pull(image, destination)
+
+    checkpoint = read_checkpoint(part_path)
+    assert checkpoint["offset"] == 2 * BLOCK_SIZE
+    assert checkpoint["hash"] == hashlib.sha256(DATA[:2 * BLOCK_SIZE]).hexdigest()
+    assert not image.available_local
+
+    transport = RecordingTransport()
+    image.pull(destination, transport=transport, block_size=BLOCK_SIZE)
+
+    assert transport.offsets == [2 * BLOCK_SIZE]
+    with open(destination, "rb") as _f:
+        assert _f.read() == DATA
+    assert cached(tmp_path) == ["cached.img", "cached.img.sha256"]
+
+def test_checkpoint_of_another_version_is_discarded(tmp_path):
+    image = make_image(tmp_path)
+    destination = str(tmp_path / "cached.img")
+    part_path = cancelled_pull(image, destination)
+    checkpoint = read_checkpoint(part_path)
+    write_checkpoint(part_path, "old-hash", checkpoint["offset"], checkpoint["hash"])
+
+    transport = RecordingTransport()
+    image.pull(destination, transport=transport, block_size=BLOCK_SIZE)
+
+    assert transport.offsets == [0]
+    with open(destination, "rb") as _f:
+        assert _f.read() == DATA
+
+def test_damaged_part_file_is_pulled_again(tmp_path):
+    image = make_image(tmp_path)
+    destination = str(tmp_path / "cached.img")
+    part_path = cancelled_pull(image, destination)
+    with open(part_path, "r+b") as _f:
+        _f.write(bytes([DATA[0] ^ 0xff]))
+
+    transport = RecordingTransport()
+    image.pull(destination, transport=transport, block_size=BLOCK_SIZE)
+
+    assert transport.offsets == [0]
+    with open(destination, "rb") as _f:
+        assert _f.read() == DATA
+
+CHUNK = 4096
+
+def make_outdated(tmp_path, old, new, chunk_size=CHUNK):
+    """returns an image cached as old while the repository has new"""
+    remote_path, local_path = str(tmp_path / "image.img"), str(tmp_path / "cached.img")
+    for file, data in ((remote_path, new), (local_path, old)):
+        with open(file, "wb") as _f:
+            _f.write(data)
+    remote_hash = publish_image(remote_path, chunk_size=CHUNK)
+    local_hash = publish_image(local_path, chunk_size=chunk_size)
+    return Image("image.img", remote_path, local_path, remote_hash, local_hash)
+
+def changed(data, *chunks):
+    data = bytearray(data)
+    for i in chunks:
+        data[i * CHUNK] ^= 0xff
+    return bytes(data)
+
+def test_delta_pull_fetches_changed_chunks(tmp_path):
+    # The new version also moves a chunk and grows by half a chunk
+    new = changed(DATA, 3, 40) + DATA[:CHUNK] + os.urandom(CHUNK // 2)
+    image = make_outdated(tmp_path, DATA, new)
+    transport = RangeTransport()
+    assert image.outdated
+
+    assert image.pull_delta(transport=transport)
+
+    assert transport.ranges == [3 * CHUNK, 40 * CHUNK, len(DATA) + CHUNK]
+    with open(image.local_path, "rb") as _f:
+        assert _f.read() == new
+    assert not image.outdated
+    assert read_image_hash(image.local_path) == image.remote_hash
+    assert read_chunk_manifest(image.local_path) == read_chunk_manifest(image.remote_path)
+    assert cached(tmp_path) == ["cached.img", "cached.img.chunks", "cached.img.sha256"]
+
+def test_delta_pull_needs_matching_manifests(tmp_path):
+    image = make_outdated(tmp_path, DATA, changed(DATA, 1), chunk_size=2 * CHUNK)
+    assert not image.pull_delta(transport=RangeTransport())
+
+    write_chunk_manifest(image.local_path, None, None)
+    assert not image.pull_delta(transport=RangeTransport())
+
+    with open(image.local_path, "rb") as _f:
+        assert _f.read() == DATA
+
+def test_damaged_cache_fails_delta_verification(tmp_path):
+    image = make_outdated(tmp_path, DATA, changed(DATA, 1))
+    # The cached copy no longer matches its own manifest
+    with open(image.local_path, "r+b") as _f:
+        _f.write(bytes([DATA[0] ^ 0xff]))
+
+    assert not image.pull_delta(transport=RangeTransport())
+
+    assert image.outdated
+    assert cached(tmp_path) == ["cached.img", "cached.img.chunks", "cached.img.sha256"]
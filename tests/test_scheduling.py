@@ -0,0 +1,103 @@
+"""Tests of dependency-aware operation scheduling"""
+import threading
+import time
+import pytest
+from libs.scheduling import OperationGraph, OperationScheduler, CACHE_RESOURCE
+
+class FakeOperation:
+    def __init__(self, *resources, exclusive=False):
+        self.resources = set(resources)
+        self.exclusive = exclusive
+
+def image(name):
+    return ("image", name)
+
+def volume(name):
+    return ("volume", name)
+
+def test_operations_depend_on_earlier_conflicts():
+    graph = OperationGraph([
+        FakeOperation(image("a"), CACHE_RESOURCE),
+        FakeOperation(image("b"), CACHE_RESOURCE),
+        FakeOperation(image("a"), volume("system")),
+        FakeOperation(image("c"), volume("data")),
+        FakeOperation(image("b"), volume("system")),
+    ])
+
+    assert graph.dependencies == [set(), {0}, {0}, set(), {1, 2}]
+
+def test_exclusive_operations_block_everything():
+    graph = OperationGraph([
+        FakeOperation(image("a")),
+        FakeOperation(exclusive=True),
+        FakeOperation(image("b")),
+    ])
+
+    assert graph.dependencies == [set(), {0}, {1}]
+
+def test_ready_waits_for_dependencies():
+    graph = OperationGraph([FakeOperation(image("a")), FakeOperation(image("a")),
+                            FakeOperation(image("b"))])
+
+    assert graph.ready(set(), set()) == [0, 2]
+    assert graph.ready({2}, {0, 2}) == []
+    assert graph.ready({0, 2}, {0, 2}) == [1]
+
+def test_scheduler_keeps_dependency_order():
+    operations = [FakeOperation(image("a")), FakeOperation(image("b")),
+                  FakeOperation(image("a")), FakeOperation(image("b"))]
+    finished = []
+    lock = threading.Lock()
+
+    def _run(i, _op):
+        time.sleep(0.01 * (4 - i))
+        with lock:
+            finished.append(i)
+
+    OperationScheduler(operations, max_workers=4).run(_run)
+
+    assert sorted(finished) == [0, 1, 2, 3]
+    assert finished.index(0) < finished.index(2)
+    assert finished.index(1) < finished.index(3)
+
+def test_scheduler_runs_independent_operations_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+
+    # Both operations only return once the other one runs too
+    OperationScheduler([FakeOperation(image("a")), FakeOperation(image("b"))],
+                       max_workers=2).run(lambda i, _op: barrier.wait())
+
+def test_scheduler_respects_worker_limit():
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    def _run(i, _op):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.02)
+        with lock:
+            running -= 1
+
+    OperationScheduler([FakeOperation(image(str(i))) for i in range(6)], max_workers=2).run(_run)
+
+    assert peak == 2
+
+def test_failure_stops_new_operations():
+    started = []
+
+    def _run(i, _op):
+        started.append(i)
+        if i == 0:
+            raise RuntimeError("deploy failed")
+
+    operations = [FakeOperation(image("a")), FakeOperation(image("a")), FakeOperation(image("a"))]
+    with pytest.raises(RuntimeError, match="deploy failed"):
+        OperationScheduler(operations, max_workers=2).run(_run)
+
+    assert started == [0]
+
+def test_invalid_worker_count():
+    with pytest.raises(ValueError):
+        OperationScheduler([], max_workers=0)
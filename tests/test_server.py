@@ -0,0 +1,178 @@
+"""Tests of the failrp server"""
+import gzip
+import json
+from types import SimpleNamespace
+import pytest
+from libs.metrics import OperationMetrics, RunReport
+from libs.repositories import ConfigRepository
+from server import server
+
+def operation(name, image, transferred, duration, **fields):
+    return {"operation": name, "image": image, "transferred": transferred,
+            "duration": duration, "cache_hit": False, "overlapped": False, **fields}
+
+def pull(image, megabytes, duration, **fields):
+    return operation("PullOperation", image, megabytes * 1024**2, duration, **fields)
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "REPORTS_FILE", str(tmp_path / "reports.jsonl"))
+    monkeypatch.setattr(server, "reports", [])
+    monkeypatch.setattr(server, "reports_loaded", False)
+    return server.app.test_client()
+
+def post(client, host, operations, config="RPFile.linux", room=None):
+    response = client.post("/reports", json={"host": host, "config": config, "room": room,
+                                             "operations": operations})
+    assert response.status_code == 204
+
+def test_invalid_report_is_refused(client):
+    assert client.post("/reports", json={"host": "a"}).status_code == 400
+    assert server.get_reports() == []
+
+def test_image_bandwidth_leaves_out_overlapped_and_failed(client):
+    post(client, "a", [pull("ubuntu.img", 100, 1), pull("exams.zip", 10, 1)])
+    post(client, "b", [pull("ubuntu.img", 50, 1),
+                       pull("ubuntu.img", 10, 1, overlapped=True),
+                       pull("ubuntu.img", 10, 1, error="OSError: disk full")])
+
+    images = client.get("/reports/images").get_json()
+
+    assert images["ubuntu.img"]["count"] == 2
+    assert images["ubuntu.img"]["mean"] == 75
+    assert images["ubuntu.img"]["p99"] == 100
+    assert images["ubuntu.img"]["bytes"] == 150 * 1024**2
+    assert images["ubuntu.img"]["overlapped"] == 1
+    assert images["exams.zip"]["count"] == 1
+
+def test_deploys_and_clients_are_aggregated_apart(client):
+    post(client, "a", [pull("ubuntu.img", 100, 1),
+                       operation("DeployOperation", "ubuntu.img", 20 * 1024**2, 2)])
+    post(client, "b", [pull("ubuntu.img", 30, 1)])
+
+    deploys = client.get("/reports/deploys").get_json()
+    clients = client.get("/reports/clients").get_json()
+
+    assert deploys["ubuntu.img"]["mean"] == 10
+    assert clients["a"]["mean"] == 100 and clients["b"]["mean"] == 30
+
+def test_overlapped_runs_stay_out_of_every_rate(client):
+    post(client, "a", [pull("ubuntu.img", 100, 1),
+                       pull("ubuntu.img", 1, 1, overlapped=True),
+                       operation("DeployOperation", "ubuntu.img", 1, 1)])
+    post(client, "b", [pull("ubuntu.img", 1, 1, overlapped=True)])
+
+    assert client.get("/reports/clients").get_json() == {
+        "a": {"count": 1, "mean": 100, "p50": 100, "p90": 100, "p99": 100}}
+    metrics = client.get("/metrics").get_data(as_text=True)
+    assert 'failrp_image_bandwidth_mbps_count{image="ubuntu.img"} 1' in metrics
+
+def test_pull_through_cache_copy_counts_as_pull(client):
+    report = RunReport()
+    deploy = OperationMetrics(0, "DeployOperation", "DEPLOY ubuntu.img system", "ubuntu.img")
+    copy = OperationMetrics(0, "PullOperation", "PULL ubuntu.img", "ubuntu.img", parent=0)
+    for metrics in (deploy, copy):
+        metrics.started, metrics.duration = 0, 2
+        metrics.add_bytes(100 * 1024**2)
+        report.add(metrics)
+    report.finish(True)
+
+    post(client, "a", report.to_dict()["operations"])
+
+    assert client.get("/reports/images").get_json()["ubuntu.img"]["mean"] == 50
+    assert client.get("/reports/deploys").get_json()["ubuntu.img"]["mean"] == 50
+
+def test_cache_hits_by_room(client):
+    post(client, "a", [pull("ubuntu.img", 1, 1, cache_hit=True),
+                       pull("exams.zip", 1, 1)], room="lab")
+    post(client, "b", [pull("ubuntu.img", 1, 1, cache_hit=True)])
+
+    rooms = client.get("/reports/rooms").get_json()
+
+    assert rooms["lab"] == {"hits": 1, "total": 2, "ratio": 0.5}
+    assert rooms["RPFile.linux"]["ratio"] == 1
+
+def test_reports_are_read_back_from_the_store(client, monkeypatch):
+    post(client, "a", [pull("ubuntu.img", 100, 1)])
+    monkeypatch.setattr(server, "reports", [])
+    monkeypatch.setattr(server, "reports_loaded", False)
+
+    assert [report["host"] for report in server.get_reports()] == ["a"]
+    assert "failrp_reports_total 1" in client.get("/metrics").get_data(as_text=True)
+
+def test_images_answer_range_requests(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "IMAGE_REPOSITORY", str(tmp_path))
+    (tmp_path / "ubuntu.img").write_bytes(bytes(range(256)) * 4)
+
+    response = client.get("/images/ubuntu.img", headers={"Range": "bytes=256-511"})
+
+    assert response.status_code == 206
+    assert response.data == bytes(range(256))
+    assert response.headers["Content-Range"] == "bytes 256-511/1024"
+
+@pytest.fixture
+def configs(tmp_path, monkeypatch):
+    config_path = tmp_path / "rpository"
+    config_path.mkdir()
+    (config_path / "RPFile.linux").write_text("PULL ubuntu.img\n")
+    (tmp_path / "volumes.yaml").write_text("volumes: {}\n")
+    monkeypatch.setattr(server, "CONFIG_REPOSITORY", str(config_path))
+    monkeypatch.setattr(server, "VOLUME_FILE", str(tmp_path / "volumes.yaml"))
+    monkeypatch.setattr(server, "bundle", {})
+    return config_path
+
+def test_bundle_revalidates_with_etag(client, configs):
+    response = client.get("/bundle")
+    etag = response.headers["ETag"]
+
+    assert response.status_code == 200
+    assert response.get_json() == {"configs": {"RPFile.linux": "PULL ubuntu.img\n"},
+                                   "volumes": "volumes: {}\n"}
+    unchanged = client.get("/bundle", headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304 and unchanged.data == b""
+
+    (configs / "RPFile.windows").write_text("PULL windows.img\n")
+    changed = client.get("/bundle", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert list(changed.get_json()["configs"]) == ["RPFile.linux", "RPFile.windows"]
+
+def test_bundle_is_gzipped_on_request(client, configs):
+    response = client.get("/bundle", headers={"Accept-Encoding": "gzip, deflate"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(response.data))["volumes"] == "volumes: {}\n"
+    assert "Content-Encoding" not in client.get("/bundle").headers
+
+class ClientSession:
+    """Sends the requests of a ConfigRepository to the test client"""
+    def __init__(self, client):
+        self.client = client
+        self.statuses = []
+
+    def get(self, url, timeout, headers=None):
+        response = self.client.get(url.removeprefix("http://server:1"), headers=headers)
+        self.statuses.append(response.status_code)
+        return SimpleNamespace(status_code=response.status_code, headers=response.headers,
+                               json=response.get_json, text=response.get_data(as_text=True),
+                               raise_for_status=lambda: None)
+
+def test_config_repository_sync_is_conditional(client, configs):
+    repo = ConfigRepository("server", "1")
+    repo.session = ClientSession(client)
+
+    repo.sync()
+    linux = repo.configs["RPFile.linux"]
+    repo.sync()
+
+    assert repo.session.statuses == [200, 304]
+    assert repo.configs["RPFile.linux"] is linux
+    assert repo.volume_file == "volumes: {}\n"
+
+def test_peer_lookup_needs_hash(client, monkeypatch):
+    monkeypatch.setattr(server, "peers", {})
+    client.post("/peers/", json={"port": 2022, "images": {"ubuntu.img": "abc"}})
+    client.post("/peers/", json={"port": 2023, "images": {}})
+
+    assert client.get("/peers/ubuntu.img?port=1").status_code == 400
+    assert client.get("/peers/windows.img?port=1&hash=abc").get_json() == []
+    assert client.get("/peers/ubuntu.img?port=1&hash=abc").get_json() == ["http://127.0.0.1:2022"]
@@ -0,0 +1,99 @@
+"""Tests of reading the block device tree from a fake sysfs root"""
+import os
+import pytest
+from libs.partitioning import SysfsHelper
+
+def write(root, relative, content):
+    file = os.path.join(root, relative)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(file, "w", encoding="utf-8") as _f:
+        _f.write(content)
+
+def add_device(root, name, dev, size, properties, parent=None, partition=None, removable="0"):
+    """adds a block device with its udev data, partitions live in their disk's directory"""
+    device_dir = f"sys/devices/virtual/block/{parent}/{name}" if parent \
+        else f"sys/devices/virtual/block/{name}"
+    write(root, f"{device_dir}/dev", dev)
+    write(root, f"{device_dir}/size", str(size))
+    if partition:
+        write(root, f"{device_dir}/partition", str(partition))
+    else:
+        write(root, f"{device_dir}/removable", removable)
+
+    os.makedirs(os.path.join(root, "sys/class/block"), exist_ok=True)
+    os.symlink(os.path.join(root, device_dir), os.path.join(root, "sys/class/block", name))
+    if properties is not None:
+        write(root, f"run/udev/data/b{dev}", "".join([f"E:{key}={value}\n"
+                                                      for key, value in properties.items()]))
+
+@pytest.fixture
+def root(tmp_path):
+    root = str(tmp_path)
+    add_device(root, "sda", "8:0", 2048, {"ID_PART_TABLE_TYPE": "gpt"})
+    add_device(root, "sda1", "8:1", 1024, {
+        "ID_FS_TYPE": "ext4",
+        "ID_FS_UUID": "fs-uuid",
+        "ID_FS_LABEL": "FAILRP_CACHE",
+        "ID_FS_LABEL_ENC": "FAILRP\\x20CACHE",
+        "ID_PART_ENTRY_UUID": "part-uuid",
+        "ID_PART_ENTRY_NAME": "cache",
+    }, parent="sda", partition=1)
+    add_device(root, "sda2", "8:2", 512, {"ID_FS_TYPE": "ntfs"}, parent="sda", partition=2)
+    add_device(root, "loop0", "7:0", 4096, {}, removable="1")
+    write(root, "proc/mounts", "/dev/sda1 /mnt/cache\\040dir ext4 rw 0 0\nproc /proc proc rw 0 0\n")
+    return root
+
+def test_tree_matches_lsblk_layout(root):
+    devices = SysfsHelper(root).call()
+
+    assert [device["path"] for device in devices] == ["/dev/loop0", "/dev/sda"]
+    loop, disk = devices
+    assert loop["type"] == "loop" and loop["rm"] and loop["children"] == []
+    assert disk["type"] == "disk" and disk["size"] == 2048 * 512
+    assert [child["path"] for child in disk["children"]] == ["/dev/sda1", "/dev/sda2"]
+
+def test_partition_properties(root):
+    cache, other = SysfsHelper(root).call()[1]["children"]
+
+    assert cache == {
+        "path": "/dev/sda1",
+        "type": "part",
+        "size": 1024 * 512,
+        "rm": False,
+        "partuuid": "part-uuid",
+        "uuid": "fs-uuid",
+        "fstype": "ext4",
+        "partlabel": "cache",
+        # Encoded properties win over the plain ones
+        "label": "FAILRP CACHE",
+        "mountpoint": "/mnt/cache dir",
+        "partn": 1,
+    }
+    assert other["fstype"] == "ntfs" and other["label"] is None and other["mountpoint"] is None
+    assert other["partn"] == 2
+
+def test_missing_udev_data_raises(root):
+    add_device(root, "sdb", "8:16", 2048, None)
+
+    with pytest.raises(LookupError):
+        SysfsHelper(root).call()
+
+def test_available_needs_udev_database(tmp_path):
+    os.makedirs(tmp_path / "sys/class/block")
+    assert not SysfsHelper(str(tmp_path)).available
+
+    os.makedirs(tmp_path / "run/udev/data")
+    assert SysfsHelper(str(tmp_path)).available
+
+def test_raid_and_nbd_are_not_disks(root):
+    add_device(root, "md0", "9:0", 4096, {})
+    write(root, "sys/devices/virtual/block/md0/md/level", "raid1\n")
+    add_device(root, "md1", "9:1", 4096, {})
+    add_device(root, "nbd0", "43:0", 4096, {})
+
+    types = {device["path"]: device["type"] for device in SysfsHelper(root).call()}
+
+    assert types["/dev/md0"] == "raid1"
+    assert types["/dev/md1"] == "raid"
+    assert types["/dev/nbd0"] == "nbd"
+    assert types["/dev/sda"] == "disk"
@@ -0,0 +1,70 @@
+"""Tests of the shared block device topology snapshot"""
+import pytest
+from libs import partitioning
+from libs.partitioning import Disk, Partition, get_topology, invalidate_topology, set_disk_types
+
+def part(_path, number, label=None):
+    return {"path": _path, "type": "part", "size": 512, "rm": False, "partuuid": None,
+            "uuid": None, "fstype": "ext4", "partlabel": None, "label": label,
+            "mountpoint": None, "partn": number}
+
+def disk(_path, _type, *children):
+    return {"path": _path, "type": _type, "size": 1024, "rm": False, "partuuid": None,
+            "uuid": None, "fstype": None, "partlabel": None, "label": None,
+            "mountpoint": None, "children": list(children)}
+
+@pytest.fixture
+def reads(monkeypatch):
+    """counts reads of the block device tree"""
+    reads = []
+    def read_block_devices():
+        reads.append(len(reads))
+        return [disk("/dev/sda", "disk", part("/dev/sda1", 1, f"read {len(reads)}"),
+                     part("/dev/sda2", 2)),
+                disk("/dev/loop0", "loop", part("/dev/loop0p1", 1))]
+
+    monkeypatch.setattr(partitioning, "read_block_devices", read_block_devices)
+    invalidate_topology()
+    yield reads
+    set_disk_types(["disk"])
+
+def test_lookups_share_one_snapshot(reads):
+    first = Partition.from_device("/dev/sda1")
+
+    assert Disk.from_partition(first) is Disk.from_device("/dev/sda")
+    assert Partition.get_all()["/dev/sda1"] is first
+    assert get_topology().partition("/dev/sda", 2).path == "/dev/sda2"
+    assert len(reads) == 1
+
+def test_invalidation_reads_again(reads):
+    assert Partition.from_device("/dev/sda1").fslabel == "read 1"
+
+    invalidate_topology()
+    assert Partition.from_device("/dev/sda1").fslabel == "read 2"
+    get_topology(refresh=True)
+    assert len(reads) == 3
+
+def test_disk_types_filter_devices(reads):
+    assert list(Disk.get_all()) == ["/dev/sda"]
+    with pytest.raises(FileNotFoundError):
+        Partition.from_device("/dev/loop0p1")
+
+    set_disk_types(["disk", "loop"])
+
+    assert Partition.from_device("/dev/loop0p1").number == 1
+    assert len(reads) == 2
+
+def test_wrong_device_kind(reads):
+    with pytest.raises(ValueError):
+        Disk.from_device("/dev/sda1")
+    with pytest.raises(ValueError):
+        Partition.from_device("/dev/sda")
+
+def test_relabeling_invalidates(reads, monkeypatch):
+    monkeypatch.setattr(partitioning, "e2label", lambda *args: None)
+    monkeypatch.setattr(partitioning, "udevadm", lambda *args: None)
+
+    Partition.from_device("/dev/sda1").set_fslabel("FAILRP_CACHE")
+    Partition.from_device("/dev/sda1")
+
+    assert len(reads) == 2
@@ -0,0 +1,101 @@
+"""Tests of the transfer engine fallbacks"""
+import errno
+import hashlib
+import io
+import os
+import pytest
+from libs.transfer import transfer
+
+DATA = os.urandom(100 * 1024)
+BLOCK_SIZE = 16 * 1024
+
+@pytest.fixture
+def files(tmp_path):
+    src_path, dst_path = tmp_path / "src", tmp_path / "dst"
+    src_path.write_bytes(DATA)
+    with open(src_path, "rb", buffering=0) as fsrc, open(dst_path, "wb", buffering=0) as fdst:
+        yield fsrc, fdst
+    assert dst_path.read_bytes() == DATA
+
+def record(monkeypatch, name, calls, fail_after=None, error=errno.EXDEV):
+    """counts calls of an os copy method, failing with error after fail_after calls"""
+    method = getattr(os, name)
+    def _method(*args):
+        calls.append(name)
+        if fail_after is not None and calls.count(name) > fail_after:
+            raise OSError(error, os.strerror(error))
+        return method(*args)
+    monkeypatch.setattr(os, name, _method)
+
+def test_copy_file_range_first(files, monkeypatch):
+    calls, progress = [], []
+    record(monkeypatch, "copy_file_range", calls)
+    record(monkeypatch, "sendfile", calls)
+
+    copied = transfer(*files, total=len(DATA), block_size=BLOCK_SIZE,
+                      callback=lambda *args: progress.append(args))
+
+    assert copied == len(DATA)
+    assert set(calls) == {"copy_file_range"}
+    assert progress[-1][1:] == (len(DATA), len(DATA))
+    assert sum([size for size, _, _ in progress]) == len(DATA)
+
+def test_sendfile_carries_on_after_copy_file_range(files, monkeypatch):
+    calls = []
+    # The filesystem gives up on copy_file_range after two blocks
+    record(monkeypatch, "copy_file_range", calls, fail_after=2)
+    record(monkeypatch, "sendfile", calls)
+
+    assert transfer(*files, block_size=BLOCK_SIZE) == len(DATA)
+    assert calls.count("copy_file_range") == 3 and "sendfile" in calls
+
+def test_userspace_when_kernel_methods_are_unsupported(files, monkeypatch):
+    calls = []
+    record(monkeypatch, "copy_file_range", calls, fail_after=0, error=errno.ENOSYS)
+    record(monkeypatch, "sendfile", calls, fail_after=0, error=errno.EINVAL)
+
+    assert transfer(*files, block_size=BLOCK_SIZE) == len(DATA)
+    assert calls == ["copy_file_range", "sendfile"]
+
+def test_hasher_reads_through_userspace(files, monkeypatch):
+    calls = []
+    record(monkeypatch, "copy_file_range", calls)
+    record(monkeypatch, "sendfile", calls)
+    hasher = hashlib.sha256()
+
+    transfer(*files, hasher=hasher, block_size=BLOCK_SIZE)
+
+    assert calls == []
+    assert hasher.hexdigest() == hashlib.sha256(DATA).hexdigest()
+
+def test_streams_without_descriptor(tmp_path):
+    with open(tmp_path / "dst", "wb", buffering=0) as fdst:
+        assert transfer(io.BytesIO(DATA), fdst, block_size=BLOCK_SIZE) == len(DATA)
+
+    assert (tmp_path / "dst").read_bytes() == DATA
+
+def test_callback_interval(files):
+    progress = []
+
+    transfer(*files, block_size=BLOCK_SIZE, callback_interval=40 * 1024,
+             callback=lambda *args: progress.append(args))
+
+    # Every report but the last covers at least one interval
+    assert all(size >= 40 * 1024 for size, _, _ in progress[:-1])
+    assert progress[-1][1] == len(DATA)
+
+def test_real_errors_are_raised(tmp_path, monkeypatch):
+    calls = []
+    record(monkeypatch, "copy_file_range", calls, fail_after=0, error=errno.EIO)
+    (tmp_path / "src").write_bytes(DATA)
+
+    with open(tmp_path / "src", "rb", buffering=0) as fsrc, \
+        open(tmp_path / "dst", "wb", buffering=0) as fdst:
+        with pytest.raises(OSError):
+            transfer(fsrc, fdst, block_size=BLOCK_SIZE)
+
+def test_invalid_callback(files):
+    fsrc, fdst = files
+    with pytest.raises(ValueError):
+        transfer(fsrc, fdst, callback="progress")
+    transfer(fsrc, fdst)
@@ -0,0 +1,94 @@
+"""Tests of the HTTP image transport"""
+import os
+from types import SimpleNamespace
+import pytest
+from libs.repositories import Image
+from libs.transports import HttpTransport, RangedReader, FileTransport, get_transport
+
+DATA = os.urandom(10000)
+CHUNK_SIZE = 1024
+
+class FakeSession:
+    """Answers range requests from DATA, responses lists overrides per request"""
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.ranges = []
+
+    def get(self, url, timeout, headers):
+        start, end = headers["Range"].removeprefix("bytes=").split("-")
+        self.ranges.append((int(start), int(end)))
+        if self.responses:
+            return self.responses.pop(0)
+        return SimpleNamespace(status_code=206, content=DATA[int(start):int(end) + 1])
+
+def make_transport(responses=()):
+    transport = HttpTransport("http://server", connections=2, chunk_size=CHUNK_SIZE)
+    transport.session = FakeSession(responses)
+    return transport
+
+def make_image():
+    return Image("ubuntu 22.img", "/mnt/repo/ubuntu 22.img", None, "hash", None,
+                 remote_size=len(DATA))
+
+def test_reader_fetches_aligned_chunks():
+    fetched = []
+    def fetch(offset, length):
+        fetched.append((offset, length))
+        return DATA[offset:offset + length]
+
+    with RangedReader(fetch, 1500, len(DATA), CHUNK_SIZE, 2) as reader:
+        assert reader.read() == DATA[1500:]
+
+    assert fetched[0] == (1500, 2048 - 1500)
+    assert all(offset % CHUNK_SIZE == 0 for offset, _ in fetched[1:])
+    assert sum([length for _, length in fetched]) == len(DATA) - 1500
+
+def test_reader_raises_fetch_errors():
+    def fetch(offset, length):
+        if offset >= 3 * CHUNK_SIZE:
+            raise IOError("connection reset")
+        return DATA[offset:offset + length]
+
+    with RangedReader(fetch, 0, len(DATA), CHUNK_SIZE, 2) as reader:
+        with pytest.raises(IOError):
+            reader.read()
+
+def test_open_reads_through_range_requests():
+    transport = make_transport()
+
+    with transport.open(make_image(), 100) as reader:
+        assert reader.read() == DATA[100:]
+
+    assert sorted(transport.session.ranges)[0] == (100, CHUNK_SIZE - 1)
+    assert transport.url(make_image()) == "http://server/images/ubuntu%2022.img"
+
+def test_read_range_stops_at_image_end():
+    transport = make_transport()
+    view = memoryview(bytearray(CHUNK_SIZE))
+
+    assert transport.read_range(make_image(), view, len(DATA) - 100) == 100
+    assert bytes(view[:100]) == DATA[-100:]
+    assert transport.read_range(make_image(), view, len(DATA)) == 0
+    assert transport.session.ranges == [(len(DATA) - 100, len(DATA) - 1)]
+
+def test_whole_file_responses_are_refused():
+    # A server ignoring Range answers 200 with the whole image
+    transport = make_transport([SimpleNamespace(status_code=200, content=DATA)] * 3)
+
+    with pytest.raises(IOError):
+        transport.fetch("http://server/images/a.img", 0, CHUNK_SIZE)
+    assert len(transport.session.ranges) == 3
+
+def test_short_responses_are_retried():
+    transport = make_transport([SimpleNamespace(status_code=206, content=DATA[:10])])
+
+    assert transport.fetch("http://server/images/a.img", 0, CHUNK_SIZE) == DATA[:CHUNK_SIZE]
+    assert len(transport.session.ranges) == 2
+
+def test_get_transport():
+    assert isinstance(get_transport("file"), FileTransport)
+    assert get_transport("http", "http://server").link == "http://server"
+    with pytest.raises(ValueError):
+        get_transport("http")
+    with pytest.raises(ValueError):
+        HttpTransport("http://server", connections=0)
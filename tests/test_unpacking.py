@@ -0,0 +1,138 @@
+"""Tests of streaming archive extraction"""
+import io
+import os
+import stat
+import tarfile
+import time
+import warnings
+import zipfile
+import pytest
+from libs.unpacking import unpack
+
+MTIME = 1000000000
+
+def add_file(_tar, name, data, mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = MTIME
+    _tar.addfile(info, io.BytesIO(data))
+
+def add_link(_tar, name, target, link_type=tarfile.LNKTYPE):
+    info = tarfile.TarInfo(name)
+    info.type = link_type
+    info.linkname = target
+    _tar.addfile(info)
+
+def make_tar(tmp_path, build, name="archive.tar.gz"):
+    archive = str(tmp_path / name)
+    with tarfile.open(archive, "w:gz" if name.endswith(".gz") else "w") as _tar:
+        build(_tar)
+    return archive
+
+def make_zip(tmp_path, build):
+    archive = str(tmp_path / "archive.zip")
+    with warnings.catch_warnings(), zipfile.ZipFile(archive, "w") as _zip:
+        warnings.simplefilter("ignore")
+        build(_zip)
+    return archive
+
+def read(file):
+    with open(file, "rb") as _f:
+        return _f.read()
+
+def test_tar_hard_links_to_small_files(tmp_path):
+    def build(_tar):
+        for i in range(50):
+            add_file(_tar, f"d/f{i:04}a", bytes([i]) * 300 * 1024)
+            add_link(_tar, f"d/f{i:04}b", f"d/f{i:04}a")
+    out = tmp_path / "out"
+
+    unpack(make_tar(tmp_path, build), str(out))
+
+    for i in range(50):
+        first, second = out / f"d/f{i:04}a", out / f"d/f{i:04}b"
+        assert read(second) == bytes([i]) * 300 * 1024
+        assert os.stat(first).st_ino == os.stat(second).st_ino
+
+def test_tar_last_duplicate_wins(tmp_path):
+    def build(_tar):
+        for i in range(20):
+            add_file(_tar, "d/file", str(i).encode() * 1000)
+    out = tmp_path / "out"
+
+    unpack(make_tar(tmp_path, build), str(out))
+
+    assert read(out / "d/file") == b"19" * 1000
+
+def test_tar_file_replacing_hard_link_keeps_target(tmp_path):
+    def build(_tar):
+        add_file(_tar, "a", b"original")
+        add_link(_tar, "b", "a")
+        add_file(_tar, "b", b"replaced")
+    out = tmp_path / "out"
+
+    unpack(make_tar(tmp_path, build), str(out))
+
+    assert read(out / "a") == b"original"
+    assert read(out / "b") == b"replaced"
+
+def test_tar_symlinks_and_attributes(tmp_path):
+    def build(_tar):
+        add_file(_tar, "bin/tool", b"#!/bin/sh\n", mode=0o750)
+        add_link(_tar, "tool", "bin/tool", tarfile.SYMTYPE)
+    out = tmp_path / "out"
+
+    unpack(make_tar(tmp_path, build), str(out))
+
+    assert os.readlink(out / "tool") == "bin/tool"
+    assert read(out / "tool") == b"#!/bin/sh\n"
+    assert stat.S_IMODE(os.stat(out / "bin/tool").st_mode) == 0o750
+    assert os.stat(out / "bin/tool").st_mtime == MTIME
+
+@pytest.mark.parametrize("members", [
+    [("file", "../evil")],
+    [("file", "/tmp/evil")],
+    [("link", "../outside", "escape"), ("file", "escape/evil")],
+])
+def test_tar_path_traversal_is_refused(tmp_path, members):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+
+    def build(_tar):
+        for kind, name, *target in members:
+            if kind == "file":
+                add_file(_tar, name, b"evil")
+            else:
+                add_link(_tar, target[0], name, tarfile.SYMTYPE)
+
+    with pytest.raises(ValueError):
+        unpack(make_tar(tmp_path, build, "archive.tar"), str(tmp_path / "out"))
+    assert os.listdir(outside) == []
+
+def test_zip_duplicates_symlinks_and_attributes(tmp_path):
+    def build(_zip):
+        info = zipfile.ZipInfo("d/file", (2001, 9, 9, 1, 46, 40))
+        info.external_attr = (stat.S_IFREG | 0o640) << 16
+        _zip.writestr(info, b"first")
+        _zip.writestr(info, b"second")
+        link = zipfile.ZipInfo("d/link")
+        link.external_attr = (stat.S_IFLNK | 0o777) << 16
+        _zip.writestr(link, "file")
+    out = tmp_path / "out"
+
+    unpack(make_zip(tmp_path, build), str(out))
+
+    assert read(out / "d/file") == b"second"
+    assert stat.S_IMODE(os.stat(out / "d/file").st_mode) == 0o640
+    # Zip stores local time
+    assert os.stat(out / "d/file").st_mtime == time.mktime((2001, 9, 9, 1, 46, 40, 0, 0, -1))
+    assert os.readlink(out / "d/link") == "file"
+
+def test_zip_path_traversal_is_refused(tmp_path):
+    def build(_zip):
+        _zip.writestr("../evil", b"evil")
+
+    with pytest.raises(ValueError):
+        unpack(make_zip(tmp_path, build), str(tmp_path / "out"))
+    assert not (tmp_path / "evil").exists()
@@ -0,0 +1,80 @@
+"""Tests of volume mount sessions"""
+import os
+from types import SimpleNamespace
+import pytest
+from libs import volumes
+from libs.volumes import VolumeManager
+
+@pytest.fixture
+def mounts(tmp_path, monkeypatch):
+    """records mount calls, mount paths are created below tmp_path"""
+    calls = []
+    def mkdtemp():
+        mount_path = str(tmp_path / f"mount{len(calls)}")
+        os.mkdir(mount_path)
+        return mount_path
+
+    monkeypatch.setattr(volumes, "mount", lambda *args: calls.append(("mount", *args)))
+    monkeypatch.setattr(volumes, "umount", lambda *args: calls.append(("umount", *args)))
+    monkeypatch.setattr(volumes.tempfile, "mkdtemp", mkdtemp)
+    return calls
+
+@pytest.fixture
+def manager():
+    return VolumeManager(SimpleNamespace(path="/dev/sda"))
+
+def partition(name):
+    return SimpleNamespace(path=f"/dev/{name}")
+
+def test_operations_share_one_mount(manager, mounts):
+    system = partition("sda1")
+    with manager.mounted(system) as first:
+        with manager.mounted(system) as second:
+            assert first == second
+            assert manager.mounts["/dev/sda1"].refs == 2
+
+    with manager.mounted(system) as third:
+        assert third == first
+
+    assert mounts == [("mount", "/dev/sda1", first)]
+    assert manager.mounts["/dev/sda1"].refs == 0
+
+def test_release_unmounts_and_removes_mount_path(manager, mounts):
+    with manager.mounted(partition("sda1")) as mount_path:
+        pass
+
+    manager.release(partition("sda1"))
+    manager.release(partition("sda1"))
+
+    assert mounts[-1] == ("umount", mount_path)
+    assert not os.path.exists(mount_path)
+    assert manager.mounts == {}
+
+def test_volume_in_use_is_not_released(manager, mounts):
+    with manager.mounted(partition("sda1")):
+        with pytest.raises(RuntimeError):
+            manager.release(partition("sda1"))
+
+    assert [call[0] for call in mounts] == ["mount"]
+
+def test_release_all(manager, mounts):
+    for name in ("sda1", "sda2"):
+        with manager.mounted(partition(name)):
+            pass
+
+    manager.release_all()
+
+    assert [call[0] for call in mounts] == ["mount", "mount", "umount", "umount"]
+    assert manager.mounts == {}
+
+def test_failed_mount_removes_mount_path(manager, mounts, tmp_path, monkeypatch):
+    def mount(*args):
+        raise OSError("wrong fs type")
+    monkeypatch.setattr(volumes, "mount", mount)
+
+    with pytest.raises(OSError):
+        with manager.mounted(partition("sda1")):
+            pass
+
+    assert os.listdir(tmp_path) == []
+    assert manager.mounts == {}